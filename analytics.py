@@ -0,0 +1,238 @@
+"""
+Windowed statistics of the channels, maintained sample by sample and published as derived channels.
+
+For each selected channel, over its last `window` samples:
+
+    mean, std, rms      sliding Welford update: O(1) per sample
+    min, max            monotonic deques: O(1) amortized per sample
+    <f>Hz               amplitude at the frequency f, sliding DFT of a single bin: O(1) per sample, and
+                        recomputed exactly once per window against the accumulation of rounding errors.
+                        The bin is at f exactly, even between two bins of the DFT of the window, and the
+                        mean of the window is removed from it. NaN when the window holds less than a cycle
+                        of f, or when f is above half the sample rate
+
+The sample rate needed by the spectral bins is estimated from the times of the first full window.
+The statistics of a device are published as the pseudo-device derivedDevice(ip) with the channels
+"<channel>.<statistic>", every 1 / outputRate seconds of samples, alongside the frames of the device.
+"""
+from collections import deque
+from samplestore import DataFrame
+from typing import Deque, Dict, List, Sequence, Tuple
+import cmath
+import math
+import numpy
+
+DEFAULT_WINDOW = 256
+DEFAULT_OUTPUT_RATE = 10
+STATISTICS = ("mean", "std", "rms", "min", "max")
+
+
+def derivedDevice(ip: str) -> str:
+    return f"{ip}#stats"
+
+
+class ChannelWindow:
+    """
+    The statistics of the last `window` values of a channel.
+    """
+
+    def __init__(self, window: int):
+        self.window = window
+        self.values: Deque[float] = deque()
+        self.count = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+        # (index, value) candidates for the minimum and the maximum of the window
+        self._minimums: Deque[Tuple[int, float]] = deque()
+        self._maximums: Deque[Tuple[int, float]] = deque()
+        self.bins: List[float] = list()
+        self._rotations: List[complex] = list()
+        # Phase of a value leaving the window, and sum of the rotations of the window (the bin of a constant)
+        self._leavingRotations: List[complex] = list()
+        self._constantBins: List[complex] = list()
+        self._spectrum: List[complex] = list()
+
+    def setBins(self, bins: Sequence[float]) -> None:
+        """
+        Track the DFT bins k (frequency k * sampleRate / window) from now on, k not necessarily whole.
+        """
+        self.bins = list(bins)
+        self._rotations = [cmath.exp(2j * math.pi * k / self.window) for k in self.bins]
+        self._leavingRotations = [cmath.exp(2j * math.pi * k) for k in self.bins]
+        exponents = numpy.arange(self.window, 0, -1)
+        self._constantBins = [complex(numpy.exp(2j * math.pi * k * exponents / self.window).sum()) for k in self.bins]
+        self._recomputeSpectrum()
+
+    def _recomputeSpectrum(self) -> None:
+        # Same phase convention as the sliding update: the newest value is rotated once, the oldest N times
+        values = numpy.zeros(self.window)
+        values[self.window - len(self.values):] = self.values
+        exponents = numpy.arange(self.window, 0, -1)
+        self._spectrum = [complex(numpy.dot(values, numpy.exp(2j * math.pi * k * exponents / self.window)))
+                          for k in self.bins]
+
+    def push(self, value: float) -> None:
+        leaving = 0.0
+        if len(self.values) < self.window:
+            size = len(self.values) + 1
+            delta = value - self.mean
+            self.mean += delta / size
+            self._m2 += delta * (value - self.mean)
+        else:
+            leaving = self.values.popleft()
+            previousMean = self.mean
+            self.mean += (value - leaving) / self.window
+            self._m2 += (value - leaving) * (value - self.mean + leaving - previousMean)
+        self.values.append(value)
+
+        index = self.count
+        self.count += 1
+        while self._maximums and self._maximums[-1][1] <= value:
+            self._maximums.pop()
+        self._maximums.append((index, value))
+        while self._minimums and self._minimums[-1][1] >= value:
+            self._minimums.pop()
+        self._minimums.append((index, value))
+        oldest = self.count - self.window
+        if self._maximums[0][0] < oldest:
+            self._maximums.popleft()
+        if self._minimums[0][0] < oldest:
+            self._minimums.popleft()
+
+        if self.bins:
+            if self.count % self.window == 0:
+                self._recomputeSpectrum()
+            else:
+                self._spectrum = [(bin + value - leaving * leavingRotation) * rotation for bin, rotation, leavingRotation
+                                  in zip(self._spectrum, self._rotations, self._leavingRotations)]
+
+    @property
+    def variance(self) -> float:
+        return max(0.0, self._m2 / len(self.values)) if self.values else math.nan
+
+    @property
+    def std(self) -> float:
+        return math.sqrt(self.variance)
+
+    @property
+    def rms(self) -> float:
+        return math.sqrt(self.variance + self.mean ** 2) if self.values else math.nan
+
+    @property
+    def minimum(self) -> float:
+        return self._minimums[0][1] if self._minimums else math.nan
+
+    @property
+    def maximum(self) -> float:
+        return self._maximums[0][1] if self._maximums else math.nan
+
+    def amplitudes(self) -> List[float]:
+        """
+        Amplitude of each bin, NaN until the window is full and for the bins it can't resolve.
+        """
+        if len(self.values) < self.window:
+            return [math.nan] * len(self.bins)
+        return [math.nan if k < 1 or k > self.window / 2 else
+                abs(bin - self.mean * constant) * (1 if k == self.window / 2 else 2) / self.window
+                for bin, constant, k in zip(self._spectrum, self._constantBins, self.bins)]
+
+
+class _DeviceAnalytics:
+    def __init__(self, columns: List[int], names: List[str], window: int, frequencies: Sequence[float]):
+        # Position in the rows (time excluded) and name of each selected channel
+        self.columns = columns
+        self.names = names
+        self.windows = [ChannelWindow(window) for _ in columns]
+        self.frequencies = list(frequencies)
+        self.times: Deque[float] = deque(maxlen=window)
+        self.sampleRate: float or None = None
+        self.nextOutput: float or None = None
+
+
+class AnalyticsStage:
+    def __init__(self, window: int = DEFAULT_WINDOW, outputRate: float = DEFAULT_OUTPUT_RATE,
+                 frequencies: Sequence[float] = (), channels: Sequence[str] or None = None):
+        """
+        :param window: samples per window
+        :param outputRate: derived frames per second (of sample time) per device
+        :param frequencies: frequencies (Hz) whose amplitude is tracked
+        :param channels: names of the channels to analyse, every channel of the devices by default
+        """
+        self.window = window
+        self.outputRate = outputRate
+        self.frequencies = list(frequencies)
+        self.channels = None if channels is None else list(channels)
+        self._devices: Dict[str, _DeviceAnalytics] = dict()
+
+    def addDevice(self, ip: str, channels: Sequence[str], exclude: Sequence[str] = ()) -> List[str]:
+        """
+        :param channels: the channels of the rows of the device, after their time
+        :param exclude: channels never analysed, e.g. the time channels
+        :return: the derived channels of the device
+        """
+        selected = [(column, name) for column, name in enumerate(channels) if name not in exclude
+                    and (self.channels is None or name in self.channels)]
+        self._devices[ip] = _DeviceAnalytics([column for column, _ in selected], [name for _, name in selected],
+                                             self.window, self.frequencies)
+        return self.derivedChannels(ip)
+
+    def derivedChannels(self, ip: str) -> List[str]:
+        analytics = self._devices[ip]
+        suffixes = list(STATISTICS) + [f"{frequency:g}Hz" for frequency in analytics.frequencies]
+        return [f"{name}.{suffix}" for name in analytics.names for suffix in suffixes]
+
+    def submit(self, ip: str, rows: Sequence[Sequence[float]]) -> List[List[float]]:
+        """
+        Add rows (time, value 1, value 2, ...) of a device, in time order.
+        :return: the derived rows due (time, then the values of derivedChannels), often none
+        """
+        analytics = self._devices.get(ip)
+        if analytics is None or not analytics.columns:
+            return []
+        output = list()
+        for row in rows:
+            t = row[0]
+            for column, window in zip(analytics.columns, analytics.windows):
+                value = row[1 + column]
+                if value == value:
+                    window.push(value)
+            analytics.times.append(t)
+            if analytics.sampleRate is None and analytics.frequencies and len(analytics.times) == self.window:
+                self._setBins(analytics)
+            if analytics.nextOutput is None:
+                analytics.nextOutput = t
+            if t >= analytics.nextOutput:
+                output.append(self._derivedRow(analytics, t))
+                analytics.nextOutput += 1 / self.outputRate
+                if analytics.nextOutput <= t:
+                    # Samples were missing: start again from now
+                    analytics.nextOutput = t + 1 / self.outputRate
+        return output
+
+    def toFrames(self, ip: str, rows: Sequence[Sequence[float]]) -> List[DataFrame]:
+        """
+        The rows of `submit` as frames of derivedDevice(ip), without the values not known yet.
+        """
+        channels = self.derivedChannels(ip)
+        frames = list()
+        for row in rows:
+            data = {channel: value for channel, value in zip(channels, row[1:]) if value == value}
+            frames.append(DataFrame(row[0], data or None))
+        return frames
+
+    def _setBins(self, analytics: _DeviceAnalytics) -> None:
+        span = analytics.times[-1] - analytics.times[0]
+        if span <= 0:
+            return
+        analytics.sampleRate = (len(analytics.times) - 1) / span
+        bins = [frequency * self.window / analytics.sampleRate for frequency in analytics.frequencies]
+        for window in analytics.windows:
+            window.setBins(bins)
+
+    @staticmethod
+    def _derivedRow(analytics: _DeviceAnalytics, t: float) -> List[float]:
+        row = [t]
+        for window in analytics.windows:
+            row.extend((window.mean if window.values else math.nan, window.std, window.rms, window.minimum, window.maximum))
+            row.extend(window.amplitudes() if window.bins else [math.nan] * len(analytics.frequencies))
+        return row
@@ -0,0 +1,220 @@
+"""
+Throughput, latency, CPU and memory of the acquisition chain on simulated phones (see simulator.py):
+
+    python3 benchmark.py --phones 8 --duration 10 --sensor-rate 200 --latency 0.02
+
+The simulated phones run in their own process. Then each stage is measured on its own:
+    producer     PhyphoxFleet polling the phones: samples/s, age of the samples when they reach the
+                 producer (end-to-end latency) and request latency percentiles
+    broadcaster  the samples of the producer stage pushed through the ring buffer and the broadcast
+    client       decoding of the datagrams sent by the broadcaster, like Phyclient does
+"""
+from fleet import PhyphoxFleet
+from rich.console import Console
+from rich.table import Table
+from shmring import SampleRing
+from simulator import simulatorAddresses, simulatorOptions, startSimulators
+from typing import Dict, List, Tuple
+import argparse
+import asyncio
+import json
+import main
+import multiprocessing
+import os
+import resource
+import socket
+import sys
+import threading
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "examples"))
+import phyclient  # noqa: E402
+
+console = Console()
+
+
+def percentile(values: List[float], value: float) -> float:
+    if len(values) == 0:
+        return 0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * value / 100))]
+
+
+def peakMemory() -> int:
+    """
+    Peak resident memory of the process, in KB.
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class Measure:
+    def __init__(self):
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+        self.memory = peakMemory()
+
+    def stop(self) -> Dict[str, float]:
+        return {"wall": time.perf_counter() - self.wall, "cpu": time.process_time() - self.cpu,
+                "memory": peakMemory() - self.memory}
+
+
+def _serveSimulators(args: argparse.Namespace, ready: multiprocessing.Event, stop: multiprocessing.Event) -> None:
+    async def serve():
+        simulators = await startSimulators(args.phones, args.port, distinctHosts=args.distinct_hosts, **simulatorOptions(args))
+        ready.set()
+        await asyncio.get_running_loop().run_in_executor(None, stop.wait)
+        for runner, _ in simulators:
+            await runner.cleanup()
+
+    asyncio.run(serve())
+
+
+async def benchmarkProducer(args: argparse.Namespace, addresses: List[Tuple[str, int]]):
+    fleet = PhyphoxFleet(addresses, 1 / args.rate, not args.polled)
+    rows: Dict[str, list] = dict()
+    ages = list()
+
+    def sink(ip: str, frames: list):
+        now = time.time()
+        channels = fleet.channels(ip)
+        for frame in frames:
+            ages.append(now - fleet.devices[0].timeOrigin - frame.t)
+        rows.setdefault(ip, []).extend((frame.t, *main._frameValues(frame, channels)) for frame in frames)
+
+    async with fleet:
+        failed = await fleet.connect()
+        if not failed:
+            failed = await fleet.sync(1)
+        if failed:
+            raise ConnectionError(f"the simulated phones {', '.join(device.ip for device in failed)} don't answer")
+        measure = Measure()
+        await fleet.start(sink)
+        await asyncio.sleep(args.duration)
+        await fleet.stop()
+        result = measure.stop()
+        requestLatencies = [latency for poller in fleet.pollers for latency in poller.stats.latencies]
+        result.update({
+            "samples": sum(len(deviceRows) for deviceRows in rows.values()),
+            "failed": sum(poller.stats.failedRequests for poller in fleet.pollers),
+            "latency": (percentile(ages, 50), percentile(ages, 99)),
+            "request": (percentile(requestLatencies, 50), percentile(requestLatencies, 99)),
+        })
+        channels = {device.ip: list(device.dataChannels) for device in fleet.devices}
+    return result, rows, channels
+
+
+def benchmarkBroadcaster(rows: Dict[str, list], channels: Dict[str, List[str]], binary: bool):
+    main.phonesList = [main.PhyphoxPhone(ip, 0) for ip in rows]
+    for device in main.phonesList:
+        device.dataChannels = channels[device.ip]
+    records = [(index, row[0], row[1:], 0) for index, device in enumerate(main.phonesList) for row in rows[device.ip]]
+    ring = SampleRing(max(1, len(records)), max(len(deviceChannels) for deviceChannels in channels.values()))
+    ring.writeBatch(records)
+
+    packets = list()
+    listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 2**25)
+    listener.bind(("127.0.0.1", main.SERVER_PORT))
+    listener.settimeout(0.5)
+
+    def capture():
+        while True:
+            try:
+                packets.append(listener.recv(2**16))
+            except (TimeoutError, socket.timeout):
+                return
+
+    captureThread = threading.Thread(target=capture, daemon=True)
+    captureThread.start()
+    main.doBroadcast = False
+    main.packetsSent = 0
+    measure = Measure()
+    # Not broadcasting anymore: the function sends what is in the ring and returns
+    main.dataServerLiveBroadcasting(ring, binary)
+    result = measure.stop()
+    captureThread.join()
+    listener.close()
+    ring.close()
+    ring.unlink()
+    result.update({"samples": len(records), "packets": main.packetsSent, "received": len(packets)})
+    return result, packets
+
+
+def benchmarkClient(packets: List[bytes], binary: bool):
+    client = phyclient.Phyclient(0, binary=binary)
+    samples = 0
+    measure = Measure()
+    for packet in packets:
+        if binary:
+            decoded = client._decodeBinary(packet)
+            if decoded is not None:
+                samples += sum(len(device["time"]) for device in decoded.values())
+        else:
+            json.loads(packet)
+            samples += 1
+    result = measure.stop()
+    result["samples"] = samples
+    return result
+
+
+def report(args: argparse.Namespace, producer: dict, broadcaster: dict, client: dict) -> Table:
+    table = Table(title=f"{args.phones} phones, {args.sensor_rate:g} Hz, {args.rate:g} requests/s, "
+                        f"{'binary' if args.binary else 'JSON'} broadcast")
+    for column in ("Stage", "Samples", "Samples/s", "CPU (s)", "CPU/sample (µs)", "Peak memory +KB", "Details"):
+        table.add_column(column)
+
+    def row(name: str, result: dict, details: str):
+        table.add_row(name, str(result["samples"]), f"{result['samples'] / max(result['wall'], 1e-9):.0f}",
+                      f"{result['cpu']:.3f}", f"{result['cpu'] / max(result['samples'], 1) * 10**6:.1f}",
+                      str(result["memory"]), details)
+
+    row("producer", producer, f"sample age p50 {producer['latency'][0] * 1000:.1f} ms, p99 {producer['latency'][1] * 1000:.1f} ms\n"
+                              f"request p50 {producer['request'][0] * 1000:.1f} ms, p99 {producer['request'][1] * 1000:.1f} ms\n"
+                              f"failed requests {producer['failed']}")
+    row("broadcaster", broadcaster, f"{broadcaster['packets']} datagrams, {broadcaster['received']} received")
+    row("client", client, "")
+    return table
+
+
+def parseArguments(arguments: List[str] or None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark the acquisition chain on simulated phones.")
+    parser.add_argument("--phones", type=int, default=4, help="simulated phones (default: %(default)s)")
+    parser.add_argument("--duration", type=float, default=5, help="seconds of acquisition (default: %(default)s)")
+    parser.add_argument("--rate", type=float, default=5, help="requests per second per phone (default: %(default)s)")
+    parser.add_argument("--polled", action="store_true", help="only fetch the latest values at each request")
+    parser.add_argument("--binary", action="store_true", help="benchmark the binary broadcast instead of JSON")
+    parser.add_argument("--port", type=int, default=18080, help="port of the simulated phones (default: %(default)s)")
+    parser.add_argument("--same-host", dest="distinct_hosts", action="store_false",
+                        help="serve every phone on 127.0.0.1 (needed out of Linux), phones then share their ip")
+    parser.add_argument("--sensor-rate", type=float, default=100, help="samples per second (default: %(default)s)")
+    parser.add_argument("--channels", type=int, default=3, help="data channels per phone (default: %(default)s)")
+    parser.add_argument("--latency", type=float, default=0.01, help="seconds added to each answer (default: %(default)s)")
+    parser.add_argument("--jitter", type=float, default=0.005, help="random +/- seconds on the latency (default: %(default)s)")
+    parser.add_argument("--loss", type=float, default=0, help="probability of a request to fail (default: %(default)s)")
+    parser.add_argument("--drift", type=float, default=0, help="clock drift of the phones, in ppm (default: %(default)s)")
+    return parser.parse_args(arguments)
+
+
+def run(args: argparse.Namespace) -> None:
+    ready, stop = multiprocessing.Event(), multiprocessing.Event()
+    simulators = multiprocessing.Process(target=_serveSimulators, args=(args, ready, stop), daemon=True)
+    simulators.start()
+    while not ready.wait(0.1):
+        if not simulators.is_alive():
+            raise RuntimeError("the simulated phones could not be started")
+    try:
+        console.print("[italic] - Producer...")
+        addresses = simulatorAddresses(args.phones, args.port, distinctHosts=args.distinct_hosts)
+        producer, rows, channels = asyncio.run(benchmarkProducer(args, addresses))
+    finally:
+        stop.set()
+        simulators.join()
+    console.print("[italic] - Broadcaster...")
+    broadcaster, packets = benchmarkBroadcaster(rows, channels, args.binary)
+    console.print("[italic] - Client...")
+    client = benchmarkClient(packets, args.binary)
+    console.print(report(args, producer, broadcaster, client))
+
+
+if __name__ == "__main__":
+    run(parseArguments())
@@ -0,0 +1,194 @@
+"""
+Lossless export of an experiment, once stopped and before the phones are cleared.
+
+The phones keep their whole buffers during the experiment, even the samples the live polling missed
+(throttled rate, polled mode, outages). `exportFull` downloads them from every phone concurrently, one
+channel per request, each answer streamed to a temporary file. The files are then parsed chunk by chunk
+straight to arrays, one phone at a time, and written to a recording (see recording.py) with the sensor
+times mapped to the host clock exactly like the live samples. `mergeRecordings` then completes the live
+recording with it.
+
+The time channels hold the sensor time of each sample, live and exported alike: it identifies a sample
+on the phone, while its stamp on the host clock depends on the clock fit of the moment.
+"""
+from typing import Dict, List, Sequence
+from phyphox import PhyphoxPhone
+from recording import RecordingReader, RecordingWriter
+import asyncio
+import numpy
+import os
+
+# Rows handed to the recording writer at once
+WRITE_ROWS = 2**16
+# Bytes of a downloaded buffer parsed at once
+PARSE_CHUNK = 2**20
+# Seconds two stamps of the same sensor time can differ by, live and exported, because of the clock fits.
+# A phone cleared during the run repeats its sensor times much further apart.
+MERGE_TOLERANCE = 0.1
+
+
+def parseBuffer(path: str, chunkSize: int = PARSE_CHUNK) -> numpy.ndarray:
+    """
+    The values of the single buffer of a `/get` answer, read chunk by chunk: only the numbers are kept in memory.
+    Missing values (null) are NaN.
+    """
+    parts = list()
+    pending = b""
+    with open(path, "rb") as file:
+        # The answer is {"buffer": {"<channel>": {..., "buffer": [values]}}, "status": {...}}, without any other array
+        while True:
+            chunk = file.read(chunkSize)
+            if not chunk:
+                raise ValueError(f"no buffer in {path}")
+            start = chunk.find(b"[")
+            if start >= 0:
+                pending = chunk[start + 1:]
+                break
+        done = False
+        while not done:
+            end = pending.find(b"]")
+            if end >= 0:
+                text, pending, done = pending[:end], b"", True
+            else:
+                chunk = file.read(chunkSize)
+                if not chunk:
+                    raise ValueError(f"truncated buffer in {path}")
+                # The last value may be cut, it waits for the next chunk
+                cut = pending.rfind(b",")
+                text, pending = pending[:cut + 1], pending[cut + 1:] + chunk
+            text = text.strip().strip(b",")
+            if text:
+                parts.append(numpy.fromstring(text.replace(b"null", b"nan").decode(), sep=","))
+    return numpy.concatenate(parts) if parts else numpy.empty(0)
+
+
+def bufferRows(device: PhyphoxPhone, buffers: Dict[str, numpy.ndarray]) -> numpy.ndarray:
+    """
+    The whole buffers of the channels of a device as rows (time, then one value per data channel of the device),
+    ordered by time. The samples are stamped with the clock of the device, relative to its timeOrigin.
+    """
+    parts = list()
+    for timeChannel, channels in device.timeChannels.items():
+        times = buffers[timeChannel]
+        columns = [buffers[channel] for channel in channels]
+        count = min([len(times)] + [len(column) for column in columns])
+        rows = numpy.full((count, len(device.dataChannels) + 1), numpy.nan)
+        rows[:, 0] = device.clock.toHost(times[:count]) - device.timeOrigin
+        rows[:, 1 + device.dataChannels.index(timeChannel)] = times[:count]
+        for channel, column in zip(channels, columns):
+            rows[:, 1 + device.dataChannels.index(channel)] = column[:count]
+        parts.append(rows)
+    if len(parts) == 0:
+        return numpy.empty((0, len(device.dataChannels) + 1))
+    rows = numpy.concatenate(parts)
+    return rows[numpy.argsort(rows[:, 0], kind="stable")]
+
+
+def _writeRows(writer: RecordingWriter, ip: str, rows: numpy.ndarray) -> None:
+    for begin in range(0, len(rows), WRITE_ROWS):
+        writer.write(ip, rows[begin:begin + WRITE_ROWS].tolist())
+
+
+def _downloads(device: PhyphoxPhone, path: str) -> Dict[str, str]:
+    return {channel: f"{path}.{device.ip}.{index}.json" for index, channel in enumerate(device.dataChannels)}
+
+
+async def _download(device: PhyphoxPhone, downloads: Dict[str, str]) -> bool:
+    # One channel after the other: a single large answer at a time per phone
+    for channel, download in downloads.items():
+        if not await device.downloadBuffer(channel, download):
+            return False
+    return True
+
+
+async def exportFull(devices: Sequence[PhyphoxPhone], path: str) -> List[PhyphoxPhone]:
+    """
+    Download the whole buffers of the devices to a recording. The experiment must be stopped, not cleared.
+    :return: the devices which failed, missing from the recording
+    """
+    downloads = [_downloads(device, path) for device in devices]
+    results = await asyncio.gather(*(_download(device, deviceDownloads) for device, deviceDownloads in zip(devices, downloads)))
+    failed = list()
+    with RecordingWriter(path) as writer:
+        for device, deviceDownloads, downloaded in zip(devices, downloads, results):
+            if downloaded:
+                try:
+                    rows = bufferRows(device, {channel: parseBuffer(download) for channel, download in deviceDownloads.items()})
+                except (ValueError, KeyError):
+                    downloaded = False
+                else:
+                    writer.addDevice(device.ip, device.dataChannels)
+                    _writeRows(writer, device.ip, rows)
+            if not downloaded:
+                failed.append(device)
+            for download in deviceDownloads.values():
+                if os.path.exists(download):
+                    os.remove(download)
+    return failed
+
+
+def _readRows(reader: RecordingReader, ip: str, channels: List[str]) -> numpy.ndarray:
+    # A copy: the columns of uncompressed chunks point into the mapping of the reader
+    columns = reader.read(ip)
+    return numpy.column_stack([columns["t"]] + [columns[channel] for channel in channels])
+
+
+def _exported(liveRows: numpy.ndarray, rows: numpy.ndarray, column: int) -> numpy.ndarray:
+    # Whether each live row has the same sensor time (in `column`) as an exported row, stamped about the same time
+    live = liveRows[:, column]
+    exported = rows[~numpy.isnan(rows[:, column])]
+    exported = exported[numpy.lexsort((exported[:, 0], exported[:, column]))]
+    first = numpy.searchsorted(exported[:, column], live, side="left")
+    last = numpy.searchsorted(exported[:, column], live, side="right") - 1
+    found = (last >= first) & ~numpy.isnan(live)
+    matched = numpy.zeros(len(live), dtype=bool)
+    # The same sensor time is only repeated by a phone cleared during the run: its earliest and latest stamps are enough
+    for candidate in (first, last):
+        stamps = exported[numpy.clip(candidate[found], 0, max(0, len(exported) - 1)), 0]
+        matched[found] |= numpy.abs(stamps - liveRows[found, 0]) <= MERGE_TOLERANCE
+    return matched
+
+
+def mergeRecordings(livePath: str, fullPath: str, outputPath: str,
+                    timeChannels: Dict[str, Sequence[str]] or None = None) -> None:
+    """
+    Write the samples of the full export, plus the live samples it doesn't have, to a new recording.
+    A live sample is identified in the export by its sensor time (the value of its time channel), as the
+    stamps of the export come from the final clock fit. Live samples without it are kept when they are
+    outside of the time range of the export.
+    The devices missing from the export are copied from the live recording.
+    :param timeChannels: the time channels of each device, by ip
+    """
+    timeChannels = timeChannels if timeChannels is not None else dict()
+    with RecordingReader(livePath) as live, RecordingReader(fullPath) as full, RecordingWriter(outputPath) as writer:
+        for ip, (_, channels) in live.devices.items():
+            liveRows = _readRows(live, ip, channels)
+            if ip in full.devices and full.devices[ip][1] == channels:
+                rows = _readRows(full, ip, channels)
+                if len(rows):
+                    timeColumns = [1 + channels.index(channel) for channel in timeChannels.get(ip, ()) if channel in channels]
+                    hasTime = numpy.zeros(len(liveRows), dtype=bool)
+                    kept = numpy.ones(len(liveRows), dtype=bool)
+                    for column in timeColumns:
+                        hasTime |= ~numpy.isnan(liveRows[:, column])
+                        kept &= ~_exported(liveRows, rows, column)
+                    outside = (liveRows[:, 0] < rows[0, 0]) | (liveRows[:, 0] > rows[-1, 0])
+                    kept &= hasTime | outside
+                    rows = numpy.concatenate((rows, liveRows[kept]))
+                    rows = rows[numpy.argsort(rows[:, 0], kind="stable")]
+                else:
+                    rows = liveRows
+            else:
+                rows = liveRows
+            writer.addDevice(ip, channels)
+            _writeRows(writer, ip, rows)
+
+
+def completeRecording(path: str, fullPath: str, timeChannels: Dict[str, Sequence[str]] or None = None) -> None:
+    """
+    Merge the full export into the live recording at `path` (see mergeRecordings), then remove the export.
+    """
+    merged = f"{path}.merging"
+    mergeRecordings(path, fullPath, merged, timeChannels)
+    os.replace(merged, path)
+    os.remove(fullPath)
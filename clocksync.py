@@ -0,0 +1,133 @@
+from collections import deque
+from typing import Deque, Dict, List, Tuple
+import math
+
+
+class ClockSync:
+    """
+    Maps the experiment time of a phone (the time buffers of phyphox) to the host clock (time.time()):
+        host = offset + rate * remote
+
+    It is fed with NTP-like exchanges: the host time when a request is sent, the newest experiment time
+    in the answer, and the host time when the answer is received. The newest experiment time is the one of
+    the newest sample: it was read before the answer was received, and lags the experiment time by up to a
+    sensor period. So `hostReceived - rate * remote` is never below the offset, and is closest to it for the
+    exchanges answered quickly right after a new sample: the fit follows this lower envelope instead of the
+    average of the exchanges, which the quantization to the sensor period would bias by half a period.
+
+    The exchanges are split in buckets of BUCKET_SPAN seconds of experiment time, keeping the one closest to
+    the envelope of each. The rate (drift) is fitted through them once they span MIN_DRIFT_SPAN seconds, 1 (or
+    the previous rate) until then. The offset follows the envelope of the recent buckets, smoothly: a better
+    exchange moves the stamps of the next samples by a fraction of the correction only.
+    """
+    BUCKET_SPAN = 2.0
+    BUCKETS = 64
+    # Buckets of the offset estimation: the newest ones, so an unknown drift barely matters
+    RECENT_BUCKETS = 4
+    # Remote time span (s) needed before trusting a drift estimation, the previous rate is used until then
+    MIN_DRIFT_SPAN = 30.0
+    MAX_DRIFT = 0.005
+    # Seconds: residual (rms) of the envelope points around the fit above which the rate isn't trusted
+    MAX_RESIDUAL = 0.002
+    # Part of the offset correction applied at each exchange
+    OFFSET_SMOOTHING = 0.2
+
+    def __init__(self, buckets: int = BUCKETS):
+        self.offset = 0.0
+        self.rate = 1.0
+        self.bestRoundTrip: float or None = None
+        # Whether the rate was fitted since the last reset, over MIN_DRIFT_SPAN with a residual under
+        # MAX_RESIDUAL, and this residual
+        self.hasRate = False
+        self.residual: float or None = None
+        # Bucket index -> (remote time, host time of the answer) of the exchange closest to the envelope
+        self._buckets: Dict[int, Tuple[float, float]] = dict()
+        self._order: Deque[int] = deque()
+        self._maxBuckets = buckets
+        self._isFitted = False
+
+    @property
+    def isCalibrated(self) -> bool:
+        return len(self._buckets) > 0
+
+    @property
+    def drift(self) -> float:
+        return self.rate - 1
+
+    @property
+    def span(self) -> float:
+        """
+        Remote time (s) covered by the exchanges kept.
+        """
+        if len(self._order) < 2:
+            return 0.0
+        return self._buckets[self._order[-1]][0] - self._buckets[self._order[0]][0]
+
+    def reset(self, keepRate: bool = True) -> None:
+        """
+        Forget the exchanges, e.g. when the experiment time restarts. The rate is a property of the phone
+        clock, so it can be kept as the prior of the next estimations, until it is estimated again.
+        """
+        self._buckets.clear()
+        self._order.clear()
+        self.offset = 0.0
+        self.bestRoundTrip = None
+        self._isFitted = False
+        self.hasRate = False
+        self.residual = None
+        if not keepRate:
+            self.rate = 1.0
+
+    def addSample(self, hostSent: float, remote: float, hostReceived: float) -> None:
+        roundTrip = hostReceived - hostSent
+        if roundTrip < 0 or remote is None:
+            return
+        if self.bestRoundTrip is None or roundTrip < self.bestRoundTrip:
+            self.bestRoundTrip = roundTrip
+        bucket = math.floor(remote / ClockSync.BUCKET_SPAN)
+        kept = self._buckets.get(bucket)
+        if kept is None:
+            if self._order and bucket < self._order[-1]:
+                # The experiment time went back without a reset: not the same timeline
+                return
+            self._order.append(bucket)
+            if len(self._order) > self._maxBuckets:
+                del self._buckets[self._order.popleft()]
+        elif hostReceived - remote >= kept[1] - kept[0]:
+            return
+        self._buckets[bucket] = (remote, hostReceived)
+        self._fit()
+
+    def _fitRate(self, points: List[Tuple[float, float]]) -> None:
+        if len(points) < 3 or self.span < ClockSync.MIN_DRIFT_SPAN:
+            return
+        count = len(points)
+        meanRemote = sum(point[0] for point in points) / count
+        meanHost = sum(point[1] for point in points) / count
+        covariance = sum((point[0] - meanRemote) * (point[1] - meanHost) for point in points)
+        variance = sum((point[0] - meanRemote) ** 2 for point in points)
+        rate = covariance / variance
+        residual = math.sqrt(sum((point[1] - meanHost - rate * (point[0] - meanRemote)) ** 2 for point in points) / count)
+        # A sane phone clock never drifts that much, the exchanges are too noisy to conclude anything
+        if abs(rate - 1) > ClockSync.MAX_DRIFT or residual > ClockSync.MAX_RESIDUAL:
+            return
+        if self._isFitted:
+            # Keep the stamp of the newest exchange where it was: the stamps stay continuous
+            self.offset += (self.rate - rate) * points[-1][0]
+        self.rate = rate
+        self.residual = residual
+        self.hasRate = True
+
+    def _fit(self) -> None:
+        points = [self._buckets[bucket] for bucket in self._order]
+        self._fitRate(points)
+        # The answer came at least half of the best round trip after the sample was read
+        target = min(host - self.rate * remote for remote, host in points[-ClockSync.RECENT_BUCKETS:]) - self.bestRoundTrip / 2
+        if self._isFitted:
+            self.offset += ClockSync.OFFSET_SMOOTHING * (target - self.offset)
+        else:
+            self.offset = target
+            self._isFitted = True
+
+    def toHost(self, remote: float) -> float:
+        return self.offset + self.rate * remote
@@ -0,0 +1,82 @@
+"""
+Connection state of a device, fed with the outcome of every request:
+
+    CONNECTED       the last request succeeded
+    RETRYING        some requests in a row failed: keep trying on the normal schedule
+    DISCONNECTED    `failureThreshold` requests in a row failed: the circuit is open, only one probe is let
+                    through after a backoff which doubles after each failed probe, up to `maxBackoff`
+
+The first success after DISCONNECTED sets `needsResume`: whoever drives the device resumes it then.
+"""
+import random
+import time
+
+CONNECTED = "connected"
+RETRYING = "retrying"
+DISCONNECTED = "disconnected"
+
+FAILURE_THRESHOLD = 3
+INITIAL_BACKOFF = 0.5
+MAX_BACKOFF = 30
+BACKOFF_MULTIPLIER = 2
+# Random +/- part of the backoff, so the probes of several devices spread out
+BACKOFF_JITTER = 0.1
+
+
+class ConnectionState:
+    def __init__(self, failureThreshold: int = FAILURE_THRESHOLD, initialBackoff: float = INITIAL_BACKOFF,
+                 maxBackoff: float = MAX_BACKOFF, multiplier: float = BACKOFF_MULTIPLIER):
+        self.failureThreshold = failureThreshold
+        self.initialBackoff = initialBackoff
+        self.maxBackoff = maxBackoff
+        self.multiplier = multiplier
+        self.state = CONNECTED
+        # Failed requests in a row, disconnections since the creation
+        self.failures = 0
+        self.outages = 0
+        self.needsResume = False
+        # Host time (time.time()) of the first failure of the current outage
+        self.downSince: float or None = None
+        self.backoff = initialBackoff
+        self._retryAt = 0.0
+
+    @property
+    def isConnected(self) -> bool:
+        return self.state == CONNECTED
+
+    def canRequest(self) -> bool:
+        """
+        Whether a request should be sent now: always, unless the circuit is open and the backoff isn't over.
+        """
+        return self.state != DISCONNECTED or time.monotonic() >= self._retryAt
+
+    def retryIn(self) -> float:
+        """
+        :return: seconds before the next probe is allowed
+        """
+        if self.state != DISCONNECTED:
+            return 0
+        return max(0.0, self._retryAt - time.monotonic())
+
+    def recordSuccess(self) -> None:
+        if self.state == DISCONNECTED:
+            self.needsResume = True
+        self.state = CONNECTED
+        self.failures = 0
+        self.downSince = None
+        self.backoff = self.initialBackoff
+
+    def recordFailure(self) -> None:
+        self.failures += 1
+        if self.downSince is None:
+            self.downSince = time.time()
+        if self.state == DISCONNECTED:
+            # The probe failed too
+            self.backoff = min(self.maxBackoff, self.backoff * self.multiplier)
+        elif self.failures >= self.failureThreshold:
+            self.state = DISCONNECTED
+            self.outages += 1
+        else:
+            self.state = RETRYING
+            return
+        self._retryAt = time.monotonic() + self.backoff * random.uniform(1 - BACKOFF_JITTER, 1 + BACKOFF_JITTER)
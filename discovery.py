@@ -0,0 +1,97 @@
+from dataclasses import dataclass
+from phyphox import PhyphoxPhone
+from typing import AsyncIterator, Callable, Iterable, Set, Tuple
+import aiohttp
+import asyncio
+import ipaddress
+import itertools
+
+DEFAULT_CONCURRENCY = 256
+DEFAULT_TIMEOUT = 0.5
+
+
+@dataclass
+class DiscoveredPhone:
+    ip: str
+    port: int
+    config: dict
+
+
+def _addresses(network: ipaddress.IPv4Network or ipaddress.IPv6Network) -> Iterable:
+    # A /31 or /32 has no "hosts" but is still a valid target
+    return network.hosts() if network.num_addresses > 2 else iter(network)
+
+
+def countTargets(network: str, ports: Iterable[int]) -> int:
+    hosts = ipaddress.ip_network(network, strict=False)
+    return (hosts.num_addresses - 2 if hosts.num_addresses > 2 else hosts.num_addresses) * len(list(ports))
+
+
+async def _isPortOpen(ip: str, port: int, timeout: float) -> bool:
+    try:
+        _, writer = await asyncio.wait_for(asyncio.open_connection(ip, port), timeout)
+    except (OSError, asyncio.TimeoutError):
+        return False
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except OSError:
+        pass
+    return True
+
+
+async def _fetchConfig(ip: str, port: int, session: aiohttp.ClientSession, timeout: float) -> dict or None:
+    phone = PhyphoxPhone(ip, port, session=session, requestTimeout=timeout)
+    try:
+        await phone.getRemoteConfig()
+    except (aiohttp.ClientError, ValueError, KeyError, TypeError):
+        # Something answered, but not a phyphox server
+        return None
+    if phone.didLastRequestFailed() or "inputs" not in phone.config:
+        return None
+    return phone.config
+
+
+async def scanNetwork(network: str, ports: Iterable[int], concurrency: int = DEFAULT_CONCURRENCY,
+                      timeout: float = DEFAULT_TIMEOUT, verify: bool = True,
+                      exclude: Set[Tuple[str, int]] = frozenset(),
+                      onProbed: Callable[[], None] or None = None) -> AsyncIterator[DiscoveredPhone]:
+    """
+    Probe every host of a network (CIDR notation, e.g. "192.168.1.0/24") on every given port concurrently,
+    at most `concurrency` connections at once, and yield the phones as soon as they are found.
+    :param verify: only keep the hosts answering a valid phyphox `/config`
+    :param exclude: (ip, port) couples not to probe, e.g. the phones already paired
+    :param onProbed: called after each probe, whatever its result, to follow the progress
+    """
+    ports = list(ports)
+    addresses = _addresses(ipaddress.ip_network(network, strict=False))
+    targets = ((str(ip), port) for ip, port in itertools.product(addresses, ports))
+    found: asyncio.Queue = asyncio.Queue()
+    session = PhyphoxPhone.createSession(concurrency) if verify else None
+
+    async def worker():
+        for ip, port in targets:
+            if (ip, port) not in exclude and await _isPortOpen(ip, port, timeout):
+                config = {} if session is None else await _fetchConfig(ip, port, session, timeout * 4)
+                if config is not None:
+                    await found.put(DiscoveredPhone(ip, port, config))
+            if onProbed is not None:
+                onProbed()
+
+    # Every worker pulls from the same generator: the concurrency is bounded without creating a task per host
+    workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+    waiter = asyncio.ensure_future(asyncio.gather(*workers))
+    try:
+        while not (waiter.done() and found.empty()):
+            getter = asyncio.ensure_future(found.get())
+            await asyncio.wait((getter, waiter), return_when=asyncio.FIRST_COMPLETED)
+            if getter.done():
+                yield getter.result()
+            else:
+                getter.cancel()
+        waiter.result()
+    finally:
+        for task in workers:
+            task.cancel()
+        if session is not None:
+            await session.close()
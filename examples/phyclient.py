@@ -1,45 +1,204 @@
+import asyncio
 import socket
 import json
+import select
+import struct
 import threading
+from collections import deque
 from queue import Queue, Empty
 import time
 
+import numpy
+
+# Binary format of the broadcast, see wireformat.py at the root of the project
+MAGIC = b"PX"
+SCHEMA_PACKET = 1
+DATA_PACKET = 2
+GAP_PACKET = 3
+START_PACKET = 4
+HEADER = struct.Struct("!2sBB")
+SCHEMA_HEADER = struct.Struct("!HH")
+DATA_HEADER = struct.Struct("!HIHH")
+GAP_BODY = struct.Struct("!Hdd")
+START_BODY = struct.Struct("!Hdd")
+
+# A datagram can't be larger
+MAX_DATAGRAM = 2**16
+# Datagrams waiting in the socket are read in bursts into a preallocated buffer of this size
+RECEIVE_BUFFER = 2**20
+# Requested size of the kernel receive buffer of the socket
+SOCKET_BUFFER = 2**22
+BATCH_FRAMES = 4096
+
 
 class PhyClosed(BaseException):
     pass
 
 
+def _unpackString(data: bytes, offset: int):
+    length = data[offset]
+    return bytes(data[offset + 1:offset + 1 + length]).decode(), offset + 1 + length
+
+
 class Phyclient:
     TIMEMOUT = 5
 
-    def __init__(self, port):
+    def __init__(self, port, binary=False, socketBuffer=SOCKET_BUFFER, address="127.0.0.1"):
+        """
+        :param binary: set it if the server broadcasts the binary format. getData then returns
+        {ip: {"time": array, "data": {channel: array}}} with one NumPy array entry per frame.
+        :param socketBuffer: size requested for the kernel receive buffer: the datagrams arriving while it is
+        full are lost. The size granted is in `socketBufferSize` once listening.
+        :param address: address to listen on, a multicast group is joined on every interface
+        """
         self.port = port
-        self.address = "127.0.0.1"
+        self.address = address
+        self.binary = binary
+        self.socketBuffer = socketBuffer
+        self.socketBufferSize = 0
         self.doRun = False
         self.thread: threading.Thread or None = None
+        # Lists of the items decoded from a burst of datagrams
         self.queue = Queue()
+        self._pending = deque()
         self.timeout = 0
         self.didReceiveData = False
+        # device id -> (schema id, ip, channels)
+        self.schemas = dict()
+        self.unknownSchemaPackets = 0
+        # Binary format only: next sequence number expected by device id, and data packets missed by ip
+        self._sequences = dict()
+        self.lostPackets = dict()
+        # (ip, start, end) of the samples a device lost, e.g. while it was unreachable, announced by the server
+        self.gaps = list()
+        # ip -> (start, uncertainty): when each device really started, relative to t=0, announced by the server
+        self.starts = dict()
 
-    def _backgroundThread(self):
+    def _decodeBinary(self, data: bytes) -> dict or None:
+        magic, version, packetType = HEADER.unpack_from(data)
+        if magic != MAGIC:
+            return None
+        offset = HEADER.size
+        if packetType == SCHEMA_PACKET:
+            deviceId, schemaId = SCHEMA_HEADER.unpack_from(data, offset)
+            ip, offset = _unpackString(data, offset + SCHEMA_HEADER.size)
+            count, = struct.unpack_from("!H", data, offset)
+            offset += 2
+            channels = list()
+            for _ in range(count):
+                channel, offset = _unpackString(data, offset)
+                channels.append(channel)
+            self.schemas[deviceId] = (schemaId, ip, channels)
+            return None
+        if packetType == GAP_PACKET:
+            deviceId, start, end = GAP_BODY.unpack_from(data, offset)
+            schema = self.schemas.get(deviceId)
+            if schema is not None:
+                self.gaps.append((schema[1], start, end))
+            return None
+        if packetType == START_PACKET:
+            deviceId, start, uncertainty = START_BODY.unpack_from(data, offset)
+            schema = self.schemas.get(deviceId)
+            if schema is not None:
+                self.starts[schema[1]] = (start, uncertainty)
+            return None
+        if packetType != DATA_PACKET:
+            return None
+        deviceId, sequence, schemaId, frames = DATA_HEADER.unpack_from(data, offset)
+        schema = self.schemas.get(deviceId)
+        if schema is None or schema[0] != schemaId:
+            self.unknownSchemaPackets += 1
+            return None
+        _, ip, channels = schema
+        self._checkSequence(deviceId, ip, sequence)
+        values = numpy.frombuffer(data, dtype="<f8", offset=offset + DATA_HEADER.size, count=frames * (len(channels) + 1))
+        values = values.reshape(frames, len(channels) + 1)
+        return {ip: {"time": values[:, 0], "data": {channel: values[:, i + 1] for i, channel in enumerate(channels)}}}
+
+    def _checkSequence(self, deviceId: int, ip: str, sequence: int) -> None:
+        expected = self._sequences.get(deviceId)
+        self._sequences[deviceId] = (sequence + 1) % 2**32
+        if expected is None:
+            return
+        gap = (sequence - expected) % 2**32
+        # A jump backwards is a restart of the server, not a loss
+        if 0 < gap < 2**31:
+            self.lostPackets[ip] = self.lostPackets.get(ip, 0) + gap
+
+    @property
+    def lostPacketsCount(self) -> int:
+        return sum(self.lostPackets.values())
+
+    def _decodeBurst(self, buffer: memoryview, packets: list) -> list:
+        """
+        Decode the datagrams of a burst, stored at the (offset, size) of `packets` in the buffer.
+        In binary mode the frames of each device are merged into a single item, copied out of the buffer.
+        """
+        if not self.binary:
+            items = list()
+            for offset, size in packets:
+                item = json.loads(bytes(buffer[offset:offset + size]))
+                ip, frame = next(iter(item.items()))
+                if "gap" in frame:
+                    self.gaps.append((ip, *frame["gap"]))
+                    continue
+                if "start" in frame:
+                    self.starts[ip] = tuple(frame["start"])
+                    continue
+                items.append(item)
+            return items
+        decoded = (self._decodeBinary(buffer[offset:offset + size]) for offset, size in packets)
+        # Concatenating copies the frames out of the buffer, which is reused by the next burst
+        merged = self._mergeArrays([item for item in decoded if item is not None])
+        return [{ip: frames} for ip, frames in merged.items()]
+
+    def _openSocket(self) -> socket.socket:
         listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        listener.bind((self.address, self.port))
-        listener.settimeout(2)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.socketBuffer)
+        self.socketBufferSize = listener.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+        if socket.inet_aton(self.address)[0] in range(224, 240):
+            # Several clients can follow the same multicast group on one host
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            listener.bind(("", self.port))
+            membership = socket.inet_aton(self.address) + socket.inet_aton("0.0.0.0")
+            listener.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+        else:
+            listener.bind((self.address, self.port))
+        listener.setblocking(False)
+        return listener
+
+    def _backgroundThread(self):
+        listener = self._openSocket()
+        buffer = memoryview(bytearray(RECEIVE_BUFFER))
         while self.doRun:
-            try:
-                data, remote = listener.recvfrom(2**13)
-            except TimeoutError:
+            readable, _, _ = select.select([listener], [], [], 2)
+            if not readable:
                 if not self.didReceiveData:
                     continue
                 self.timeout += 2
                 if self.timeout > Phyclient.TIMEMOUT:
                     self.doRun = False
                 continue
-            if len(data) < 2**2:
+            # Take every datagram already waiting, as long as the buffer has room
+            packets = list()
+            offset = 0
+            while offset + MAX_DATAGRAM <= len(buffer):
+                try:
+                    size = listener.recv_into(buffer[offset:], MAX_DATAGRAM)
+                except (BlockingIOError, InterruptedError):
+                    break
+                packets.append((offset, size))
+                offset += size
+            packets = [packet for packet in packets if packet[1] >= 2**2]
+            if len(packets) == 0:
                 continue
             if not self.didReceiveData:
                 self.didReceiveData = True
-            self.queue.put(json.loads(data))
+            self.timeout = 0
+            items = self._decodeBurst(buffer, packets)
+            if items:
+                self.queue.put(items)
+        listener.close()
 
     def runListener(self):
         self.doRun = True
@@ -50,10 +209,82 @@ class Phyclient:
         self.doRun = False
         self.thread.join()
 
+    def _next(self, timeout: float):
+        if len(self._pending) == 0:
+            self._pending.extend(self.queue.get(timeout=timeout))
+        return self._pending.popleft()
+
     def getData(self):
         while True:
             try:
-                return self.queue.get(timeout=2)
+                return self._next(2)
             except (TimeoutError, Empty):
                 if not self.doRun and self.timeout > Phyclient.TIMEMOUT:
                     raise PhyClosed
+
+    def getBatch(self, maxFrames: int = BATCH_FRAMES, timeout: float = 2) -> dict:
+        """
+        Everything received, up to about maxFrames frames, as {ip: {"time": array, "data": {channel: array}}}.
+        Waits up to `timeout` seconds for the first frames, then only takes what already arrived.
+        :return: an empty dict if nothing arrived in time
+        """
+        items, frames = list(), 0
+        wait = timeout
+        while frames < maxFrames:
+            try:
+                item = self._next(wait)
+            except (TimeoutError, Empty):
+                if frames == 0 and not self.doRun and self.timeout > Phyclient.TIMEMOUT:
+                    raise PhyClosed
+                break
+            wait = 0
+            items.append(item)
+            frames += sum(numpy.size(frame["time"]) for frame in item.values())
+        if self.binary:
+            return self._mergeArrays(items)
+        return self._mergeFrames(items)
+
+    @staticmethod
+    def _mergeArrays(items: list) -> dict:
+        parts = dict()
+        for item in items:
+            for ip, frames in item.items():
+                parts.setdefault(ip, []).append(frames)
+        return {ip: {"time": numpy.concatenate([part["time"] for part in deviceParts]),
+                     "data": {channel: numpy.concatenate([part["data"][channel] for part in deviceParts])
+                              for channel in deviceParts[0]["data"]}}
+                for ip, deviceParts in parts.items()}
+
+    @staticmethod
+    def _mergeFrames(items: list) -> dict:
+        frames = dict()
+        for item in items:
+            for ip, frame in item.items():
+                frames.setdefault(ip, []).append(frame)
+        result = dict()
+        for ip, deviceFrames in frames.items():
+            # Frames without data (the device didn't answer) become NaN on every channel
+            channels = dict.fromkeys(channel for frame in deviceFrames for channel in (frame["data"] or {}))
+            result[ip] = {"time": numpy.array([frame["time"] for frame in deviceFrames], dtype=float),
+                          "data": {channel: numpy.array([(frame["data"] or {}).get(channel) for frame in deviceFrames], dtype=float)
+                                   for channel in channels}}
+        return result
+
+    async def batches(self, maxFrames: int = BATCH_FRAMES, timeout: float = 2):
+        """
+        The batches of getBatch, until the server stops sending:
+
+            async for batch in client:
+                ...
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                batch = await loop.run_in_executor(None, self.getBatch, maxFrames, timeout)
+            except PhyClosed:
+                return
+            if batch:
+                yield batch
+
+    def __aiter__(self):
+        return self.batches()
@@ -0,0 +1,299 @@
+"""
+Fan-out of the broadcast to several subscribers: each batch is encoded once by the broadcaster and the
+same buffers are handed to every subscriber.
+
+    UdpSubscriber        one datagram per packet to a host:port
+    MulticastSubscriber  one datagram per packet to a multicast group, for any number of listeners
+    StreamSubscriber     a client connected to a StreamServer (TCP or Unix socket). Each packet is sent as
+                         its length (u32, big-endian) followed by the packet. The packets wait in a bounded
+                         queue, emptied by a thread per client: when a slow client lets it fill up, the
+                         drop policy decides what happens.
+"""
+from abc import ABC, abstractmethod
+from collections import deque
+from metrics import defaultRegistry
+from typing import Deque, List, Sequence, Tuple
+import os
+import socket
+import struct
+import threading
+
+LENGTH = struct.Struct("!I")
+# What a full stream queue does with a new packet: forget the oldest one, forget the new one, or drop the client
+DROP_OLDEST = "drop-oldest"
+DROP_NEWEST = "drop-newest"
+DISCONNECT = "disconnect"
+DROP_POLICIES = (DROP_OLDEST, DROP_NEWEST, DISCONNECT)
+DEFAULT_QUEUE_SIZE = 4096
+MULTICAST_TTL = 1
+# Seconds a closing stream client is given to take the packets waiting, and a closing thread to end
+CLOSE_TIMEOUT = 1.0
+
+
+class Subscriber(ABC):
+    def __init__(self, name: str):
+        self.name = name
+        self.closed = False
+        self.sent = defaultRegistry.counter("fanout_packets_total", "Packets sent to a subscriber", subscriber=name)
+        self.dropped = defaultRegistry.counter("fanout_dropped_total", "Packets a subscriber didn't get", subscriber=name)
+
+    @abstractmethod
+    def publish(self, packets: Sequence[bytes]) -> None:
+        pass
+
+    def close(self) -> None:
+        self.closed = True
+
+
+class UdpSubscriber(Subscriber):
+    def __init__(self, address: Tuple[str, int], sock: socket.socket or None = None):
+        """
+        :param sock: UDP socket to send with, e.g. shared by the unicast subscribers of a FanOut
+        """
+        super().__init__(f"udp://{address[0]}:{address[1]}")
+        self.address = address
+        self._socket = sock if sock is not None else socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._ownsSocket = sock is None
+
+    def publish(self, packets: Sequence[bytes]) -> None:
+        for packet in packets:
+            try:
+                self._socket.sendto(packet, self.address)
+                self.sent.inc()
+            except OSError:
+                # Full socket buffer or unreachable host: datagrams are lost anyway, keep going
+                self.dropped.inc()
+
+    def close(self) -> None:
+        super().close()
+        if self._ownsSocket:
+            self._socket.close()
+
+
+class MulticastSubscriber(UdpSubscriber):
+    def __init__(self, group: str, port: int, ttl: int = MULTICAST_TTL, interface: str or None = None):
+        """
+        :param ttl: routers the datagrams can cross, 1 keeps them on the local network
+        :param interface: ip of the local interface to send from (default: chosen by the system)
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, ttl)
+        # Listeners on this host receive the feed too
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+        if interface is not None:
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(interface))
+        super().__init__((group, port), sock)
+        self.name = f"multicast://{group}:{port}"
+        self._ownsSocket = True
+
+
+class StreamSubscriber(Subscriber):
+    def __init__(self, connection: socket.socket, name: str, queueSize: int = DEFAULT_QUEUE_SIZE,
+                 dropPolicy: str = DROP_OLDEST):
+        """
+        :param queueSize: packets waiting for the client at most
+        :param dropPolicy: DROP_OLDEST, DROP_NEWEST or DISCONNECT, applied when the queue is full
+        """
+        if dropPolicy not in DROP_POLICIES:
+            raise ValueError(f"unknown drop policy {dropPolicy!r}")
+        super().__init__(name)
+        self.queueSize = queueSize
+        self.dropPolicy = dropPolicy
+        self._connection = connection
+        self._queue: Deque[bytes] = deque()
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._writerThread, daemon=True)
+        self._thread.start()
+
+    def publish(self, packets: Sequence[bytes]) -> None:
+        with self._condition:
+            if self.closed:
+                return
+            for packet in packets:
+                if len(self._queue) >= self.queueSize:
+                    if self.dropPolicy == DROP_NEWEST:
+                        self.dropped.inc()
+                        continue
+                    if self.dropPolicy == DISCONNECT:
+                        self.dropped.inc(len(self._queue) + 1)
+                        self._queue.clear()
+                        self.closed = True
+                        # Unblocks the writer if it is stuck sending to the client
+                        try:
+                            self._connection.shutdown(socket.SHUT_RDWR)
+                        except OSError:
+                            pass
+                        break
+                    self._queue.popleft()
+                    self.dropped.inc()
+                self._queue.append(packet)
+            self._condition.notify()
+
+    def _writerThread(self):
+        while True:
+            with self._condition:
+                while len(self._queue) == 0 and not self.closed:
+                    self._condition.wait()
+                if len(self._queue) == 0:
+                    break
+                packets = list(self._queue)
+                self._queue.clear()
+            try:
+                self._connection.sendall(b"".join(LENGTH.pack(len(packet)) + packet for packet in packets))
+                self.sent.inc(len(packets))
+            except OSError:
+                # The client left
+                self.dropped.inc(len(packets))
+                with self._condition:
+                    self.dropped.inc(len(self._queue))
+                    self._queue.clear()
+                    self.closed = True
+                break
+        self._connection.close()
+
+    def close(self, timeout: float = CLOSE_TIMEOUT) -> None:
+        """
+        Stop accepting packets, send the ones waiting and disconnect. A client which doesn't take them
+        within `timeout` is disconnected anyway.
+        """
+        with self._condition:
+            self.closed = True
+            self._condition.notify()
+        self._thread.join(timeout)
+        # Unblocks the writer if it is stuck sending to a client which stopped reading
+        try:
+            self._connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._thread.join(timeout)
+
+
+class StreamServer:
+    """
+    Accepts stream clients and subscribes each of them to a FanOut.
+    """
+
+    def __init__(self, fanOut: "FanOut", address: Tuple[str, int] or str, queueSize: int = DEFAULT_QUEUE_SIZE,
+                 dropPolicy: str = DROP_OLDEST):
+        """
+        :param address: (host, port) to listen on with TCP, or the path of a Unix socket
+        """
+        self.fanOut = fanOut
+        self.address = address
+        self.queueSize = queueSize
+        self.dropPolicy = dropPolicy
+        self._socket: socket.socket or None = None
+        self._thread: threading.Thread or None = None
+
+    def start(self) -> None:
+        if isinstance(self.address, str):
+            if os.path.exists(self.address):
+                os.unlink(self.address)
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind(self.address)
+        self._socket.listen()
+        self._thread = threading.Thread(target=self._acceptThread, daemon=True)
+        self._thread.start()
+
+    def _acceptThread(self):
+        while True:
+            try:
+                connection, peer = self._socket.accept()
+            except OSError:
+                # Closed
+                return
+            if connection.family == socket.AF_INET:
+                connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                name = f"tcp://{peer[0]}:{peer[1]}"
+            else:
+                name = f"unix://{self.address}#{connection.fileno()}"
+            self.fanOut.add(StreamSubscriber(connection, name, self.queueSize, self.dropPolicy))
+
+    def close(self) -> None:
+        if self._socket is None:
+            return
+        # Wakes accept() up on Linux, closing alone doesn't
+        try:
+            self._socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._socket.close()
+        self._thread.join(CLOSE_TIMEOUT)
+        self._socket = None
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.unlink(self.address)
+
+
+class FanOut:
+    """
+    The subscribers of the broadcast. `publish` may be called from one thread while clients come and go.
+    """
+
+    def __init__(self):
+        self.subscribers: List[Subscriber] = list()
+        self.servers: List[StreamServer] = list()
+        self._lock = threading.Lock()
+        # Packets dropped by the subscribers already removed
+        self._removedDropped = 0.0
+        self._udpSocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def add(self, subscriber: Subscriber) -> Subscriber:
+        with self._lock:
+            self.subscribers.append(subscriber)
+        return subscriber
+
+    def remove(self, subscriber: Subscriber) -> None:
+        with self._lock:
+            removed = subscriber in self.subscribers
+            if removed:
+                self.subscribers.remove(subscriber)
+        subscriber.close()
+        if removed:
+            with self._lock:
+                self._removedDropped += subscriber.dropped.value
+
+    def addUdp(self, host: str, port: int) -> UdpSubscriber:
+        return self.add(UdpSubscriber((host, port), self._udpSocket))
+
+    def addMulticast(self, group: str, port: int, ttl: int = MULTICAST_TTL, interface: str or None = None) -> MulticastSubscriber:
+        return self.add(MulticastSubscriber(group, port, ttl, interface))
+
+    def serve(self, address: Tuple[str, int] or str, queueSize: int = DEFAULT_QUEUE_SIZE,
+              dropPolicy: str = DROP_OLDEST) -> StreamServer:
+        """
+        Accept stream clients on a TCP (host, port) or a Unix socket path.
+        """
+        server = StreamServer(self, address, queueSize, dropPolicy)
+        server.start()
+        self.servers.append(server)
+        return server
+
+    def publish(self, packets: Sequence[bytes]) -> None:
+        with self._lock:
+            subscribers = list(self.subscribers)
+        for subscriber in subscribers:
+            if subscriber.closed:
+                # Left, or disconnected by its drop policy
+                self.remove(subscriber)
+                continue
+            subscriber.publish(packets)
+
+    def dropped(self) -> float:
+        with self._lock:
+            return self._removedDropped + sum(subscriber.dropped.value for subscriber in self.subscribers)
+
+    def close(self) -> None:
+        for server in self.servers:
+            server.close()
+        self.servers.clear()
+        with self._lock:
+            subscribers = list(self.subscribers)
+            self.subscribers.clear()
+        for subscriber in subscribers:
+            subscriber.close()
+        with self._lock:
+            self._removedDropped += sum(subscriber.dropped.value for subscriber in subscribers)
+        self._udpSocket.close()
@@ -0,0 +1,252 @@
+from bulkexport import exportFull
+from discovery import scanNetwork
+from phyphox import PhyphoxPhone
+from poller import AdaptiveRate, DevicePoller
+from samplestore import DataFrame
+from startsync import START_LEAD, StartReport, startTogether, warmUp
+from typing import AsyncIterator, Callable, Dict, Iterable, List, Tuple
+import asyncio
+import time
+
+# Pause (s) after stopping the devices, before they can be queried again
+STOP_DELAY = 0.03
+CALIBRATION_DURATION = 2
+CALIBRATION_INTERVAL = 0.05
+
+
+async def calibrateClock(device: PhyphoxPhone, duration: float = CALIBRATION_DURATION,
+                         interval: float = CALIBRATION_INTERVAL, stopDelay: float = STOP_DELAY) -> bool:
+    """
+    Run a short experiment on the device and exchange its time with it repeatedly.
+    The device is cleared before and after.
+    :return: whether the clock could be calibrated
+    """
+    await device.resetExperiment()
+    await device.startExperiment()
+    endAt = time.monotonic() + duration
+    while time.monotonic() < endAt:
+        await device.syncClock()
+        await asyncio.sleep(interval)
+    await device.stopExperiment()
+    await asyncio.sleep(stopDelay)
+    if not device.clock.isCalibrated:
+        return False
+    await device.resetExperiment()
+    device.deltaTime = device.clock.rate
+    return True
+
+
+class PhyphoxFleet:
+    """
+    A set of phones acquiring together, without any user interaction:
+
+        async with PhyphoxFleet([("192.168.1.20", 8080)]) as fleet:
+            await fleet.connect()
+            await fleet.sync()
+            await fleet.start()
+            async for ip, frames in fleet.stream():
+                ...
+            # from another task: await fleet.stop()
+    """
+
+    def __init__(self, devices: Iterable[Tuple[str, int] or PhyphoxPhone] = (), interval: float = 1 / 5,
+                 incremental: bool = True, intervals: Dict[str, float] or None = None,
+                 bufferCapacity: int or None = None, stopDelay: float = STOP_DELAY, adaptive: dict or None = None):
+        """
+        :param interval: seconds between two polls of a device
+        :param incremental: fetch every sample recorded instead of the latest values only
+        :param intervals: poll interval of the devices which don't use `interval`, by ip
+        :param bufferCapacity: samples kept in memory per device (unbounded by default)
+        :param stopDelay: pause (s) after stopping the devices, before they can be queried again
+        :param adaptive: adapt the rate of each device to its latency, starting from its interval, with these
+        options of poller.AdaptiveRate (bounds, target latency...). Disabled when None.
+        """
+        self.interval = interval
+        self.incremental = incremental
+        self.intervals = intervals if intervals is not None else dict()
+        self.adaptive = adaptive
+        self.bufferCapacity = bufferCapacity
+        self.stopDelay = stopDelay
+        self.devices: List[PhyphoxPhone] = list()
+        self.pollers: List[DevicePoller] = list()
+        # Measured start of each device, by ip
+        self.starts: Dict[str, StartReport] = dict()
+        self.isRunning = False
+        self._stop = asyncio.Event()
+        self._tasks: List[asyncio.Task] = list()
+        self._frames: asyncio.Queue = asyncio.Queue()
+        for device in devices:
+            if isinstance(device, PhyphoxPhone):
+                self.devices.append(device)
+            else:
+                self.add(*device)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        if self.isRunning:
+            await self.stop()
+        await self.close()
+
+    def channels(self, ip: str) -> List[str]:
+        for device in self.devices:
+            if device.ip == ip:
+                return device.dataChannels
+        raise KeyError(ip)
+
+    def add(self, ip: str, port: int) -> PhyphoxPhone:
+        for device in self.devices:
+            if device.ip == ip and device.port == port:
+                return device
+        device = PhyphoxPhone(ip, port, bufferCapacity=self.bufferCapacity)
+        self.devices.append(device)
+        return device
+
+    async def discover(self, network: str, ports: Iterable[int], **options) -> List[PhyphoxPhone]:
+        """
+        Scan a network (see discovery.scanNetwork for the options) and add the phones found.
+        :return: the phones added
+        """
+        known = {(device.ip, device.port) for device in self.devices}
+        found = list()
+        async for phone in scanNetwork(network, ports, exclude=known, **options):
+            device = self.add(phone.ip, phone.port)
+            # Empty when the hosts weren't verified: connect fetches it
+            if phone.config:
+                device.applyConfig(phone.config)
+            found.append(device)
+        return found
+
+    async def connect(self, devices: Iterable[PhyphoxPhone] or None = None) -> List[PhyphoxPhone]:
+        """
+        Fetch the configuration of every device, or of these ones only.
+        :return: the devices which failed
+        """
+        devices = self.devices if devices is None else list(devices)
+        await asyncio.gather(*(device.getRemoteConfig() for device in devices))
+        return [device for device in devices if device.didLastRequestFailed()]
+
+    async def sync(self, duration: float = CALIBRATION_DURATION,
+                   devices: Iterable[PhyphoxPhone] or None = None) -> List[PhyphoxPhone]:
+        """
+        Calibrate the clock of every device concurrently, or of these ones only.
+        :return: the devices which failed
+        """
+        devices = self.devices if devices is None else list(devices)
+        results = await asyncio.gather(*(calibrateClock(device, duration, stopDelay=self.stopDelay) for device in devices))
+        return [device for device, calibrated in zip(devices, results)
+                if device.didLastRequestFailed() or not calibrated]
+
+    async def warmUp(self) -> None:
+        """
+        Open a connection to every device, ready for a start at a scheduled instant (see startsync.py).
+        """
+        await warmUp(self.devices)
+
+    async def start(self, sink: Callable[[str, List[DataFrame]], None] or None = None,
+                    onGap: Callable[[str, float, float], None] or None = None, origin: float or None = None,
+                    onStart: Callable[[StartReport], None] or None = None) -> None:
+        """
+        Start the experiment on every device together, then poll each of them in its own task.
+        :param sink: receives the new frames of a device after each poll. Without it, use `stream`.
+        :param onGap: receives the ip of a device and the times between which its samples are lost
+        :param origin: host time (time.time()) of t=0, when every device is asked to start. By default the
+        connections are warmed up and the start is scheduled START_LEAD later; otherwise call `warmUp` before.
+        Fleets sharing it share their timeline.
+        :param onStart: receives the measured start of each device which started
+        """
+        if origin is None:
+            await self.warmUp()
+            origin = time.time() + START_LEAD
+        # Every device stamps its samples on the host clock relative to the same origin
+        for device in self.devices:
+            device.timeOrigin = origin
+        self.starts = {report.ip: report for report in await startTogether(self.devices, origin)}
+        if onStart is not None:
+            for report in self.starts.values():
+                if report.started:
+                    onStart(report)
+        self._stop.clear()
+        self.pollers = [DevicePoller(device, self.intervals.get(device.ip, self.interval), sink or self._enqueue, self.incremental,
+                                     self._controller(device), onGap)
+                        for device in self.devices]
+        self._tasks = [asyncio.create_task(poller.run(self._stop)) for poller in self.pollers]
+        self.isRunning = True
+
+    def _controller(self, device: PhyphoxPhone) -> AdaptiveRate or None:
+        if self.adaptive is None:
+            return None
+        return AdaptiveRate(1 / self.intervals.get(device.ip, self.interval), **self.adaptive)
+
+    def snapshot(self) -> List[dict]:
+        """
+        The counters of every poller since the start, their request latency percentiles (s), and the
+        estimation of the clock of their device.
+        """
+        return [{"ip": poller.device.ip, "interval": poller.interval, "adaptive": poller.controller is not None,
+                 "ticks": poller.stats.ticks,
+                 "samples": poller.stats.samples, "failedRequests": poller.stats.failedRequests,
+                 "missedTicks": poller.stats.missedTicks, "lag": poller.stats.lastLag,
+                 "state": poller.device.connection.state, "outages": poller.device.connection.outages,
+                 "gaps": poller.stats.gaps, "startSkew": self._startSkew(poller.device),
+                 "clockRate": poller.device.clock.rate, "clockHasRate": poller.device.clock.hasRate,
+                 "clockResidual": poller.device.clock.residual, "bestRoundTrip": poller.device.clock.bestRoundTrip,
+                 "latencyP50": poller.stats.latencyPercentile(50), "latencyP99": poller.stats.latencyPercentile(99)}
+                for poller in self.pollers]
+
+    def _startSkew(self, device: PhyphoxPhone) -> float or None:
+        report = self.starts.get(device.ip)
+        return report.skew if report is not None and report.started else None
+
+    def _enqueue(self, ip: str, frames: List[DataFrame]) -> None:
+        if frames:
+            self._frames.put_nowait((ip, frames))
+
+    async def stream(self) -> AsyncIterator[Tuple[str, List[DataFrame]]]:
+        """
+        The frames of each poll as (ip, frames), until the fleet is stopped and everything was read.
+        """
+        while not self._stop.is_set():
+            getter = asyncio.ensure_future(self._frames.get())
+            stopper = asyncio.ensure_future(self._stop.wait())
+            await asyncio.wait((getter, stopper), return_when=asyncio.FIRST_COMPLETED)
+            stopper.cancel()
+            if getter.done():
+                yield getter.result()
+            else:
+                getter.cancel()
+        # Stopped: let the pollers end before reading what is left
+        await asyncio.gather(*self._tasks)
+        while not self._frames.empty():
+            yield self._frames.get_nowait()
+
+    async def stop(self, reset: bool = True) -> None:
+        """
+        Stop the experiment on every device and stop polling, once the samples recorded since the last poll
+        were fetched (incremental mode).
+        :param reset: also clear the experiment data on the devices
+        """
+        await asyncio.gather(*(device.stopExperiment() for device in self.devices))
+        self._stop.set()
+        await asyncio.gather(*self._tasks)
+        self.isRunning = False
+        if reset:
+            await self.reset()
+
+    async def reset(self) -> None:
+        """
+        Clear the experiment data on every device.
+        """
+        await asyncio.sleep(self.stopDelay)
+        await asyncio.gather(*(device.resetExperiment() for device in self.devices))
+
+    async def exportFull(self, path: str) -> List[PhyphoxPhone]:
+        """
+        Download the whole buffers of every device to a recording (see bulkexport.py), after `stop(reset=False)`.
+        :return: the devices which failed
+        """
+        return await exportFull(self.devices, path)
+
+    async def close(self) -> None:
+        await asyncio.gather(*(device.close() for device in self.devices))
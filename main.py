@@ -1,16 +1,37 @@
-from rich.console import Console
-from rich.prompt import Confirm, IntPrompt
+from rich.console import Console, Group
+from rich.prompt import Confirm, IntPrompt, Prompt
 from rich.progress import Progress
 from rich.live import Live
 from rich.table import Table
 
+import argparse
 import asyncio
 import multiprocessing
+import queue
 import signal
+import sys
 import threading
 
-from typing import List, Dict
+from typing import List, Dict, Set, Tuple
+from analytics import DEFAULT_OUTPUT_RATE, DEFAULT_WINDOW, AnalyticsStage, derivedDevice
+from bulkexport import completeRecording
+from discovery import DiscoveredPhone, countTargets, scanNetwork
+from fanout import DEFAULT_QUEUE_SIZE, DROP_OLDEST, DROP_POLICIES, MULTICAST_TTL, FanOut
+from fleet import PhyphoxFleet, calibrateClock
+from metrics import JsonDumpExporter, MetricsExporter, PrometheusExporter, defaultRegistry
 from phyphox import PhyphoxPhone
+from poller import MAX_RATE, TARGET_LATENCY
+from recording import RecordingSink, RecordingWriter
+from registry import DeviceRegistry
+from replay import MAX_SPEED, loadSession, replaySession
+from resample import ALIGNED_DEVICE, LINEAR, METHODS, Resampler
+from samplestore import DataFrame
+from sharding import DEFAULT_SAMPLE_RATE, PHONES_PER_WORKER, MergedRings, balanceShards, deviceLoad
+from shmring import FLAG_EMPTY, FLAG_GAP, FLAG_START, SampleRing
+from startsync import START_LEAD, StartReport
+from wireformat import BinaryEncoder
+import math
+import os
 import socket
 import time
 import json
@@ -18,6 +39,20 @@ import json
 ### CONSTANT
 PORT = 8080
 SERVER_PORT = 6060
+# Seconds between two announcements of the channels schemas in binary mode
+SCHEMA_ANNOUNCE_PERIOD = 1
+# Records taken from the ring buffer at most before sending a batch, and the pause (s) when it is empty
+BROADCAST_BATCH = 512
+BROADCAST_IDLE_DELAY = 0.002
+# Records the ring buffer between the producer and the broadcaster can hold
+RING_CAPACITY = 2**16
+# Samples kept in memory per device, the older ones are only available through the broadcast
+BUFFER_CAPACITY = 2**16
+# Seconds between two metrics snapshots of the producer, and between two refreshes of the dashboard
+METRICS_PERIOD = 0.5
+DASHBOARD_REFRESH = 0.5
+# Seconds the producer processes wait for each other to start, stop or clear the phones together
+BARRIER_TIMEOUT = 60
 
 console = Console()
 MY_IP: str = ""
@@ -25,12 +60,38 @@ LOCAL_NETWORK_IP: str = ""
 MENU_POINTER: int = 0
 doRun: bool = True
 phonesList: List[PhyphoxPhone] = list()
-alreadyPairedIps = set()
+alreadyPairedIps: Set[Tuple[str, int]] = set()
+# The paired phones, their configuration and clock calibration, kept between two launches (see registry.py)
+deviceRegistry = DeviceRegistry()
 doRunExperiment: bool = False
+doBroadcast: bool = False
 frameRate = 1/25
+# Poll interval of the devices which don't use frameRate
+deviceIntervals: Dict[str, float] = dict()
+incrementalFetching = True
+# Options of poller.AdaptiveRate when the rate of each device adapts to its latency, None otherwise
+adaptiveRate: dict or None = None
+binaryBroadcasting = False
+# Grid times per second and method of the alignment of the devices (see resample.py), broadcast raw when None
+resampleRate: float or None = None
+resampleMethod = LINEAR
+# Producer processes polling the phones, and the load of each phone measured by the previous experiment (by ip)
+producerWorkers = 1
+measuredLoads: Dict[str, float] = dict()
+# Options of analytics.AnalyticsStage when rolling statistics of the channels are published, None otherwise
+analyticsOptions: dict or None = None
+# Where the producer downloads the whole buffers of the phones after the run, to complete the recording
+fullExportPath: str or None = None
 delayRequest = 0.03
 requestTimeError = 0
 packetsSent = 0
+bytesSent = 0
+# Subscribers of the broadcast (see fanout.py), only 127.0.0.1:SERVER_PORT when None
+broadcastFanOut: FanOut or None = None
+# Latest snapshot of the producer process (see publishMetrics)
+producerMetrics: dict = {"devices": [], "series": []}
+# The requests are made by the producer: export its series along with ours
+defaultRegistry.addCollector(lambda: producerMetrics["series"])
 
 
 def getLocalIp() -> str:
@@ -44,10 +105,6 @@ def getLocalIp() -> str:
     return res
 
 
-def getEndpointFromIp(ip: str) -> int:
-    return int(ip[ip.index(".", 3 * 2 + 2) + 1:])
-
-
 def mainMenu() -> int:
     console.print("-" * 2, "MAIN", "-" * 2)
     console.print(" " * 2, "1 - Add device")
@@ -70,37 +127,33 @@ def mainMenu() -> int:
     return subMenu[choice]
 
 
-def addPhone() -> int:
+async def addPhone() -> int:
     global alreadyPairedIps, phonesList
-    port = PORT
+    network = f"{LOCAL_NETWORK_IP}0/24"
+    ports = [PORT]
     console.print("-" * 2, "Phone Pairing", "-" * 2)
     console.print("Current Configuration: ")
-    console.print(" " * 3, "PORT:", port)
+    console.print(" " * 3, "NETWORK:", network)
+    console.print(" " * 3, "PORTS:", ", ".join(map(str, ports)))
     choice = Confirm.ask("Change configuration ?", default=False)
     if choice:
-        port = IntPrompt.ask("> ")
+        network = Prompt.ask("Network (CIDR) ", default=network)
+        ports = [int(port) for port in Prompt.ask("Ports (comma separated) ", default=str(PORT)).split(",")]
 
-    # ? Pre-allocate the list ?
-    newPhones = list()
-    newPhonesCount = 0
+    newPhones: List[DiscoveredPhone] = list()
 
     with Progress() as progress:
-        task = progress.add_task("[green] Scanning local network...", total=255)
-        for endpoint in range(1, 255 + 1):
-            if endpoint in alreadyPairedIps:
-                continue
-            try:
-                s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                s.settimeout(0.1)
-                remoteIP = f"{LOCAL_NETWORK_IP}{endpoint}"
-                s.connect((remoteIP, port))
-                s.close()
-                newPhones.append(endpoint)
-                newPhonesCount += 1
-            except (ConnectionError, OSError) as e:
-                # Ignore... What can we do else ?
-                pass
-            progress.update(task, advance=1)
+        try:
+            total = countTargets(network, ports)
+        except ValueError:
+            console.print("[red] Invalid network ! Dropping...")
+            time.sleep(2)
+            return 0
+        task = progress.add_task("[green] Scanning local network...", total=total)
+        async for phone in scanNetwork(network, ports, exclude=alreadyPairedIps, onProbed=lambda: progress.update(task, advance=1)):
+            progress.console.print(f"[deep_sky_blue1] Found {phone.ip}:{phone.port}")
+            newPhones.append(phone)
+    newPhonesCount = len(newPhones)
 
     console.print("[deep_sky_blue1] Phones detected:", newPhonesCount)
     if newPhonesCount == 0:
@@ -109,26 +162,26 @@ def addPhone() -> int:
 
     console.print(" " * 3, "0 - Add all")
     for endpoint in range(newPhonesCount):
-        console.print(" " * 3, f"{endpoint + 1} - Add {LOCAL_NETWORK_IP}{newPhones[endpoint]}")
+        console.print(" " * 3, f"{endpoint + 1} - Add {newPhones[endpoint].ip}:{newPhones[endpoint].port}")
     choice = IntPrompt.ask("> ")
-    if choice < 0 or choice - 1 > newPhonesCount:
+    if choice < 0 or choice > newPhonesCount:
         console.print("[red] Invalid choice ! Dropping...")
         time.sleep(2)
         return 0
-    if choice == 0:
-        for endpoint in newPhones:
-            phonesList.append(PhyphoxPhone(f"{LOCAL_NETWORK_IP}{endpoint}", port))
-            alreadyPairedIps.add(endpoint)
-        console.print(f"[green] Added [purple] {newPhonesCount} [green]phones !")
-    else:
-        phonesList.append(PhyphoxPhone(f"{LOCAL_NETWORK_IP}{newPhones[choice - 1]}", port))
-        alreadyPairedIps.add(newPhones[choice - 1])
-        console.print(f"[green] Added [purple] 1 [green]phone !")
+    selected = newPhones if choice == 0 else [newPhones[choice - 1]]
+    for phone in selected:
+        device = PhyphoxPhone(phone.ip, phone.port, bufferCapacity=BUFFER_CAPACITY)
+        device.applyConfig(phone.config)
+        phonesList.append(device)
+        alreadyPairedIps.add((phone.ip, phone.port))
+        deviceRegistry.remember(device)
+    saveRegistry()
+    console.print(f"[green] Added [purple] {len(selected)} [green]phone{'s' if len(selected) > 1 else ''} !")
     time.sleep(1)
     return 0
 
 
-def pairedPhones() -> int:
+async def pairedPhones() -> int:
     global phonesList, alreadyPairedIps
     console.print("-"*2, "PAIRED PHONES", "-"*2)
     numberOfPhones = len(phonesList)
@@ -138,7 +191,7 @@ def pairedPhones() -> int:
         return 0
     console.print("Connected Phones: ")
     for i in range(numberOfPhones):
-        console.print(" ", i + 1, ".", f"{phonesList[i].ip}:{phonesList[i].port}")
+        console.print(" ", i + 1, ".", f"{phonesList[i].ip}:{phonesList[i].port}", f"[italic]({phonesList[i].connection.state})")
     console.print()
     console.print(" "*2, "0 - Do nothing")
     console.print(" "*2, "1 - Disconnect a phone")
@@ -149,6 +202,10 @@ def pairedPhones() -> int:
         time.sleep(2)
         return 0
     if choice == 2:
+        await asyncio.gather(*(device.close() for device in phonesList))
+        for device in phonesList:
+            deviceRegistry.forget(device)
+        saveRegistry()
         phonesList.clear()
         alreadyPairedIps.clear()
         console.print("[green] All phones disconnected !")
@@ -163,75 +220,232 @@ def pairedPhones() -> int:
             time.sleep(2)
             return 0
         device = phonesList.pop(choice - 1)
-        alreadyPairedIps.remove(getEndpointFromIp(device.ip))
+        await device.close()
+        deviceRegistry.forget(device)
+        saveRegistry()
+        alreadyPairedIps.remove((device.ip, device.port))
         console.print(f"[green] Phone {device.ip} disconnected !")
         time.sleep(1)
     return 0
 
 
+async def restorePairedPhones() -> None:
+    """
+    Pair again the phones of the previous launches (see registry.py) instead of scanning the network,
+    and probe them all at once.
+    """
+    records = deviceRegistry.load()
+    if len(records) == 0:
+        return
+    for record in records:
+        phonesList.append(PhyphoxPhone(record.ip, record.port, bufferCapacity=BUFFER_CAPACITY))
+        alreadyPairedIps.add((record.ip, record.port))
+    unconfigured, _ = await deviceRegistry.validate(phonesList)
+    console.print(f"[deep_sky_blue1]Known phones: {len(records)} ({len(records) - len(unconfigured)} ready)")
+
+
+def saveRegistry() -> None:
+    try:
+        deviceRegistry.save()
+    except OSError as e:
+        console.print("[red1] The paired phones couldn't be saved:", e)
+
+
 async def isPhyphoxPhoneAlive(device: PhyphoxPhone):
-    global alreadyPairedIps, phonesList
+    """
+    The phone is kept even if it doesn't answer: its requests are retried with a backoff (see connection.py).
+    Disconnect it from the paired phones menu to forget it.
+    """
     await device.ping()
     if not device.isAlive:
-        console.print("[italic red] Phone", device.ip, "just died !")
-        alreadyPairedIps.remove(getEndpointFromIp(device.ip))
-        phonesList.remove(device)
+        console.print("[italic red] Phone", device.ip, "doesn't answer, it will be retried",
+                      f"({device.connection.state})")
 
 
 async def deltaTimeTest(device: PhyphoxPhone):
+    """
+    Calibrate the clock of the device: run a short experiment and exchange its time with it repeatedly.
+    """
     global requestTimeError
-    await device.resetExperiment()
-    await device.startExperiment()
-    await asyncio.sleep(2)
-    await device.stopExperiment()
-    await asyncio.sleep(delayRequest)
-    remoteTime = await device.getRemoteTime()
-    if remoteTime is None:
-        return
-    if len(remoteTime) < 2:
+    if not await calibrateClock(device, stopDelay=delayRequest):
         device._didLastRequestFailed = True
         requestTimeError += 1
         return
-    remoteStart = remoteEnd = 0
-    for rem in remoteTime:
-        if rem["event"] == "START":
-            remoteStart = rem["experimentTime"]
-        elif rem["event"] == "PAUSE":
-            remoteEnd = rem["experimentTime"]
-    remoteDelta = remoteEnd - remoteStart
-    localDelta = (device.endAt - device.startAt) / 10**9 - delayRequest
-    console.log(f"[italic]      {device.ip} - Remote : {remoteDelta} ; Local : {localDelta}")
-    await device.resetExperiment()
-    device.deltaTime = localDelta / remoteDelta
-
-
-async def latencyPhone5Test():
+    deviceRegistry.remember(device)
+    console.log(f"[italic]      {device.ip} - Best round trip : {device.clock.bestRoundTrip * 1000:.1f} ms")
+
+
+def _latencyReport(device: PhyphoxPhone) -> str:
+    if device.clock.bestRoundTrip is None:
+        return "not calibrated"
+    # The rate can't be estimated by the short calibrations, only by a long enough run (see clocksync.py)
+    if device.clock.hasRate:
+        drift = f"{device.clock.drift * 10**6:.1f} ppm"
+    elif device.clock.rate != 1:
+        drift = f"{device.clock.drift * 10**6:.1f} ppm (previous run)"
+    else:
+        drift = "not estimated yet"
+    return f"best round trip {device.clock.bestRoundTrip * 1000:.1f} ms, offset uncertainty " \
+           f"{device.clock.bestRoundTrip * 500:.1f} ms, drift {drift}"
+
+
+async def latencyPhone5Test() -> Tuple[bool, Dict[str, List[float]]]:
+    """
+    Calibrate the clocks 5 times in a row.
+    :return: whether enough calibrations succeeded, and the best round trips (s) of each device
+    """
     console.print("[italic] - Running 5 tests of latency per device...")
-    latencyResults: Dict[str, List[float]] = {device.ip: list() for device in phonesList}
+    roundTrips: Dict[str, List[float]] = {device.ip: list() for device in phonesList}
     for test in range(5):
         await asyncio.gather(*(deltaTimeTest(device) for device in phonesList))
         for device in phonesList:
-            latencyResults[device.ip].append(device.deltaTime)
-    for device in phonesList:
-        device.deltaTime = sum(latencyResults[device.ip])/5
-    return requestTimeError <= len(phonesList) * 5 // 2
+            if device.clock.bestRoundTrip is not None:
+                roundTrips[device.ip].append(device.clock.bestRoundTrip)
+    return requestTimeError <= len(phonesList) * 5 // 2, roundTrips
+
 
+def _recordToFrame(record: tuple) -> DataFrame:
+    device = phonesList[record[0]]
+    if record[1] & FLAG_EMPTY:
+        return DataFrame(record[2], None)
+    data = {channel: value for channel, value in zip(device.dataChannels, record[3:]) if value == value}
+    return DataFrame(record[2], data or None)
 
-def dataServerLiveBroadcasting(output: multiprocessing.Queue):
+
+def dataServerLiveBroadcasting(ring: SampleRing, binary: bool = False, recorder: RecordingSink or None = None,
+                               fanOut: FanOut or None = None, resampler: Resampler or None = None,
+                               analytics: AnalyticsStage or None = None):
     """
     This function must be run in a different thread in order to keep the interactive console.
     Here we broadcast the data gathered to a local port using the UDP protocol.
-    The user can listen to the port to handle the data
+    The user can listen to the port to handle the data.
+    In binary mode, the records waiting in the ring are batched per device (see wireformat.py),
+    otherwise each frame is sent as its own JSON datagram.
+    Lost samples are announced by a gap packet in binary mode, by {ip: {"gap": [start, end]}} in JSON,
+    and the measured start of each device (see startsync.py) by a start packet, by {ip: {"start": [start, uncertainty]}}.
+    Each batch is encoded once and the same packets go to every subscriber.
+    :param recorder: also hand the records over to this recording
+    :param fanOut: the subscribers, only 127.0.0.1:SERVER_PORT by default
+    :param resampler: broadcast the devices aligned on its time grid, as the single device ALIGNED_DEVICE,
+    instead of their own frames. The recording keeps the frames of each device.
+    :param analytics: also broadcast the rolling statistics of each device, as the device derivedDevice(ip)
     :return:
     """
-    global packetsSent
-    server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    console.print("[cyan] Broadcasting on", SERVER_PORT)
-    while doRunExperiment or output.qsize() > 0:
-        data = output.get()
-        packet = {data[0]: data[1].toJson()}
-        server.sendto(json.dumps(packet).encode(), ("127.0.0.1", SERVER_PORT))
-        packetsSent += 1
+    global packetsSent, bytesSent
+    ownsFanOut = fanOut is None
+    if ownsFanOut:
+        fanOut = FanOut()
+        fanOut.addUdp("127.0.0.1", SERVER_PORT)
+    console.print("[cyan] Broadcasting to", ", ".join(subscriber.name for subscriber in fanOut.subscribers) or "no one yet")
+    encoder = BinaryEncoder()
+    for device in phonesList:
+        encoder.registerDevice(device.ip, device.dataChannels)
+        if recorder is not None:
+            recorder.addDevice(device.ip, device.dataChannels)
+        if resampler is not None:
+            resampler.addDevice(device.ip, device.dataChannels)
+        if analytics is not None:
+            derivedChannels = analytics.addDevice(device.ip, device.dataChannels, exclude=device.timeChannels)
+            encoder.registerDevice(derivedDevice(device.ip), derivedChannels)
+            if recorder is not None:
+                recorder.addDevice(derivedDevice(device.ip), derivedChannels)
+    if resampler is not None:
+        encoder.registerDevice(ALIGNED_DEVICE, resampler.channels)
+    records = defaultRegistry.counter("broadcast_records_total", "Records taken from the ring buffer")
+    packets = defaultRegistry.counter("broadcast_packets_total", "Datagrams sent")
+    sentBytes = defaultRegistry.counter("broadcast_bytes_total", "Bytes sent")
+    serializing = defaultRegistry.histogram("broadcast_serialize_seconds", "Encoding of the datagrams of a batch")
+    sending = defaultRegistry.histogram("broadcast_send_seconds", "Sending of the datagrams of a batch")
+    resampling = defaultRegistry.histogram("broadcast_resample_seconds", "Alignment of the devices of a batch")
+    analysing = defaultRegistry.histogram("broadcast_analytics_seconds", "Rolling statistics of a batch")
+    lastAnnounce = 0
+    while doBroadcast or len(ring) > 0:
+        if binary and time.monotonic() - lastAnnounce >= SCHEMA_ANNOUNCE_PERIOD:
+            fanOut.publish(encoder.schemaPackets())
+            lastAnnounce = time.monotonic()
+        batchRecords = ring.readBatch(BROADCAST_BATCH)
+        if len(batchRecords) == 0:
+            time.sleep(BROADCAST_IDLE_DELAY)
+            continue
+        records.inc(len(batchRecords))
+        batch: Dict[int, list] = dict()
+        for record in batchRecords:
+            batch.setdefault(record[0], []).append(record)
+        encodedAt = time.perf_counter()
+        batchPackets = list()
+        for index, deviceRecords in batch.items():
+            device = phonesList[index]
+            gaps = [record for record in deviceRecords if record[1] & FLAG_GAP]
+            if gaps:
+                deviceRecords = [record for record in deviceRecords if not record[1] & FLAG_GAP]
+                if resampler is not None:
+                    for record in gaps:
+                        resampler.gap(device.ip, record[2], record[3])
+                elif binary:
+                    batchPackets.extend(encoder.encodeGap(device.ip, record[2], record[3]) for record in gaps)
+                else:
+                    batchPackets.extend(json.dumps({device.ip: {"gap": [record[2], record[3]]}}).encode() for record in gaps)
+            starts = [record for record in deviceRecords if record[1] & FLAG_START]
+            if starts:
+                deviceRecords = [record for record in deviceRecords if not record[1] & FLAG_START]
+                if binary:
+                    batchPackets.extend(encoder.encodeStart(device.ip, record[2], record[3]) for record in starts)
+                else:
+                    batchPackets.extend(json.dumps({device.ip: {"start": [record[2], record[3]]}}).encode() for record in starts)
+            rows = [record[2:3 + len(device.dataChannels)] for record in deviceRecords]
+            if recorder is not None and rows:
+                recorder.submit(device.ip, rows)
+            if analytics is not None and rows:
+                analysedAt = time.perf_counter()
+                derived = analytics.submit(device.ip, rows)
+                analysing.observe(time.perf_counter() - analysedAt)
+                if recorder is not None and derived:
+                    recorder.submit(derivedDevice(device.ip), derived)
+                if derived and binary:
+                    batchPackets.extend(encoder.encodeRows(derivedDevice(device.ip), derived))
+                elif derived:
+                    batchPackets.extend(json.dumps({derivedDevice(device.ip): frame.toJson()}).encode()
+                                        for frame in analytics.toFrames(device.ip, derived))
+            if resampler is not None:
+                resampler.submit(device.ip, rows)
+            elif binary:
+                batchPackets.extend(encoder.encodeRows(device.ip, rows))
+            else:
+                batchPackets.extend(json.dumps({device.ip: _recordToFrame(record).toJson()}).encode() for record in deviceRecords)
+        if resampler is not None:
+            resampledAt = time.perf_counter()
+            batchPackets.extend(_encodeAligned(resampler, resampler.advance(), encoder if binary else None))
+            resampling.observe(time.perf_counter() - resampledAt)
+        sentAt = time.perf_counter()
+        serializing.observe(sentAt - encodedAt)
+        fanOut.publish(batchPackets)
+        sending.observe(time.perf_counter() - sentAt)
+        batchBytes = sum(len(packet) for packet in batchPackets)
+        packetsSent += len(batchPackets)
+        bytesSent += batchBytes
+        packets.inc(len(batchPackets))
+        sentBytes.inc(batchBytes)
+    if resampler is not None:
+        # The grid times still waiting for the late devices
+        fanOut.publish(_encodeAligned(resampler, resampler.advance(final=True), encoder if binary else None))
+    if ownsFanOut:
+        fanOut.close()
+
+
+def _encodeAligned(resampler: Resampler, rows, encoder: BinaryEncoder or None) -> List[bytes]:
+    """
+    :param encoder: binary format, JSON when None
+    """
+    if len(rows) == 0:
+        return []
+    if encoder is not None:
+        return encoder.encodeRows(ALIGNED_DEVICE, rows.tolist())
+    return [json.dumps({ALIGNED_DEVICE: frame.toJson()}).encode() for frame in resampler.toFrames(rows)]
+
+
+def _frameValues(frame: DataFrame, channels: List[str]) -> list:
+    data = frame.data or {}
+    return [math.nan if data.get(channel) is None else data[channel] for channel in channels]
 
 
 def _errorBeforeLaunching() -> bool:
@@ -244,50 +458,189 @@ def _errorBeforeLaunching() -> bool:
     return False
 
 
-async def producerMinion(queue: multiprocessing.Queue, device: PhyphoxPhone):
-    await device.getCurrentData(frameRate)
-    queue.put((device.ip, device.dataBuffer[-1]))
-    await asyncio.sleep(frameRate * device.deltaTime)
+async def publishMetrics(fleet: PhyphoxFleet, metrics: multiprocessing.Queue, worker: int = 0) -> None:
+    """
+    Publish the snapshot of the pollers every METRICS_PERIOD, with the rates achieved since the previous one,
+    and the series of the metrics registry of the process.
+    :param worker: number of the producer process, in the snapshots
+    """
+    previous: Dict[str, dict] = dict()
+    previousAt = time.monotonic()
+    while True:
+        await asyncio.sleep(METRICS_PERIOD)
+        now = time.monotonic()
+        devices = fleet.snapshot()
+        for device in devices:
+            before = previous.get(device["ip"], {"samples": 0, "ticks": 0})
+            device["sampleRate"] = (device["samples"] - before["samples"]) / (now - previousAt)
+            device["requestRate"] = (device["ticks"] - before["ticks"]) / (now - previousAt)
+        previous = {device["ip"]: device for device in devices}
+        previousAt = now
+        # Only the series of this process: the ones it collects come from the main process
+        metrics.put({"worker": worker, "devices": devices, "series": defaultRegistry.collect(collectors=False)})
 
 
-async def experimentProducer(output: multiprocessing.Queue, iinput: multiprocessing.Queue) -> None:
-    await asyncio.gather(*(device.startExperiment() for device in phonesList))
-    while True:
-        await asyncio.gather(*(producerMinion(output, device) for device in phonesList))
-        if iinput.qsize() > 0:
-            if iinput.get():
-                break
-    await asyncio.gather(*(device.stopExperiment() for device in phonesList))
-    await asyncio.sleep(delayRequest)
-    await asyncio.gather(*(device.resetExperiment() for device in phonesList))
+def _meet(barrier: multiprocessing.Barrier) -> bool:
+    """
+    Wait for the other parties, at most BARRIER_TIMEOUT.
+    :return: False if some never came, then everyone goes on alone
+    """
+    try:
+        barrier.wait(BARRIER_TIMEOUT)
+        return True
+    except threading.BrokenBarrierError:
+        return False
+
+
+async def experimentProducer(output: SampleRing, iinput: multiprocessing.Queue, metrics: multiprocessing.Queue,
+                             shard: List[int], worker: int, startBarrier: multiprocessing.Barrier,
+                             workersBarrier: multiprocessing.Barrier, origin: multiprocessing.Value) -> None:
+    """
+    Poll the phones of a shard. The producer processes and the main process start together (startBarrier,
+    three times: connections warmed up, start instant set by the main process in `origin`, started), so every
+    phone is started at the same instant, which is t=0; the producers then stop and clear the phones together
+    (workersBarrier).
+    """
+    loop = asyncio.get_running_loop()
+    indexes = {device.ip: i for i, device in enumerate(phonesList)}
+    channels = {device.ip: device.dataChannels for device in phonesList}
+
+    def sink(ip: str, frames: list):
+        index = indexes[ip]
+        output.writeBatch((index, frame.t, _frameValues(frame, channels[ip]), 0 if frame.data else FLAG_EMPTY) for frame in frames)
+
+    def onGap(ip: str, start: float, end: float):
+        output.writeBatch([(indexes[ip], start, (end,), FLAG_GAP)])
+
+    def onStart(report: StartReport):
+        output.writeBatch([(indexes[report.ip], report.skew, (report.uncertainty,), FLAG_START)])
+
+    fleet = PhyphoxFleet([phonesList[index] for index in shard], frameRate, incrementalFetching, deviceIntervals,
+                         stopDelay=delayRequest, adaptive=adaptiveRate)
+    await fleet.warmUp()
+    await loop.run_in_executor(None, _meet, startBarrier)
+    await loop.run_in_executor(None, _meet, startBarrier)
+    await fleet.start(sink, onGap, origin=origin.value, onStart=onStart)
+    await loop.run_in_executor(None, _meet, startBarrier)
+    publisher = asyncio.create_task(publishMetrics(fleet, metrics, worker))
+    while not await loop.run_in_executor(None, iinput.get):
+        pass
+    publisher.cancel()
+    await loop.run_in_executor(None, _meet, workersBarrier)
+    await fleet.stop(reset=False)
+    # The last snapshot: the rate of the clocks, estimated along the run, is kept by the main process
+    metrics.put({"worker": worker, "devices": fleet.snapshot(), "series": defaultRegistry.collect(collectors=False)})
+    if fullExportPath is not None:
+        if worker == 0:
+            console.print("[italic] - Downloading the whole buffers of the phones...")
+        for device in await fleet.exportFull(f"{fullExportPath}.{worker}"):
+            console.print(f"[red1] The buffers of {device.ip} couldn't be downloaded, its live samples are kept")
+    # Nothing is cleared before every shard is stopped and exported
+    await loop.run_in_executor(None, _meet, workersBarrier)
+    await fleet.reset()
+    await fleet.close()
 
 
-def experimentProducerProcessLauncher(output: multiprocessing.Queue, iinput: multiprocessing.Queue) -> None:
+def experimentProducerProcessLauncher(output: SampleRing, iinput: multiprocessing.Queue, metrics: multiprocessing.Queue,
+                                      shard: List[int], worker: int, startBarrier: multiprocessing.Barrier,
+                                      workersBarrier: multiprocessing.Barrier, origin: multiprocessing.Value) -> None:
     """
-    This function must be launched in a different process.
+    This function must be launched in a different process, one per shard of the phones.
     It's used as a trampoline for the main function.
     :param iinput: Queue Main --> Process
-    :param output: Queue Process --> Main
+    :param output: Ring buffer Process --> Main, of this shard only
+    :param metrics: Queue Process --> Main of the metrics snapshots (see publishMetrics)
+    :param shard: indexes in phonesList of the phones of this process
+    :param origin: host time of t=0 for every shard, when the phones are started, set by the main process
     :return: None
     """
     signal.signal(signal.SIGINT, signal.SIG_IGN)
-    asyncio.run(experimentProducer(output, iinput))
+    # The series copied from the main process at fork time are stale: they would hide its live ones
+    defaultRegistry.clear()
+    # The snapshots not read yet must not keep the process alive
+    metrics.cancel_join_thread()
+    asyncio.run(experimentProducer(output, iinput, metrics, shard, worker, startBarrier, workersBarrier, origin))
+    output.close()
 
 
-def generateExperimentStatusTable(queue: multiprocessing.Queue, startedAt: int):
+def _deviceLoads() -> List[float]:
+    """
+    The load of each phone: measured by the previous experiment, estimated from its rate otherwise.
+    """
+    loads = list()
+    for device in phonesList:
+        if device.ip in measuredLoads:
+            loads.append(measuredLoads[device.ip])
+            continue
+        requestRate = 1 / deviceIntervals.get(device.ip, frameRate)
+        loads.append(deviceLoad(requestRate, DEFAULT_SAMPLE_RATE if incrementalFetching else requestRate,
+                                len(device.dataChannels)))
+    return loads
+
+
+def generateExperimentStatusTable(ring: SampleRing or MergedRings, startedAt: int, devicesMetrics: List[dict]):
     table = Table()
     table.add_row(f"Number of devices: {len(phonesList)}")
-    table.add_row(f"Packets sent: {packetsSent}")
-    table.add_row(f"In queue data: {queue.qsize()}")
-    table.add_row(f"Server Port: {SERVER_PORT}")
+    if isinstance(ring, MergedRings) and len(ring.rings) > 1:
+        table.add_row(f"Producer processes: {len(ring.rings)}")
+    table.add_row(f"Packets sent: {packetsSent} ({bytesSent / 1024:.0f} KB)")
+    table.add_row(f"In queue data: {len(ring)} (max {ring.highWater}, dropped {ring.dropped})")
+    if broadcastFanOut is None:
+        table.add_row(f"Server Port: {SERVER_PORT}")
+    else:
+        table.add_row(f"Subscribers: {len(broadcastFanOut.subscribers)} (dropped {broadcastFanOut.dropped():.0f} packets)")
     table.add_row()
-    table.add_row(f"Experiment started {(time.time_ns() - startedAt)/10**9}s ago")
+    table.add_row(f"Experiment started {(time.time_ns() - startedAt)/10**9:.1f}s ago")
     table.add_row("Press CTRL-C to stop the experiment")
-    return table
+    devicesTable = Table("Device", "State", "Start", "Requests/s", "Samples/s", "Latency p50", "Latency p99", "Failed",
+                         "Missed ticks", "Gaps")
+    for device in devicesMetrics:
+        devicesTable.add_row(device["ip"], device["state"] + (f" ({device['outages']} outages)" if device["outages"] else ""),
+                             "-" if device["startSkew"] is None else f"{device['startSkew'] * 1000:+.1f} ms",
+                             f"{device['requestRate']:.1f} / {1 / device['interval']:.1f}"
+                             f"{' (auto)' if device['adaptive'] else ''}",
+                             f"{device['sampleRate']:.0f}", f"{device['latencyP50'] * 1000:.0f} ms",
+                             f"{device['latencyP99'] * 1000:.0f} ms", str(device["failedRequests"]),
+                             str(device["missedTicks"]), str(device["gaps"]))
+    return Group(table, devicesTable)
+
+
+def _receiveMetrics(metricsQueue: multiprocessing.Queue, workersMetrics: Dict[int, dict], timeout: float) -> None:
+    """
+    Keep the latest snapshot of each producer process, waiting at most `timeout` for the first one.
+    """
+    try:
+        snapshot = metricsQueue.get(timeout=timeout) if timeout > 0 else metricsQueue.get_nowait()
+        workersMetrics[snapshot["worker"]] = snapshot
+        while not metricsQueue.empty():
+            snapshot = metricsQueue.get_nowait()
+            workersMetrics[snapshot["worker"]] = snapshot
+    except queue.Empty:
+        pass
+
+
+def _keepClockRates(devicesMetrics: List[dict]) -> None:
+    """
+    Bring back the rates of the clocks estimated by the producer processes along the run, and remember those
+    which are good enough (see registry.py): they spare the calibration of the next runs.
+    """
+    devices = {device.ip: device for device in phonesList}
+    for metrics in devicesMetrics:
+        device = devices.get(metrics["ip"])
+        if device is None or not metrics["clockHasRate"]:
+            continue
+        device.deltaTime = device.clock.rate = metrics["clockRate"]
+        device.clock.hasRate = True
+        device.clock.residual = metrics["clockResidual"]
+        device.clock.bestRoundTrip = metrics["bestRoundTrip"]
+        deviceRegistry.remember(device, calibrated=True)
+    saveRegistry()
 
 
 async def runExperiment() -> int:
-    global frameRate, delayRequest, requestTimeError, doRunExperiment
+    global frameRate, delayRequest, requestTimeError, doRunExperiment, doBroadcast, incrementalFetching, binaryBroadcasting, \
+        producerMetrics, adaptiveRate, resampleRate, resampleMethod, \
+        fullExportPath, producerWorkers, analyticsOptions
     console.print("-"*2, "RUN EXPERIMENT", "-"*2)
     if len(phonesList) == 0:
         console.print("[red] Please connect a least one device to launch the experiment mode !")
@@ -298,21 +651,30 @@ async def runExperiment() -> int:
     if not choice:
         return 0
     console.clear()
-    console.print("[italic] - Retrieving configurations from devices...")
-    await asyncio.gather(*(device.getRemoteConfig() for device in phonesList))
+    console.print("[italic] - Checking the known configurations of the devices...")
+    unconfigured, uncalibrated = await deviceRegistry.validate(phonesList)
+    if unconfigured:
+        console.print(f"[italic] - Retrieving configurations from {len(unconfigured)} device.s...")
+        await asyncio.gather(*(device.getRemoteConfig() for device in unconfigured))
     if _errorBeforeLaunching():
         return 0
-    console.print("[italic] - Running short test...")
-    await asyncio.gather(*(deltaTimeTest(device) for device in phonesList))
+    calibrated = [device for device in phonesList if device not in uncalibrated]
+    if calibrated:
+        console.print(f"[italic] - Reusing the recent clock calibration of {len(calibrated)} device.s...")
+        # The calibration clears the phones, these ones must be cleared anyway
+        await asyncio.gather(*(device.resetExperiment() for device in calibrated))
+    if uncalibrated:
+        console.print("[italic] - Running short test...")
+        await asyncio.gather(*(deltaTimeTest(device) for device in uncalibrated))
     if _errorBeforeLaunching():
         return 0
     console.print("[blue] -- Latency Results :")
     for device in phonesList:
-        console.print(" "*2, "--", device.ip, " : ", device.deltaTime)
+        console.print(" "*2, "--", device.ip, " : ", _latencyReport(device))
     choice = Confirm.ask("Do you want to do more tests regarding the latency ?", default=False)
     if choice:
         while True:
-            res = await latencyPhone5Test()
+            res, roundTrips = await latencyPhone5Test()
             if not res:
                 console.print("[red] Error: too many failures ! Increasing the delay threshold...")
                 delayRequest += 0.01
@@ -320,42 +682,137 @@ async def runExperiment() -> int:
                 continue
             console.print("[blue] -- Advance Latency Results :")
             for device in phonesList:
-                console.print(" " * 2, "--", device.ip, " : ", device.deltaTime)
+                results = roundTrips[device.ip]
+                console.print(" " * 2, "--", device.ip, " : ", "no successful test" if not results else
+                              f"best round trip {min(results) * 1000:.1f} ms, mean {sum(results) / len(results) * 1000:.1f} ms "
+                              f"over {len(results)} tests")
             break
+    for device in phonesList:
+        deviceRegistry.remember(device)
+    saveRegistry()
 
-    frameRate = 1 / IntPrompt.ask("How many data per second (frame rate) do you want ?", default=25)
-    mainQueue = multiprocessing.Queue()
+    incrementalFetching = Confirm.ask("Fetch every sample recorded by the devices (incremental mode) ?", default=True)
+    if incrementalFetching:
+        frameRate = 1 / IntPrompt.ask("How many requests per second do you want ?", default=5)
+    else:
+        frameRate = 1 / IntPrompt.ask("How many data per second (frame rate) do you want ?", default=25)
+    deviceIntervals.clear()
+    if len(phonesList) > 1 and Confirm.ask("Set a different rate for some devices ?", default=False):
+        for device in phonesList:
+            deviceIntervals[device.ip] = 1 / IntPrompt.ask(f"  Rate of {device.ip} ", default=round(1 / frameRate))
+    adaptiveRate = None
+    if Confirm.ask("Adapt the rate of each device to its latency (starting from the rates above) ?", default=False):
+        adaptiveRate = {"maxRate": IntPrompt.ask("  Maximum requests per second ", default=MAX_RATE),
+                        "targetLatency": IntPrompt.ask("  Latency (ms) above which a device is slowed down ",
+                                                       default=round(TARGET_LATENCY * 1000)) / 1000}
+    binaryBroadcasting = Confirm.ask("Broadcast with the compact binary format (instead of JSON) ?", default=False)
+    resampleRate = None
+    if Confirm.ask("Broadcast the devices aligned on a common time grid (resampled) ?", default=False):
+        resampleRate = IntPrompt.ask("  Grid times per second ", default=round(1 / frameRate))
+        resampleMethod = Prompt.ask("  Interpolation ", choices=list(METHODS), default=LINEAR)
+    analyticsOptions = None
+    if Confirm.ask("Also broadcast rolling statistics (mean, std, rms, min, max, amplitudes) of the channels ?", default=False):
+        frequencies = Prompt.ask("  Frequencies (Hz) whose amplitude is tracked, comma separated ", default="")
+        channels = Prompt.ask("  Channels to analyse, comma separated (leave empty for all) ", default="")
+        analyticsOptions = {"window": IntPrompt.ask("  Samples per window ", default=DEFAULT_WINDOW),
+                            "outputRate": IntPrompt.ask("  Statistics per second ", default=DEFAULT_OUTPUT_RATE),
+                            "frequencies": [float(frequency) for frequency in frequencies.split(",") if frequency.strip()],
+                            "channels": [channel.strip() for channel in channels.split(",") if channel.strip()] or None}
+    recordingPath = Prompt.ask("Record the experiment to (leave empty to only broadcast) ", default="")
+    recorder = RecordingSink(RecordingWriter(recordingPath)) if recordingPath else None
+    fullExportPath = None
+    if recorder is not None and Confirm.ask("  Complete it with the whole buffers of the phones, downloaded at the end ?",
+                                            default=False):
+        fullExportPath = f"{recordingPath}.full"
+    resampler = Resampler(resampleRate, resampleMethod) if resampleRate else None
+    analytics = AnalyticsStage(**analyticsOptions) if analyticsOptions is not None else None
+    if len(phonesList) > 1:
+        suggested = min(os.cpu_count() or 1, math.ceil(len(phonesList) / PHONES_PER_WORKER))
+        producerWorkers = max(1, IntPrompt.ask("How many processes should poll the phones ?", default=suggested))
+    shards = balanceShards(_deviceLoads(), producerWorkers)
+    rings = [SampleRing(RING_CAPACITY, max(len(phonesList[index].dataChannels) for index in shard)) for shard in shards]
+    mainRing = MergedRings(rings)
     commanderQueue = multiprocessing.Queue()
-    doRunExperiment = True
-    console.print("[italic] - Starting the experimentProducer process...")
-    background_process = multiprocessing.Process(target=experimentProducerProcessLauncher, args=(mainQueue, commanderQueue,), daemon=True)
-    background_process.start()
-    console.print("[italic] - Waiting for the process...")
-    mainQueue.get()
+    metricsQueue = multiprocessing.Queue()
+    startBarrier = multiprocessing.Barrier(len(shards) + 1)
+    workersBarrier = multiprocessing.Barrier(len(shards))
+    origin = multiprocessing.Value("d", 0.0)
+    # The producer processes open their own connections: the ones of this process must not be inherited
+    await asyncio.gather(*(device.close() for device in phonesList))
+    doRunExperiment = doBroadcast = True
+    console.print(f"[italic] - Starting {len(shards)} experimentProducer process{'es' if len(shards) > 1 else ''}...")
+    background_processes = [multiprocessing.Process(target=experimentProducerProcessLauncher,
+                                                    args=(ring, commanderQueue, metricsQueue, shard, worker, startBarrier,
+                                                          workersBarrier, origin), daemon=True)
+                            for worker, (ring, shard) in enumerate(zip(rings, shards))]
+    for background_process in background_processes:
+        background_process.start()
+    console.print("[italic] - Waiting for the processes...")
+    ready = _meet(startBarrier)
+    # Every process starts its phones at this instant
+    origin.value = time.time() + START_LEAD
+    if not ready or not _meet(startBarrier) or not _meet(startBarrier):
+        console.print("[red1] Some processes didn't start in time, going on without waiting for them")
     started_at = time.time_ns()
     console.print("[italic] - Starting the broadcasting server...")
-    server_thread = threading.Thread(target=dataServerLiveBroadcasting, args=(mainQueue, ), daemon=True)
+    server_thread = threading.Thread(target=dataServerLiveBroadcasting, args=(mainRing, binaryBroadcasting, recorder, broadcastFanOut,
+                                                                                 resampler, analytics), daemon=True)
     server_thread.start()
-    with Live(generateExperimentStatusTable(mainQueue, started_at), refresh_per_second=5) as live:
+    producerMetrics = {"devices": [], "series": []}
+    # Latest snapshot of each producer process
+    workersMetrics: Dict[int, dict] = dict()
+    with Live(generateExperimentStatusTable(mainRing, started_at, producerMetrics["devices"]), auto_refresh=False) as live:
         while doRunExperiment:
             try:
-                live.update(generateExperimentStatusTable(mainQueue, started_at))
+                # Sleeps until the next snapshot of a producer, refreshes at least every DASHBOARD_REFRESH
+                _receiveMetrics(metricsQueue, workersMetrics, DASHBOARD_REFRESH)
+                producerMetrics = {"devices": [device for worker in sorted(workersMetrics) for device in workersMetrics[worker]["devices"]],
+                                   "series": [series for snapshot in workersMetrics.values() for series in snapshot["series"]]}
+                live.update(generateExperimentStatusTable(mainRing, started_at, producerMetrics["devices"]), refresh=True)
 
             except KeyboardInterrupt:
                 console.print("[red] Interruption request detected !")
                 doRunExperiment = False
     console.print("[italic] Notifying background service...")
-    commanderQueue.put(True)
+    for _ in background_processes:
+        commanderQueue.put(True)
     console.print("[italic] Waiting for the server...")
+    console.print("[italic] Waiting for the background service to end...")
+    for background_process in background_processes:
+        # A process can't end before what it put in the queue is read
+        while background_process.is_alive():
+            _receiveMetrics(metricsQueue, workersMetrics, DASHBOARD_REFRESH)
+        background_process.join()
+    _receiveMetrics(metricsQueue, workersMetrics, 0)
+    producerMetrics = {"devices": [device for worker in sorted(workersMetrics) for device in workersMetrics[worker]["devices"]],
+                       "series": [series for snapshot in workersMetrics.values() for series in snapshot["series"]]}
+    _keepClockRates(producerMetrics["devices"])
+    doBroadcast = False
+    # Balances the shards of the next experiment
+    elapsed = (time.time_ns() - started_at) / 10**9
+    channels = {device.ip: len(device.dataChannels) for device in phonesList}
+    for device in producerMetrics["devices"]:
+        measuredLoads[device["ip"]] = deviceLoad(device["ticks"] / elapsed, device["samples"] / elapsed, channels[device["ip"]])
     with Progress() as progress:
-        maxSize = mainQueue.qsize()
+        maxSize = len(mainRing)
         task = progress.add_task("[green] Dispatch remaining data...", total=maxSize)
-        while mainQueue.qsize() > 0:
-            delta = maxSize - mainQueue.qsize()
-            maxSize = mainQueue.qsize()
+        while len(mainRing) > 0:
+            delta = maxSize - len(mainRing)
+            maxSize = len(mainRing)
             progress.update(task, advance=delta)
-    console.print("[italic] Waiting for the background service to end...")
-    background_process.join()
+            time.sleep(BROADCAST_IDLE_DELAY)
+    server_thread.join()
+    mainRing.close()
+    mainRing.unlink()
+    if recorder is not None:
+        console.print("[italic] Finishing the recording...")
+        recorder.close()
+    if fullExportPath is not None:
+        console.print("[italic] Completing the recording with the buffers of the phones...")
+        for worker in range(len(shards)):
+            if os.path.exists(f"{fullExportPath}.{worker}"):
+                completeRecording(recordingPath, f"{fullExportPath}.{worker}",
+                                  {device.ip: list(device.timeChannels) for device in phonesList})
     console.print("[bold] All done !")
     input("Continue... ")
     return 0
@@ -375,13 +832,14 @@ async def main():
         return
     LOCAL_NETWORK_IP = MY_IP[:MY_IP.index(".", 3 * 2 + 2)] + "."
     console.print("[blue]COMPUTER IP:[white]", MY_IP)
+    await restorePairedPhones()
     while doRun:
         if MENU_POINTER == 0:
             MENU_POINTER = mainMenu()
         elif MENU_POINTER == 11:
-            MENU_POINTER = addPhone()
+            MENU_POINTER = await addPhone()
         elif MENU_POINTER == 12:
-            MENU_POINTER = pairedPhones()
+            MENU_POINTER = await pairedPhones()
         elif MENU_POINTER == 13:
             MENU_POINTER = await runExperiment()
         doRun = MENU_POINTER != -1
@@ -390,8 +848,334 @@ async def main():
         await checkPhonesConnectivity()
 
     console.print("[italic]Cleaning up...")
+    await asyncio.gather(*(device.close() for device in phonesList))
     console.print("[bold]Done.")
 
 
+def parseArguments(arguments: List[str] or None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Gather the data of phyphox phones. Without --devices nor --network, "
+                                                 "the interactive console is launched.")
+    parser.add_argument("--devices", help="comma separated list of devices (ip or ip:port) to record")
+    parser.add_argument("--network", help="network (CIDR) to scan for devices, e.g. 192.168.1.0/24")
+    parser.add_argument("--ports", default=str(PORT), help="comma separated ports of the devices (default: %(default)s)")
+    parser.add_argument("--rate", type=float, default=5, help="requests per second per device (default: %(default)s)")
+    parser.add_argument("--polled", action="store_true", help="only fetch the latest values at each request "
+                                                              "instead of every sample recorded")
+    parser.add_argument("--adaptive", action="store_true", help="adapt the rate of each device to its latency, "
+                                                                "starting from --rate")
+    parser.add_argument("--max-rate", type=float, default=MAX_RATE, help="highest adaptive rate (default: %(default)s)")
+    parser.add_argument("--target-latency", type=float, default=TARGET_LATENCY,
+                        help="latency (s) above which the adaptive rate of a device goes down (default: %(default)s)")
+    parser.add_argument("--duration", type=float, help="seconds of recording (default: until CTRL-C)")
+    parser.add_argument("--output", help="JSON lines file to write the frames to (default: standard output)")
+    parser.add_argument("--record", help="compressed recording file to write the samples to (see recording.py), "
+                                         "instead of the JSON lines")
+    parser.add_argument("--analytics", type=int, metavar="WINDOW", help="also write and broadcast rolling statistics "
+                                                                         "of the channels over WINDOW samples, as the "
+                                                                         "device '<ip>#stats' (see analytics.py)")
+    parser.add_argument("--analytics-rate", type=float, default=DEFAULT_OUTPUT_RATE,
+                        help="statistics per second per device (default: %(default)s)")
+    parser.add_argument("--analytics-frequencies", default="", metavar="F1,F2", help="frequencies (Hz) whose amplitude "
+                                                                                      "is tracked, from sample rate / window "
+                                                                                      "to half the sample rate")
+    parser.add_argument("--analytics-channels", metavar="C1,C2", help="channels to analyse (default: all)")
+    parser.add_argument("--replay", metavar="PATH", help="broadcast a recorded session (recording or JSON lines) "
+                                                         "instead of acquiring, see replay.py")
+    parser.add_argument("--speed", type=float, default=1, help=f"replay speed, {MAX_SPEED} for as fast as possible "
+                                                               "(default: %(default)s)")
+    parser.add_argument("--binary", action="store_true", help="replay with the compact binary format (instead of JSON)")
+    parser.add_argument("--resample", type=float, metavar="RATE", help="write and broadcast the devices aligned on a "
+                                                                       "common time grid of RATE times per second, as "
+                                                                       f"the single device {ALIGNED_DEVICE!r}")
+    parser.add_argument("--resample-method", choices=METHODS, default=LINEAR,
+                        help="interpolation of the aligned devices (default: %(default)s)")
+    parser.add_argument("--download", action="store_true", help="after the run, complete the recording (--record) with "
+                                                                    "the whole buffers of the phones, before clearing them")
+    parser.add_argument("--no-sync", dest="sync", action="store_false", help="skip the clock calibration")
+    parser.add_argument("--registry", metavar="PATH", help="reuse the configurations and the recent clock calibrations "
+                                                           "of the devices saved in PATH, and save them there (see "
+                                                           "registry.py)")
+    parser.add_argument("--metrics-port", type=int, help="serve the metrics in the Prometheus text format on "
+                                                         "http://127.0.0.1:<port>/metrics")
+    parser.add_argument("--metrics-dump", help="JSON file to write the metrics to periodically")
+    parser.add_argument("--subscribe", action="append", default=[], metavar="HOST:PORT",
+                        help=f"also send the broadcast to this UDP address (repeatable; the console always sends to "
+                             f"127.0.0.1:{SERVER_PORT})")
+    parser.add_argument("--multicast", metavar="GROUP:PORT", help="also send the broadcast to a multicast group")
+    parser.add_argument("--multicast-ttl", type=int, default=MULTICAST_TTL, help="routers the multicast datagrams can "
+                                                                                 "cross (default: %(default)s)")
+    parser.add_argument("--stream", action="append", default=[], metavar="HOST:PORT|PATH",
+                        help="accept TCP (HOST:PORT) or Unix socket (PATH) clients of the broadcast, each packet is "
+                             "preceded by its length (u32, big-endian) (repeatable)")
+    parser.add_argument("--stream-queue", type=int, default=DEFAULT_QUEUE_SIZE,
+                        help="packets waiting for a stream client at most (default: %(default)s)")
+    parser.add_argument("--drop-policy", choices=DROP_POLICIES, default=DROP_OLDEST,
+                        help="what happens to the packets of a stream client whose queue is full (default: %(default)s)")
+    args = parser.parse_args(arguments)
+    if args.download and not args.record:
+        parser.error("--download completes the recording, it needs --record")
+    return args
+
+
+def _parseAddress(address: str) -> Tuple[str, int]:
+    host, _, port = address.rpartition(":")
+    return host or "127.0.0.1", int(port)
+
+
+def buildFanOut(args: argparse.Namespace, local: bool) -> FanOut or None:
+    """
+    :param local: include 127.0.0.1:SERVER_PORT, like the console always did
+    :return: the subscribers given on the command line, None if there is none
+    """
+    if not (local or args.subscribe or args.multicast or args.stream):
+        return None
+    fanOut = FanOut()
+    if local:
+        fanOut.addUdp("127.0.0.1", SERVER_PORT)
+    for address in args.subscribe:
+        fanOut.addUdp(*_parseAddress(address))
+    if args.multicast:
+        fanOut.addMulticast(*_parseAddress(args.multicast), ttl=args.multicast_ttl)
+    for address in args.stream:
+        fanOut.serve(_parseAddress(address) if ":" in address else address, args.stream_queue, args.drop_policy)
+    return fanOut
+
+
+def startMetricsExporters(args: argparse.Namespace) -> List[MetricsExporter]:
+    exporters = list()
+    if args.metrics_port is not None:
+        exporters.append(PrometheusExporter(defaultRegistry, args.metrics_port))
+    if args.metrics_dump:
+        exporters.append(JsonDumpExporter(defaultRegistry, args.metrics_dump))
+    for exporter in exporters:
+        exporter.start()
+    return exporters
+
+
+def _parseDevices(devices: str, defaultPort: int) -> List[Tuple[str, int]]:
+    result = list()
+    for device in filter(None, (device.strip() for device in devices.split(","))):
+        ip, _, port = device.partition(":")
+        result.append((ip, int(port) if port else defaultPort))
+    return result
+
+
+async def headless(args: argparse.Namespace) -> int:
+    """
+    Non-interactive acquisition: every frame is written as a JSON line {ip: {"time": ..., "data": ...}},
+    and also broadcast as a JSON datagram to the subscribers given on the command line.
+    With --resample, the frames written and broadcast are the aligned ones (see resample.py).
+    :return: the exit code
+    """
+    log = Console(stderr=True)
+    ports = [int(port) for port in args.ports.split(",")]
+    devices = _parseDevices(args.devices, ports[0]) if args.devices else []
+    adaptive = {"maxRate": args.max_rate, "targetLatency": args.target_latency} if args.adaptive else None
+    fleet = PhyphoxFleet(devices, 1 / args.rate, not args.polled, bufferCapacity=BUFFER_CAPACITY, adaptive=adaptive)
+    async with fleet:
+        if args.network:
+            log.print("[italic] - Scanning", args.network)
+            for device in await fleet.discover(args.network, ports):
+                log.print(f"[deep_sky_blue1] Found {device.ip}:{device.port}")
+        if len(fleet.devices) == 0:
+            log.print("[red] No device to record !")
+            return 1
+        registry = DeviceRegistry(args.registry) if args.registry else None
+        unconfigured, uncalibrated = fleet.devices, fleet.devices
+        if registry is not None:
+            registry.load()
+            unconfigured, uncalibrated = await registry.validate(fleet.devices)
+        failed = await fleet.connect(unconfigured)
+        if not failed and args.sync:
+            if uncalibrated:
+                log.print("[italic] - Calibrating the clocks...")
+                failed = await fleet.sync(devices=uncalibrated)
+            if len(uncalibrated) < len(fleet.devices):
+                # The calibration clears the phones, the others must be cleared anyway
+                await fleet.reset()
+        if registry is not None and not failed:
+            for device in fleet.devices:
+                registry.remember(device)
+            registry.save()
+        if failed:
+            log.print("[red1] There is a problem with the devices", ", ".join(device.ip for device in failed))
+            return 1
+
+        loop = asyncio.get_running_loop()
+        stopping = asyncio.Event()
+        for stopSignal in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(stopSignal, stopping.set)
+        output = open(args.output, "w") if args.output else sys.stdout
+        recorder = RecordingSink(RecordingWriter(args.record)) if args.record else None
+        if recorder is not None:
+            for device in fleet.devices:
+                recorder.addDevice(device.ip, device.dataChannels)
+        resampler = Resampler(args.resample, args.resample_method) if args.resample else None
+        if resampler is not None:
+            for device in fleet.devices:
+                resampler.addDevice(device.ip, device.dataChannels)
+        analytics = _analyticsStage(args)
+        if analytics is not None:
+            for device in fleet.devices:
+                derivedChannels = analytics.addDevice(device.ip, device.dataChannels, exclude=device.timeChannels)
+                if recorder is not None:
+                    recorder.addDevice(derivedDevice(device.ip), derivedChannels)
+
+        def writeFrames(ip: str, frames: List[DataFrame]):
+            if broadcastFanOut is not None:
+                broadcastFanOut.publish([json.dumps({ip: frame.toJson()}).encode() for frame in frames])
+            if recorder is None or resampler is not None:
+                for frame in frames:
+                    output.write(json.dumps({ip: frame.toJson()}))
+                    output.write("\n")
+
+        def onGap(ip: str, start: float, end: float):
+            log.print(f"[yellow] {ip}: samples lost between {start:.3f} and {end:.3f} s")
+            if resampler is not None:
+                resampler.gap(ip, start, end)
+                return
+            line = json.dumps({ip: {"gap": [start, end]}})
+            if broadcastFanOut is not None:
+                broadcastFanOut.publish([line.encode()])
+            if recorder is None:
+                output.write(line)
+                output.write("\n")
+
+        def onStart(report: StartReport):
+            line = json.dumps({report.ip: {"start": [report.skew, report.uncertainty]}})
+            if broadcastFanOut is not None:
+                broadcastFanOut.publish([line.encode()])
+            if recorder is None and resampler is None:
+                output.write(line)
+                output.write("\n")
+
+        try:
+            await fleet.start(onGap=onGap, onStart=onStart)
+            log.print(f"[cyan] Recording {len(fleet.devices)} devices...")
+
+            async def stopper():
+                try:
+                    await asyncio.wait_for(stopping.wait(), args.duration)
+                except asyncio.TimeoutError:
+                    pass
+                await fleet.stop(reset=not args.download)
+
+            stopTask = asyncio.create_task(stopper())
+            async for ip, frames in fleet.stream():
+                if recorder is not None or resampler is not None or analytics is not None:
+                    channels = fleet.channels(ip)
+                    rows = [(frame.t, *_frameValues(frame, channels)) for frame in frames]
+                    if analytics is not None:
+                        derived = analytics.submit(ip, rows)
+                        if recorder is not None and derived:
+                            recorder.submit(derivedDevice(ip), derived)
+                        writeFrames(derivedDevice(ip), analytics.toFrames(ip, derived))
+                    if recorder is not None:
+                        recorder.submit(ip, rows)
+                    if resampler is not None:
+                        resampler.submit(ip, rows)
+                        writeFrames(ALIGNED_DEVICE, resampler.toFrames(resampler.advance()))
+                        continue
+                writeFrames(ip, frames)
+            if resampler is not None:
+                writeFrames(ALIGNED_DEVICE, resampler.toFrames(resampler.advance(final=True)))
+            await stopTask
+            if args.download:
+                log.print("[italic] - Downloading the whole buffers of the phones...")
+                for device in await fleet.exportFull(f"{args.record}.full"):
+                    log.print(f"[red1] The buffers of {device.ip} couldn't be downloaded, its live samples are kept")
+                await fleet.reset()
+            for device in fleet.snapshot():
+                log.print(f" {device['ip']}: {device['samples']} samples, {device['ticks']} requests "
+                          f"({device['failedRequests']} failed, {device['outages']} outages, {device['gaps']} gaps), p50 {device['latencyP50'] * 1000:.0f} ms, "
+                          f"p99 {device['latencyP99'] * 1000:.0f} ms, "
+                          f"{'adaptive rate' if device['adaptive'] else 'rate'} {1 / device['interval']:.1f}/s, "
+                          + ("didn't start" if device["startSkew"] is None else f"started {device['startSkew'] * 1000:+.1f} ms"))
+            if registry is not None:
+                # The rate of the clocks is only known after tens of seconds of polls, see registry.py
+                for device in fleet.devices:
+                    registry.remember(device, calibrated=True)
+                registry.save()
+        finally:
+            if recorder is not None:
+                recorder.close()
+                if args.download and os.path.exists(f"{args.record}.full"):
+                    log.print("[italic] - Completing the recording with the buffers of the phones...")
+                    completeRecording(args.record, f"{args.record}.full",
+                                      {device.ip: list(device.timeChannels) for device in fleet.devices})
+            if output is not sys.stdout:
+                output.close()
+            for stopSignal in (signal.SIGINT, signal.SIGTERM):
+                loop.remove_signal_handler(stopSignal)
+    log.print("[bold] All done !")
+    return 0
+
+
+def _analyticsStage(args: argparse.Namespace) -> AnalyticsStage or None:
+    if not args.analytics:
+        return None
+    return AnalyticsStage(args.analytics, args.analytics_rate,
+                          [float(frequency) for frequency in args.analytics_frequencies.split(",") if frequency.strip()],
+                          args.analytics_channels.split(",") if args.analytics_channels else None)
+
+
+def replay(args: argparse.Namespace) -> int:
+    """
+    Broadcast a recorded session, like dataServerLiveBroadcasting does during an experiment.
+    :return: the exit code
+    """
+    global doBroadcast
+    log = Console(stderr=True)
+    session = loadSession(args.replay)
+    if len(session) == 0:
+        log.print("[red] Nothing to replay !")
+        return 1
+    phonesList.clear()
+    for ip, channels in session.devices.items():
+        device = PhyphoxPhone(ip, PORT)
+        device.dataChannels = channels
+        phonesList.append(device)
+    speed = "as fast as possible" if args.speed == MAX_SPEED else f"at {args.speed:g}x"
+    log.print(f"[cyan] Replaying {len(session)} records of {len(session.devices)} devices "
+              f"({session.duration:.1f} s) {speed}...")
+    ring = SampleRing(RING_CAPACITY, session.values.shape[1])
+    resampler = Resampler(args.resample, args.resample_method) if args.resample else None
+    doBroadcast = True
+    broadcaster = threading.Thread(target=dataServerLiveBroadcasting, args=(ring, args.binary, None, broadcastFanOut, resampler,
+                                                                                  _analyticsStage(args)))
+    broadcaster.start()
+    stop = threading.Event()
+    signal.signal(signal.SIGINT, lambda *_: stop.set())
+    startedAt = time.monotonic()
+    try:
+        stats = replaySession(session, ring, args.speed, stop)
+    finally:
+        doBroadcast = False
+        broadcaster.join()
+        ring.close()
+        ring.unlink()
+    # Until everything was sent, not only written to the ring
+    elapsed = time.monotonic() - startedAt
+    log.print(f" {stats.records} records broadcast in {elapsed:.2f} s ({stats.records / max(elapsed, 1e-9):.0f}/s), "
+              f"{packetsSent} packets ({bytesSent / 1024:.0f} KB), {stats.fullRing} waits for room in the ring"
+              + (f", late by {stats.maxLag * 1000:.1f} ms at most" if args.speed != MAX_SPEED else ""))
+    log.print("[bold] All done !")
+    return 0
+
+
 if __name__ == "__main__":
-    asyncio.run(main())
+    arguments = parseArguments()
+    isHeadless = bool(arguments.devices or arguments.network)
+    metricsExporters = startMetricsExporters(arguments)
+    broadcastFanOut = buildFanOut(arguments, local=not isHeadless)
+    try:
+        if arguments.replay:
+            sys.exit(replay(arguments))
+        if isHeadless:
+            sys.exit(asyncio.run(headless(arguments)))
+        asyncio.run(main())
+    finally:
+        if broadcastFanOut is not None:
+            broadcastFanOut.close()
+        for metricsExporter in metricsExporters:
+            metricsExporter.close()
@@ -0,0 +1,248 @@
+"""
+Counters and histograms of the hot paths (device requests, broadcasting), and their exporters:
+
+    exporter = PrometheusExporter(defaultRegistry, 9100)    # http://127.0.0.1:9100/metrics
+    exporter.start()
+    ...
+    exporter.close()
+
+The series are identified by their name and labels: `defaultRegistry.counter("name", device=ip).inc()`.
+"""
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Sequence, Tuple
+import json
+import math
+import os
+import threading
+
+# Upper bounds (s) of the buckets of the durations histograms
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+DEFAULT_DUMP_PERIOD = 5
+
+
+class Counter:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        # One more bucket for the values above the last bound
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class MetricsRegistry:
+    def __init__(self):
+        # (name, labels) -> metric
+        self._metrics: Dict[Tuple[str, tuple], Counter or Histogram] = dict()
+        # name -> (type, help)
+        self._descriptions: Dict[str, Tuple[str, str]] = dict()
+        self._collectors: List[Callable[[], List[dict]]] = list()
+        self._lock = threading.Lock()
+
+    def _metric(self, kind: str, factory, name: str, description: str, labels: dict):
+        key = (name, tuple(sorted(labels.items())))
+        metric = self._metrics.get(key)
+        if metric is None:
+            with self._lock:
+                metric = self._metrics.get(key)
+                if metric is None:
+                    self._descriptions.setdefault(name, (kind, description))
+                    metric = self._metrics[key] = factory()
+        return metric
+
+    def counter(self, name: str, description: str = "", **labels) -> Counter:
+        return self._metric("counter", Counter, name, description, labels)
+
+    def histogram(self, name: str, description: str = "", buckets: Sequence[float] = DEFAULT_BUCKETS, **labels) -> Histogram:
+        return self._metric("histogram", lambda: Histogram(buckets), name, description, labels)
+
+    def addCollector(self, collector: Callable[[], List[dict]]) -> None:
+        """
+        :param collector: returns series in the format of `collect`, e.g. the ones of another process.
+        They take precedence over the series of the registry with the same name and labels.
+        """
+        self._collectors.append(collector)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._metrics.clear()
+
+    def collect(self, collectors: bool = True) -> List[dict]:
+        """
+        :param collectors: include the series of the collectors
+        :return: every series as a plain (picklable) dict: name, type, help, labels and either the value of
+        a counter or the bucket bounds, cumulative counts, sum and count of a histogram
+        """
+        series = dict()
+        with self._lock:
+            items = list(self._metrics.items())
+        for (name, labels), metric in items:
+            kind, description = self._descriptions[name]
+            entry = {"name": name, "type": kind, "help": description, "labels": dict(labels)}
+            if isinstance(metric, Counter):
+                entry["value"] = metric.value
+            else:
+                cumulative, total = list(), 0
+                for count in metric.counts:
+                    total += count
+                    cumulative.append(total)
+                entry.update({"buckets": list(metric.buckets), "counts": cumulative, "sum": metric.sum, "count": metric.count})
+            series[(name, labels)] = entry
+        for collector in self._collectors if collectors else ():
+            for entry in collector():
+                series[(entry["name"], tuple(sorted(entry["labels"].items())))] = entry
+        return sorted(series.values(), key=lambda entry: (entry["name"], sorted(entry["labels"].items())))
+
+    def toJson(self) -> str:
+        return json.dumps(self.collect())
+
+    def toPrometheus(self) -> str:
+        """
+        The series in the Prometheus text exposition format.
+        """
+        lines = list()
+        lastName = None
+        for entry in self.collect():
+            name = entry["name"]
+            if name != lastName:
+                lines.append(f"# HELP {name} {entry['help']}")
+                lines.append(f"# TYPE {name} {entry['type']}")
+                lastName = name
+            if entry["type"] == "counter":
+                lines.append(f"{name}{_labels(entry['labels'])} {entry['value']!r}")
+                continue
+            for bound, count in zip(entry["buckets"] + [math.inf], entry["counts"]):
+                le = "+Inf" if bound == math.inf else repr(float(bound))
+                lines.append(f"{name}_bucket{_labels(entry['labels'], le=le)} {count}")
+            lines.append(f"{name}_sum{_labels(entry['labels'])} {entry['sum']!r}")
+            lines.append(f"{name}_count{_labels(entry['labels'])} {entry['count']}")
+        return "\n".join(lines) + "\n"
+
+
+def _labels(labels: dict, **extra) -> str:
+    labels = {**labels, **extra}
+    if len(labels) == 0:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") for value in labels.values())
+    return "{" + ",".join(f'{key}="{value}"' for key, value in zip(labels, escaped)) + "}"
+
+
+defaultRegistry = MetricsRegistry()
+
+
+class MetricsExporter(ABC):
+    """
+    Publishes a registry somewhere until closed.
+    """
+
+    def __init__(self, registry: MetricsRegistry = defaultRegistry):
+        self.registry = registry
+
+    @abstractmethod
+    def start(self) -> None:
+        pass
+
+    @abstractmethod
+    def close(self) -> None:
+        pass
+
+
+class PrometheusExporter(MetricsExporter):
+    """
+    Serves the registry in the Prometheus text format on http://host:port/metrics, from its own thread.
+    """
+
+    def __init__(self, registry: MetricsRegistry = defaultRegistry, port: int = 9100, host: str = "127.0.0.1"):
+        super().__init__(registry)
+        self.host = host
+        self.port = port
+        self._server: ThreadingHTTPServer or None = None
+        self._thread: threading.Thread or None = None
+
+    def start(self) -> None:
+        registry = self.registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = registry.toPrometheus().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self._server.daemon_threads = True
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def close(self) -> None:
+        if self._server is None:
+            return
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+        self._server = None
+
+
+class JsonDumpExporter(MetricsExporter):
+    """
+    Writes the registry (see MetricsRegistry.collect) as JSON to a file every `period` seconds, and once more
+    when closed. The file is replaced atomically, so readers never see a partial dump.
+    """
+
+    def __init__(self, registry: MetricsRegistry = defaultRegistry, path: str = "metrics.json",
+                 period: float = DEFAULT_DUMP_PERIOD):
+        super().__init__(registry)
+        self.path = path
+        self.period = period
+        self._stop = threading.Event()
+        self._thread: threading.Thread or None = None
+
+    def dump(self) -> None:
+        temporary = self.path + ".tmp"
+        with open(temporary, "w") as file:
+            file.write(self.registry.toJson())
+        os.replace(temporary, self.path)
+
+    def _backgroundThread(self):
+        while not self._stop.wait(self.period):
+            self.dump()
+
+    def start(self) -> None:
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._backgroundThread, daemon=True)
+        self._thread.start()
+
+    def close(self) -> None:
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        self.dump()
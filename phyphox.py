@@ -1,136 +1,424 @@
 import aiohttp
-from dataclasses import dataclass
-from typing import List
+import asyncio
+from clocksync import ClockSync
+from connection import ConnectionState
+from contextlib import asynccontextmanager
+from metrics import defaultRegistry
+from samplestore import DataFrame, SampleStore
+from typing import List, Dict
+import os
 import time
 
-
-@dataclass
-class DataFrame:
-    t: float
-    data: object
-
-    def toJson(self):
-        return {"time": self.t, "data": self.data}
+# Sessions inherited from a parent process, see PhyphoxPhone._dropSession
+_inheritedSessions: List[aiohttp.ClientSession] = list()
 
 
 # TODO: create a parent class Phyphox from which we implement different devices
 class PhyphoxPhone:
-    CONNECTION_ERROR = (ConnectionError, aiohttp.ClientConnectionError, aiohttp.ClientConnectorError)
+    CONNECTION_ERROR = (ConnectionError, aiohttp.ClientConnectionError, aiohttp.ClientConnectorError, asyncio.TimeoutError)
+    # A truncated or malformed answer: the request failed just like when the phone doesn't answer
+    REQUEST_ERROR = CONNECTION_ERROR + (aiohttp.ClientPayloadError, aiohttp.ContentTypeError, ValueError, KeyError,
+                                        TypeError, IndexError, AttributeError)
+    CONNECTION_LIMIT = 4
+    KEEPALIVE_TIMEOUT = 30
+    REQUEST_TIMEOUT = 2
+    DOWNLOAD_CHUNK = 2**16
 
-    def __init__(self, phoneIP: str, phonePort: int):
+    def __init__(self, phoneIP: str, phonePort: int, session: aiohttp.ClientSession or None = None,
+                 connectionLimit: int = CONNECTION_LIMIT, requestTimeout: float = REQUEST_TIMEOUT,
+                 bufferCapacity: int or None = None):
         self.ip = phoneIP
         self.port = phonePort
         self.baseAddress = f"http://{self.ip}:{self.port}"
         self.isAlive = True
         self.config = {}
-        self.dataBuffer: List[DataFrame] = list()
+        self.dataBuffer = SampleStore(capacity=bufferCapacity)
         self.dataChannels: List[str] = list()
         self.allChannelsReq: str = ""
+        # time channel -> data channels sampled along it, and the last time value received for it
+        self.timeChannels: Dict[str, List[str]] = dict()
+        self.channelCursors: Dict[str, float] = dict()
         self.startAt = 0
         self.endAt = 0
         self.deltaTime = 1
+        # Experiment time -> host time, and the host time (s) used as t=0 by every device of an experiment
+        self.clock = ClockSync()
+        self.timeOrigin = 0.0
+        # Fed by every request, see connection.py. `session` is the id of the phone's data, it changes when cleared
+        self.connection = ConnectionState()
+        self.session: str or None = None
+        self.connectionLimit = connectionLimit
+        self.requestTimeout = requestTimeout
 
         self._didLastRequestFailed = False
+        self._didLoseSamples = False
         self._internalClock = 0
+        self._session = session
+        self._ownsSession = session is None
+        self._sessionLoop = None
+        self._sessionPid = os.getpid()
+
+    @staticmethod
+    def createSession(connectionLimit: int = CONNECTION_LIMIT, keepAlive: float = KEEPALIVE_TIMEOUT) -> aiohttp.ClientSession:
+        """
+        Build a keep-alive session. It can be shared by several phones by passing it to their constructor.
+        """
+        connector = aiohttp.TCPConnector(limit=0, limit_per_host=connectionLimit, keepalive_timeout=keepAlive)
+        return aiohttp.ClientSession(connector=connector)
+
+    def _getSession(self) -> aiohttp.ClientSession:
+        # A session is bound to the event loop it was created in: the producer process runs its own loop,
+        # so we silently open a new one there instead of reusing the (forked) parent's session.
+        loop = asyncio.get_running_loop()
+        if self._ownsSession and self._session is not None and self._sessionLoop is not loop:
+            self._dropSession()
+        if self._ownsSession and (self._session is None or self._session.closed):
+            self._session = PhyphoxPhone.createSession(self.connectionLimit)
+            self._sessionLoop = loop
+            self._sessionPid = os.getpid()
+        return self._session
+
+    def _dropSession(self) -> None:
+        """
+        Let go of a session of another event loop. In a process forked after it was opened, its keep-alive
+        connections still belong to the parent: closing them would unregister their sockets from the epoll
+        instance shared with the parent, and so would its garbage collection. It is kept aside for good.
+        Otherwise it is closed like any other.
+        """
+        if self._sessionPid != os.getpid():
+            _inheritedSessions.append(self._session)
+        elif not self._session.closed:
+            asyncio.get_running_loop().create_task(self._session.close())
+        self._session = None
+
+    @asynccontextmanager
+    async def _get(self, path: str, timeout: aiohttp.ClientTimeout or None = None):
+        # Every request is measured, body included, per endpoint and status ("error" without an answer).
+        # It succeeded if the block using the answer went through, a body cut short or unreadable is a failure
+        endpoint = path.split("?")[0]
+        status = "error"
+        failed = False
+        startedAt = time.perf_counter()
+        if timeout is None:
+            timeout = aiohttp.ClientTimeout(total=self.requestTimeout)
+        try:
+            async with self._getSession().get(f"{self.baseAddress}{path}", timeout=timeout) as response:
+                status = str(response.status)
+                yield response
+        except BaseException:
+            failed = True
+            raise
+        finally:
+            if failed or status == "error" or status.startswith("5"):
+                self.connection.recordFailure()
+            else:
+                self.connection.recordSuccess()
+            defaultRegistry.histogram("phyphox_request_seconds", "Duration of the requests to the devices",
+                                      device=self.ip, endpoint=endpoint).observe(time.perf_counter() - startedAt)
+            defaultRegistry.counter("phyphox_requests_total", "Requests to the devices",
+                                    device=self.ip, endpoint=endpoint, status=status).inc()
+
+    async def close(self) -> None:
+        if not self._ownsSession or self._session is None:
+            return
+        if self._sessionPid != os.getpid():
+            self._dropSession()
+            return
+        if not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    async def __aenter__(self):
+        self._getSession()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
 
     def didLastRequestFailed(self) -> bool:
         tmp = self._didLastRequestFailed
         self._didLastRequestFailed = False
         return tmp
 
+    def didLoseSamples(self) -> bool:
+        """
+        Whether samples couldn't be fetched since the last call: the data of the phone was cleared
+        (new session) before everything was received.
+        """
+        tmp = self._didLoseSamples
+        self._didLoseSamples = False
+        return tmp
+
     async def ping(self) -> None:
-        async with aiohttp.ClientSession() as client:
-            try:
-                response = await client.get(self.baseAddress)
+        try:
+            async with self._get("/") as response:
                 self.isAlive = response.ok
-                response.close()
-            except PhyphoxPhone.CONNECTION_ERROR:
-                self.isAlive = False
+        except PhyphoxPhone.CONNECTION_ERROR:
+            self.isAlive = False
 
     async def getRemoteConfig(self) -> None:
-        async with aiohttp.ClientSession() as client:
-            try:
-                async with client.get(f"{self.baseAddress}/config") as response:
-                    if response.status != 200:
-                        self._didLastRequestFailed = True
-                        return
-                    self.config = await response.json()
-                    self.dataChannels.clear()
-                    for inp in self.config["inputs"]:
-                        for channel in inp["outputs"]:
-                            self.dataChannels.extend(channel.values())
-                    self.allChannelsReq = "&".join(self.dataChannels)
-            except PhyphoxPhone.CONNECTION_ERROR:
-                self._didLastRequestFailed = True
+        try:
+            async with self._get("/config") as response:
+                if response.status != 200:
+                    self._didLastRequestFailed = True
+                    return
+                self.applyConfig(await response.json())
+        except PhyphoxPhone.REQUEST_ERROR:
+            self._didLastRequestFailed = True
+
+    def applyConfig(self, config: dict) -> None:
+        """
+        Use the answer of `/config`, fetched now or earlier (see registry.py): its channels and time channels.
+        """
+        self.config = config
+        self.dataChannels.clear()
+        self.timeChannels.clear()
+        self.channelCursors.clear()
+        for inp in self.config["inputs"]:
+            timeChannel = None
+            inputChannels = list()
+            for channel in inp["outputs"]:
+                self.dataChannels.extend(channel.values())
+                for key, name in channel.items():
+                    if key == "t":
+                        timeChannel = name
+                    else:
+                        inputChannels.append(name)
+            if timeChannel is not None:
+                self.timeChannels[timeChannel] = inputChannels
+        self.allChannelsReq = "&".join(self.dataChannels)
+        if self.dataBuffer.channels != self.dataChannels:
+            self.dataBuffer.setChannels(self.dataChannels)
+
+    async def probe(self) -> bool:
+        """
+        A single cheap request, the latest value of every channel: checks that the phone answers and that
+        its experiment still has the channels of the configuration in use.
+        :return: whether the configuration is still valid
+        """
+        try:
+            async with self._get(f"/get?{self.allChannelsReq}") as response:
+                self.isAlive = response.ok
+                if response.status != 200:
+                    return False
+                result = await response.json()
+                return all(channel in result["buffer"] for channel in self.dataChannels)
+        except PhyphoxPhone.CONNECTION_ERROR:
+            self.isAlive = False
+            return False
+        except PhyphoxPhone.REQUEST_ERROR:
+            return False
 
     async def startExperiment(self) -> None:
-        async with aiohttp.ClientSession() as client:
-            try:
-                async with client.get(f"{self.baseAddress}/control?cmd=start") as response:
-                    if response.status != 200:
-                        self._didLastRequestFailed = True
-                        return
-                    self.startAt = time.time_ns()
-            except PhyphoxPhone.CONNECTION_ERROR:
-                self._didLastRequestFailed = True
+        try:
+            async with self._get("/control?cmd=start") as response:
+                if response.status != 200:
+                    self._didLastRequestFailed = True
+                    return
+                self.startAt = time.time_ns()
+                # The experiment time restarts (or resumes after a pause): the previous offset is meaningless
+                self.clock.reset()
+        except PhyphoxPhone.CONNECTION_ERROR:
+            self._didLastRequestFailed = True
 
     async def stopExperiment(self) -> None:
-        async with aiohttp.ClientSession() as client:
-            try:
-                async with client.get(f"{self.baseAddress}/control?cmd=stop") as response:
-                    if response.status != 200:
-                        self._didLastRequestFailed = True
-                        return
-                    self.endAt = time.time_ns()
-            except PhyphoxPhone.CONNECTION_ERROR:
-                self._didLastRequestFailed = True
+        try:
+            async with self._get("/control?cmd=stop") as response:
+                if response.status != 200:
+                    self._didLastRequestFailed = True
+                    return
+                self.endAt = time.time_ns()
+        except PhyphoxPhone.CONNECTION_ERROR:
+            self._didLastRequestFailed = True
 
     async def resetExperiment(self) -> None:
         self.dataBuffer.clear()
+        self.channelCursors.clear()
+        # Clearing starts a new session on the phone
+        self.session = None
         self.startAt = self.endAt = self._internalClock = 0
 
-        async with aiohttp.ClientSession() as client:
-            try:
-                async with client.get(f"{self.baseAddress}/control?cmd=clear") as response:
-                    if response.status != 200:
-                        self._didLastRequestFailed = True
-                    response.close()
-            except PhyphoxPhone.CONNECTION_ERROR:
-                self._didLastRequestFailed = True
+        try:
+            async with self._get("/control?cmd=clear") as response:
+                if response.status != 200:
+                    self._didLastRequestFailed = True
+        except PhyphoxPhone.CONNECTION_ERROR:
+            self._didLastRequestFailed = True
 
     async def getRemoteTime(self) -> dict or None:
-        async with aiohttp.ClientSession() as client:
-            try:
-                async with client.get(f"{self.baseAddress}/time") as response:
-                    if response.status != 200:
-                        raise ConnectionError
-                    return await response.json()
-            except PhyphoxPhone.CONNECTION_ERROR as e:
-                self._didLastRequestFailed = True
-                return None
+        try:
+            async with self._get("/time") as response:
+                if response.status != 200:
+                    raise ConnectionError
+                return await response.json()
+        except PhyphoxPhone.REQUEST_ERROR:
+            self._didLastRequestFailed = True
+            return None
+
+    def _newestTime(self, result: dict) -> float or None:
+        for timeChannel in self.timeChannels:
+            buffer = result["buffer"].get(timeChannel, {}).get("buffer")
+            if buffer and buffer[-1] is not None:
+                return buffer[-1]
+        return None
+
+    def _stamp(self, remote: float) -> float:
+        return self.clock.toHost(remote) - self.timeOrigin
+
+    async def syncClock(self) -> bool:
+        """
+        Run one clock exchange with the phone: ask for the newest value of a time buffer.
+        The experiment must be running for the time buffers to move.
+        :return: whether a sample could be added to the clock estimation
+        """
+        timeChannel = next(iter(self.timeChannels), None)
+        if timeChannel is None:
+            return False
+        hostSent = time.time()
+        result = await self.getDataByHand(timeChannel)
+        hostReceived = time.time()
+        if result is None:
+            return False
+        remote = self._newestTime(result)
+        if remote is None:
+            return False
+        self.clock.addSample(hostSent, remote, hostReceived)
+        return True
 
     async def getCurrentData(self, frameRate: float):
-        async with aiohttp.ClientSession() as client:
-            try:
-                async with client.get(f"{self.baseAddress}/get?{self.allChannelsReq}") as response:
-                    if response.status != 200:
-                        raise ConnectionError
-                    result = await response.json()
-                    self.dataBuffer.append(DataFrame(self._internalClock, {channel: result["buffer"][channel]["buffer"][0] for channel in self.dataChannels}))
-                    self._internalClock += frameRate * self.deltaTime
-            except PhyphoxPhone.CONNECTION_ERROR:
-                self._didLastRequestFailed = True
-                self.dataBuffer.append(DataFrame(self._internalClock, None))
-                self._internalClock += frameRate * self.deltaTime
-                return
+        try:
+            hostSent = time.time()
+            async with self._get(f"/get?{self.allChannelsReq}") as response:
+                if response.status != 200:
+                    raise ConnectionError
+                result = await response.json()
+                data = dict()
+                for channel in self.dataChannels:
+                    buffer = result["buffer"][channel]["buffer"]
+                    data[channel] = buffer[0] if buffer else None
+                remote = self._newestTime(result)
+            hostReceived = time.time()
+            if remote is not None:
+                # Stamp with the sensor time instead of our own count of the frames
+                self.clock.addSample(hostSent, remote, hostReceived)
+                self._internalClock = self._stamp(remote)
+            self.dataBuffer.append(DataFrame(self._internalClock, data))
+            self._internalClock += frameRate * self.deltaTime
+            defaultRegistry.counter("phyphox_samples_total", "Samples received", device=self.ip).inc()
+        except PhyphoxPhone.REQUEST_ERROR:
+            self._didLastRequestFailed = True
+            defaultRegistry.counter("phyphox_failed_frames_total", "Frames without data, the device didn't answer",
+                                    device=self.ip).inc()
+            self.dataBuffer.append(DataFrame(self._internalClock, None))
+            self._internalClock += frameRate * self.deltaTime
+            return
+
+    def _incrementalRequest(self) -> str:
+        args = list()
+        for timeChannel, channels in self.timeChannels.items():
+            cursor = self.channelCursors.get(timeChannel)
+            if cursor is None:
+                # Nothing received yet: the whole buffers
+                args.append(f"{timeChannel}=full")
+                args.extend(f"{channel}=full" for channel in channels)
+                continue
+            args.append(f"{timeChannel}={cursor!r}")
+            args.extend(f"{channel}={cursor!r}|{timeChannel}" for channel in channels)
+        return "&".join(args)
+
+    async def getNewData(self) -> List[DataFrame]:
+        """
+        Incremental mode: only fetch the samples recorded since the last call, using phyphox's
+        `buffer=<threshold>|<time buffer>` syntax, so nothing sampled between two polls is lost.
+        Channels of an input without a time output can't be fetched this way and are ignored.
+        The samples are stamped with their sensor time mapped to the host clock, relative to timeOrigin.
+        :return: the new frames, also appended to the data buffer, ordered by time
+        """
+        try:
+            hostSent = time.time()
+            async with self._get(f"/get?{self._incrementalRequest()}") as response:
+                if response.status != 200:
+                    raise ConnectionError
+                result = await response.json()
+                session = result.get("status", {}).get("session")
+                remote = self._newestTime(result)
+                # Read before anything is updated: a malformed answer leaves the cursors where they were
+                buffers = [(timeChannel, channels, result["buffer"][timeChannel]["buffer"],
+                            [result["buffer"][channel]["buffer"] for channel in channels])
+                           for timeChannel, channels in self.timeChannels.items()]
+            hostReceived = time.time()
+        except PhyphoxPhone.REQUEST_ERROR:
+            # The cursors did not move: the next successful call will bring the missed samples back
+            self._didLastRequestFailed = True
+            defaultRegistry.counter("phyphox_failed_polls_total", "Incremental polls without an answer, "
+                                    "their samples come with the next one", device=self.ip).inc()
+            return []
+
+        if self.session is not None and session != self.session:
+            # The phone's data was cleared: the cursors point into the previous data, and its clock restarted
+            self.session = session
+            self.channelCursors.clear()
+            self.clock.reset()
+            self._didLoseSamples = True
+            return []
+        self.session = session
+
+        # Every poll is also a clock exchange, refining the estimation during the whole run
+        if remote is not None:
+            self.clock.addSample(hostSent, remote, hostReceived)
+
+        frames = list()
+        for timeChannel, channels, times, columns in buffers:
+            count = min([len(times)] + [len(column) for column in columns])
+            if count == 0:
+                continue
+            for i in range(count):
+                # The sensor time is kept as the value of the time channel, it identifies the sample on the phone
+                data = {channel: column[i] for channel, column in zip(channels, columns)}
+                data[timeChannel] = times[i]
+                frames.append(DataFrame(self._stamp(times[i]), data))
+            self.channelCursors[timeChannel] = times[count - 1]
+        frames.sort(key=lambda frame: frame.t)
+        self.dataBuffer.extend(frames)
+        defaultRegistry.counter("phyphox_samples_total", "Samples received", device=self.ip).inc(len(frames))
+        return frames
+
+    async def resume(self) -> None:
+        """
+        Back from a disconnection: fetch the configuration again, keeping the cursors of the time channels
+        which still exist, so the next incremental request brings back the samples recorded meanwhile.
+        """
+        cursors = dict(self.channelCursors)
+        await self.getRemoteConfig()
+        self.channelCursors.update((timeChannel, cursor) for timeChannel, cursor in cursors.items()
+                                   if timeChannel in self.timeChannels)
+
+    async def downloadBuffer(self, channel: str, path: str, chunkSize: int = DOWNLOAD_CHUNK) -> bool:
+        """
+        Write the answer of a `/get` of the whole buffer of a channel to a file, as it arrives:
+        it is never held in memory, however long the experiment was.
+        There is no limit on the duration of the download, only on the silences of the phone.
+        :return: whether the download is complete
+        """
+        try:
+            async with self._get(f"/get?{channel}=full",
+                                 aiohttp.ClientTimeout(total=None, sock_read=self.requestTimeout)) as response:
+                if response.status != 200:
+                    raise ConnectionError
+                with open(path, "wb") as file:
+                    async for chunk in response.content.iter_chunked(chunkSize):
+                        file.write(chunk)
+            return True
+        except PhyphoxPhone.CONNECTION_ERROR + (aiohttp.ClientPayloadError,):
+            self._didLastRequestFailed = True
+            return False
 
     async def getDataByHand(self, *args):
-        async with aiohttp.ClientSession() as client:
-            try:
-                async with client.get(f"{self.baseAddress}/get?{'&'.join(args)}") as response:
-                    if response != 200:
-                        raise ConnectionError
-                    return response.json()
-            except PhyphoxPhone.CONNECTION_ERROR:
-                self._didLastRequestFailed = True
-                return None
+        try:
+            async with self._get(f"/get?{'&'.join(args)}") as response:
+                if response.status != 200:
+                    raise ConnectionError
+                return await response.json()
+        except PhyphoxPhone.REQUEST_ERROR:
+            self._didLastRequestFailed = True
+            return None
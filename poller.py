@@ -0,0 +1,223 @@
+from collections import deque
+from dataclasses import dataclass, field
+from phyphox import PhyphoxPhone
+from samplestore import DataFrame
+from typing import Callable, Deque, List
+import asyncio
+import time
+
+# Request durations kept to compute the latency percentiles
+LATENCY_WINDOW = 256
+# Defaults of AdaptiveRate: bounds (requests/s), latency (s) above which a phone is considered saturated,
+# additive increase (requests/s per second), multiplicative decrease and polls ignored after a decrease
+MIN_RATE = 1
+MAX_RATE = 50
+TARGET_LATENCY = 0.1
+RATE_INCREASE = 1
+RATE_DECREASE = 0.5
+DECREASE_HOLDOFF = 4
+LATENCY_SMOOTHING = 0.2
+# Polls of the samples left on a stopped device, while they fail
+DRAIN_ATTEMPTS = 3
+
+
+@dataclass
+class PollerStats:
+    ticks: int = 0
+    missedTicks: int = 0
+    failedRequests: int = 0
+    samples: int = 0
+    # Ticks without request because the device is disconnected, resumptions after that, gaps reported
+    skippedTicks: int = 0
+    resumes: int = 0
+    gaps: int = 0
+    # Seconds: duration of the last request, how late the last tick started, time spent handing frames over
+    lastLatency: float = 0
+    lastLag: float = 0
+    sinkTime: float = 0
+    latencies: Deque[float] = field(default_factory=lambda: deque(maxlen=LATENCY_WINDOW))
+
+    def latencyPercentile(self, percentile: float) -> float:
+        if len(self.latencies) == 0:
+            return 0
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * percentile / 100))]
+
+
+class AdaptiveRate:
+    """
+    AIMD control of the request rate of a phone: while its answers come back faster than the target latency,
+    the rate grows by `increase` requests/s every second; on a failure or when the smoothed latency goes above
+    the target, it is multiplied by `decrease`, at most once every `holdoff` polls so a single slow answer
+    doesn't collapse it. In incremental mode every poll brings all the samples since the previous one,
+    so the rate only trades freshness against the load of the phone's server and of the Wi-Fi.
+    """
+
+    def __init__(self, rate: float, minRate: float = MIN_RATE, maxRate: float = MAX_RATE,
+                 targetLatency: float = TARGET_LATENCY, increase: float = RATE_INCREASE,
+                 decrease: float = RATE_DECREASE, holdoff: int = DECREASE_HOLDOFF):
+        """
+        :param rate: initial requests per second, clamped to [minRate, maxRate]
+        """
+        self.minRate = minRate
+        self.maxRate = maxRate
+        self.targetLatency = targetLatency
+        self.increase = increase
+        self.decrease = decrease
+        self.holdoff = holdoff
+        self.rate = min(maxRate, max(minRate, rate))
+        self.smoothedLatency = 0.0
+        self.decreases = 0
+        self._holdoff = 0
+
+    @property
+    def interval(self) -> float:
+        return 1 / self.rate
+
+    def update(self, latency: float, failed: bool) -> float:
+        """
+        :param latency: duration (s) of the last request
+        :param failed: whether it failed
+        :return: the next poll interval
+        """
+        if not failed:
+            self.smoothedLatency += LATENCY_SMOOTHING * (latency - self.smoothedLatency)
+        if failed or self.smoothedLatency > self.targetLatency:
+            if self._holdoff == 0:
+                self.rate = max(self.minRate, self.rate * self.decrease)
+                self.decreases += 1
+                self._holdoff = self.holdoff
+            else:
+                self._holdoff -= 1
+        else:
+            self._holdoff = max(0, self._holdoff - 1)
+            # One poll lasts one interval: the rate grows by `increase` per second
+            self.rate = min(self.maxRate, self.rate + self.increase * self.interval)
+        return self.interval
+
+
+class DevicePoller:
+    """
+    Polls one device on its own schedule, so a slow phone never holds the others back.
+    The ticks target fixed deadlines (start + k * interval): the duration of the request is compensated,
+    and when a request overruns one or more ticks they are coalesced into a single immediate poll.
+
+    While the device is disconnected (see connection.py) the ticks are skipped, except for the probes.
+    When it comes back, it is resumed: in incremental mode the samples recorded meanwhile come with the
+    next poll. Samples that are really lost (polled mode, or the phone's data was cleared) are reported
+    as a gap, from the time of the last frame received to the time of the next one.
+
+    In incremental mode, once stopped it polls a last time: stop the experiment on the device before,
+    and the samples it recorded since the previous poll are fetched too.
+    """
+
+    def __init__(self, device: PhyphoxPhone, interval: float, sink: Callable[[str, List[DataFrame]], None],
+                 incremental: bool = True, controller: AdaptiveRate or None = None,
+                 onGap: Callable[[str, float, float], None] or None = None):
+        """
+        :param interval: seconds between two polls
+        :param sink: receives the ip of the device and its new frames after each poll
+        :param incremental: fetch every sample since the last poll instead of the latest values only
+        :param controller: adapts the interval after each poll, starting from its own rate
+        :param onGap: receives the ip of the device and the times (s) between which samples are missing
+        """
+        self.device = device
+        self.controller = controller
+        self.interval = interval if controller is None else controller.interval
+        self.sink = sink
+        self.onGap = onGap
+        self.incremental = incremental
+        self.stats = PollerStats()
+        self._lastTime = 0.0
+        self._gapFrom: float or None = None
+
+    async def poll(self) -> List[DataFrame]:
+        if self.incremental:
+            frames = await self.device.getNewData()
+            lost = self.device.didLoseSamples()
+        else:
+            await self.device.getCurrentData(self.interval)
+            frames = [self.device.dataBuffer[-1]]
+            lost = False
+        if self.device.didLastRequestFailed():
+            self.stats.failedRequests += 1
+            if not self.incremental:
+                # Nothing to fetch it back from: report a gap rather than frames without data
+                frames = []
+                lost = True
+        if lost and self._gapFrom is None:
+            self._gapFrom = self._lastTime
+        if frames:
+            if self._gapFrom is not None:
+                self.stats.gaps += 1
+                if self.onGap is not None:
+                    self.onGap(self.device.ip, self._gapFrom, frames[0].t)
+                self._gapFrom = None
+            self._lastTime = frames[-1].t
+        return frames
+
+    async def _tick(self) -> bool:
+        """
+        Poll the device and hand its frames over to the sink.
+        :return: whether the poll succeeded
+        """
+        loop = asyncio.get_running_loop()
+        startedAt = loop.time()
+        failedRequests = self.stats.failedRequests
+        try:
+            frames = await self.poll()
+        except Exception:
+            # Whatever the phone answered, it must not end the polling of the device for good
+            self.device.connection.recordFailure()
+            self.stats.failedRequests += 1
+            frames = []
+        failed = self.stats.failedRequests > failedRequests
+        self.stats.lastLatency = loop.time() - startedAt
+        if self.controller is not None:
+            self.interval = self.controller.update(self.stats.lastLatency, failed)
+        self.stats.latencies.append(self.stats.lastLatency)
+        self.stats.ticks += 1
+        self.stats.samples += len(frames)
+
+        sinkStartedAt = time.perf_counter()
+        self.sink(self.device.ip, frames)
+        self.stats.sinkTime += time.perf_counter() - sinkStartedAt
+        if self.device.connection.needsResume:
+            self.device.connection.needsResume = False
+            await self.device.resume()
+            self.stats.resumes += 1
+        return not failed
+
+    async def drain(self, attempts: int = DRAIN_ATTEMPTS) -> None:
+        """
+        Fetch the samples left on the device since the last poll, retrying a failed poll.
+        """
+        for _ in range(attempts):
+            # Not for a device which went away
+            if not self.device.connection.canRequest() or await self._tick():
+                return
+
+    async def run(self, stop: asyncio.Event) -> None:
+        loop = asyncio.get_running_loop()
+        deadline = loop.time()
+        while not stop.is_set():
+            self.stats.lastLag = loop.time() - deadline
+            if self.device.connection.canRequest():
+                await self._tick()
+            else:
+                self.stats.skippedTicks += 1
+
+            deadline += self.interval
+            overdue = loop.time() - deadline
+            if overdue >= 0:
+                # Skip the ticks missed while waiting for the phone, and poll right away for the last one
+                missed = int(overdue // self.interval)
+                self.stats.missedTicks += missed
+                deadline += missed * self.interval
+                continue
+            try:
+                await asyncio.wait_for(stop.wait(), -overdue)
+            except asyncio.TimeoutError:
+                pass
+        if self.incremental:
+            await self.drain()
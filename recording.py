@@ -0,0 +1,264 @@
+"""
+Chunked, compressed columnar recording of the samples.
+
+File layout:
+    b"PXREC" + version (u8)
+    blocks, each starting with its type (u8) and its payload size (u32):
+        DEVICE_BLOCK    JSON {"id": ..., "ip": ..., "channels": [...]}
+        CHUNK_BLOCK     device id (u16), compression (u8), rows (u32), first time, last time (f64),
+                        then the columns (time first, then one per channel) as little-endian float64,
+                        compressed as a whole with zlib unless the compression is NONE
+        INDEX_BLOCK     JSON {"devices": [every device block], "chunks": [[offset, device id, rows,
+                        first time, last time] of every chunk]}
+    trailer: offset of the index block (u64) + b"PXEND"
+
+Chunks are written as soon as they are full or old enough, so a crash loses at most the chunk being
+filled: without the trailer, the reader rebuilds the index by walking through the blocks.
+"""
+from typing import Dict, List, Sequence, Tuple
+from samplestore import DataFrame
+from queue import Empty, Queue
+import json
+import math
+import mmap
+import numpy
+import os
+import struct
+import threading
+import time
+import zlib
+
+MAGIC = b"PXREC"
+VERSION = 1
+END_MAGIC = b"PXEND"
+DEVICE_BLOCK = 1
+CHUNK_BLOCK = 2
+INDEX_BLOCK = 3
+NONE = 0
+ZLIB = 1
+
+BLOCK_HEADER = struct.Struct("<BI")
+CHUNK_HEADER = struct.Struct("<HBIdd")
+TRAILER = struct.Struct("<Q5s")
+
+DEFAULT_CHUNK_ROWS = 4096
+DEFAULT_FLUSH_INTERVAL = 1.0
+
+
+class RecordingWriter:
+    def __init__(self, path: str, chunkRows: int = DEFAULT_CHUNK_ROWS, flushInterval: float = DEFAULT_FLUSH_INTERVAL,
+                 compression: int = ZLIB):
+        """
+        :param chunkRows: rows of a device gathered before writing a chunk
+        :param flushInterval: seconds after which the pending rows are written anyway
+        """
+        self.path = path
+        self.chunkRows = chunkRows
+        self.flushInterval = flushInterval
+        self.compression = compression
+        self._file = open(path, "wb")
+        self._file.write(MAGIC + bytes((VERSION,)))
+        self._devices: Dict[str, Tuple[int, List[str]]] = dict()
+        self._pending: Dict[str, list] = dict()
+        self._index: List[list] = list()
+        self._lastFlush = time.monotonic()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _writeBlock(self, blockType: int, payload: bytes) -> int:
+        offset = self._file.tell()
+        self._file.write(BLOCK_HEADER.pack(blockType, len(payload)))
+        self._file.write(payload)
+        return offset
+
+    def addDevice(self, ip: str, channels: Sequence[str]) -> None:
+        if ip in self._devices:
+            return
+        self._devices[ip] = (len(self._devices), list(channels))
+        self._pending[ip] = list()
+        self._writeBlock(DEVICE_BLOCK, json.dumps({"id": self._devices[ip][0], "ip": ip, "channels": list(channels)}).encode())
+
+    def write(self, ip: str, rows: Sequence[Sequence[float]]) -> None:
+        """
+        :param rows: (time, value 1, value 2, ...) in the order of the channels given to addDevice
+        """
+        pending = self._pending[ip]
+        pending.extend(rows)
+        if len(pending) >= self.chunkRows:
+            self._writeChunk(ip)
+        if time.monotonic() - self._lastFlush >= self.flushInterval:
+            self.flush()
+
+    def writeFrames(self, ip: str, frames: Sequence[DataFrame]) -> None:
+        channels = self._devices[ip][1]
+        rows = list()
+        for frame in frames:
+            data = frame.data or {}
+            rows.append((frame.t, *(math.nan if data.get(channel) is None else data[channel] for channel in channels)))
+        self.write(ip, rows)
+
+    def _writeChunk(self, ip: str) -> None:
+        rows = self._pending[ip]
+        if len(rows) == 0:
+            return
+        deviceId, channels = self._devices[ip]
+        columns = numpy.array(rows, dtype="<f8").reshape(len(rows), len(channels) + 1).T
+        payload = numpy.ascontiguousarray(columns).tobytes()
+        if self.compression == ZLIB:
+            payload = zlib.compress(payload, 1)
+        header = CHUNK_HEADER.pack(deviceId, self.compression, len(rows), columns[0].min(), columns[0].max())
+        offset = self._writeBlock(CHUNK_BLOCK, header + payload)
+        self._index.append([offset, deviceId, len(rows), columns[0].min(), columns[0].max()])
+        self._pending[ip] = list()
+
+    def flush(self) -> None:
+        for ip in self._pending:
+            self._writeChunk(ip)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._lastFlush = time.monotonic()
+
+    def close(self) -> None:
+        if self._file.closed:
+            return
+        self.flush()
+        devices = [{"id": deviceId, "ip": ip, "channels": channels} for ip, (deviceId, channels) in self._devices.items()]
+        offset = self._writeBlock(INDEX_BLOCK, json.dumps({"devices": devices, "chunks": self._index}).encode())
+        self._file.write(TRAILER.pack(offset, END_MAGIC))
+        self._file.close()
+
+
+class RecordingReader:
+    """
+    Memory-maps a recording and reads the columns of a device, optionally restricted to a time range.
+    Uncompressed chunks are read straight from the mapping: drop the arrays read before closing the reader.
+    """
+
+    def __init__(self, path: str):
+        self._file = open(path, "rb")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a phyphox recording")
+        # ip -> (device id, channels)
+        self.devices: Dict[str, Tuple[int, List[str]]] = dict()
+        self._index: List[list] = list()
+        self.complete = self._readIndex()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _blocks(self, offset: int):
+        end = len(self._map)
+        while offset + BLOCK_HEADER.size <= end:
+            blockType, size = BLOCK_HEADER.unpack_from(self._map, offset)
+            if blockType not in (DEVICE_BLOCK, CHUNK_BLOCK, INDEX_BLOCK) or offset + BLOCK_HEADER.size + size > end:
+                # Truncated by a crash
+                return
+            yield offset, blockType, offset + BLOCK_HEADER.size, size
+            offset += BLOCK_HEADER.size + size
+
+    def _readIndex(self) -> bool:
+        if len(self._map) >= len(MAGIC) + 1 + TRAILER.size and self._map[-len(END_MAGIC):] == END_MAGIC:
+            offset, _ = TRAILER.unpack_from(self._map, len(self._map) - TRAILER.size)
+            _, size = BLOCK_HEADER.unpack_from(self._map, offset)
+            index = json.loads(self._map[offset + BLOCK_HEADER.size:offset + BLOCK_HEADER.size + size])
+            for device in index["devices"]:
+                self.devices[device["ip"]] = (device["id"], device["channels"])
+            self._index = index["chunks"]
+            return True
+        # Not closed properly: walk through the blocks written
+        for offset, blockType, payload, size in self._blocks(len(MAGIC) + 1):
+            if blockType == DEVICE_BLOCK:
+                device = json.loads(self._map[payload:payload + size])
+                self.devices[device["ip"]] = (device["id"], device["channels"])
+            elif blockType == CHUNK_BLOCK:
+                deviceId, _, rows, first, last = CHUNK_HEADER.unpack_from(self._map, payload)
+                self._index.append([offset, deviceId, rows, first, last])
+        return False
+
+    def chunks(self, ip: str, start: float = -math.inf, end: float = math.inf) -> List[list]:
+        deviceId = self.devices[ip][0]
+        return [entry for entry in self._index if entry[1] == deviceId and entry[4] >= start and entry[3] <= end]
+
+    def _readChunk(self, offset: int, channels: int) -> numpy.ndarray:
+        _, size = BLOCK_HEADER.unpack_from(self._map, offset)
+        payload = offset + BLOCK_HEADER.size
+        _, compression, rows, _, _ = CHUNK_HEADER.unpack_from(self._map, payload)
+        begin, stop = payload + CHUNK_HEADER.size, payload + size
+        if compression == ZLIB:
+            data = numpy.frombuffer(zlib.decompress(self._map[begin:stop]), dtype="<f8")
+        else:
+            data = numpy.frombuffer(self._map, dtype="<f8", count=rows * (channels + 1), offset=begin)
+        return data.reshape(channels + 1, rows)
+
+    def read(self, ip: str, channels: Sequence[str] or None = None, start: float = -math.inf,
+             end: float = math.inf) -> Dict[str, numpy.ndarray]:
+        """
+        :return: the time column (key "t") and the requested channels (all by default) of a device
+        """
+        _, deviceChannels = self.devices[ip]
+        channels = deviceChannels if channels is None else channels
+        rows = [1 + deviceChannels.index(channel) for channel in channels]
+        parts = list()
+        for entry in self.chunks(ip, start, end):
+            columns = self._readChunk(entry[0], len(deviceChannels))
+            mask = (columns[0] >= start) & (columns[0] <= end)
+            parts.append(columns[[0] + rows][:, mask] if not mask.all() else columns[[0] + rows])
+        if len(parts) == 0:
+            merged = numpy.empty((len(channels) + 1, 0))
+        elif len(parts) == 1:
+            merged = parts[0]
+        else:
+            merged = numpy.concatenate(parts, axis=1)
+        result = {"t": merged[0]}
+        for i, channel in enumerate(channels):
+            result[channel] = merged[i + 1]
+        return result
+
+    def close(self) -> None:
+        self._map.close()
+        self._file.close()
+
+
+class RecordingSink:
+    """
+    Writes to a recording from its own thread, so the caller never waits for the disk.
+    """
+
+    def __init__(self, writer: RecordingWriter):
+        self.writer = writer
+        self._queue: Queue = Queue()
+        self._thread = threading.Thread(target=self._backgroundThread, daemon=True)
+        self._thread.start()
+
+    def _backgroundThread(self):
+        while True:
+            try:
+                item = self._queue.get(timeout=self.writer.flushInterval)
+            except Empty:
+                self.writer.flush()
+                continue
+            if item is None:
+                break
+            if item[0] is None:
+                self.writer.addDevice(*item[1])
+            else:
+                self.writer.write(*item)
+        self.writer.close()
+
+    def addDevice(self, ip: str, channels: Sequence[str]) -> None:
+        self._queue.put((None, (ip, list(channels))))
+
+    def submit(self, ip: str, rows: Sequence[Sequence[float]]) -> None:
+        self._queue.put((ip, rows))
+
+    def close(self) -> None:
+        self._queue.put(None)
+        self._thread.join()
@@ -0,0 +1,128 @@
+"""
+The phones already paired, kept on disk between two launches so they don't have to be found and set up again.
+
+For each phone, the registry remembers its address, the last answer of its `/config` and the rate of its
+clock (its drift, see clocksync.py), with the time of the calibration. On the next launch, `validate` probes
+every known phone concurrently with a single `/get` of the latest values of its channels (see
+PhyphoxPhone.probe):
+
+    - the channels are all there: the cached configuration is used, `/config` isn't fetched again
+    - the calibration is younger than `maxAge`: the rate is reused and the 2 s calibration is skipped.
+      The offset of the clock is never cached, it changes with each experiment and is estimated again
+      from the first polls.
+
+Only a rate which was really estimated is cached (ClockSync.hasRate: fitted over tens of seconds, with a small
+residual): the short calibration only measures the offset, the rate comes from a long enough run.
+"""
+from dataclasses import asdict, dataclass, field
+from phyphox import PhyphoxPhone
+from typing import Dict, Iterable, List, Tuple
+import asyncio
+import json
+import os
+import time
+
+REGISTRY_PATH = os.path.join(os.path.expanduser("~"), ".phyphox-devices.json")
+# Seconds a calibration of the clock rate is trusted. The drift of a phone clock changes slowly (temperature)
+CALIBRATION_MAX_AGE = 3600
+VERSION = 1
+
+
+@dataclass
+class DeviceRecord:
+    ip: str
+    port: int
+    config: dict = field(default_factory=dict)
+    # Host time (time.time()) of the last calibration, 0 if never calibrated, and its results
+    calibratedAt: float = 0
+    rate: float = 1.0
+    bestRoundTrip: float or None = None
+    # Seconds: rms of the exchanges around the fit of the rate, None if it wasn't estimated
+    residual: float or None = None
+    lastSeen: float = 0
+
+
+class DeviceRegistry:
+    def __init__(self, path: str = REGISTRY_PATH, maxAge: float = CALIBRATION_MAX_AGE):
+        """
+        :param maxAge: seconds a calibration of the clock is trusted
+        """
+        self.path = path
+        self.maxAge = maxAge
+        self.records: Dict[Tuple[str, int], DeviceRecord] = dict()
+
+    def load(self) -> List[DeviceRecord]:
+        """
+        Read the registry, it is empty if the file is missing or unreadable.
+        :return: the known devices
+        """
+        self.records.clear()
+        try:
+            with open(self.path) as file:
+                content = json.load(file)
+            if content.get("version") == VERSION:
+                for record in content["devices"]:
+                    record = DeviceRecord(**record)
+                    self.records[(record.ip, record.port)] = record
+        except (OSError, ValueError, KeyError, TypeError):
+            self.records.clear()
+        return list(self.records.values())
+
+    def save(self) -> None:
+        # Written aside then renamed: an interrupted save never leaves a truncated registry
+        temporary = f"{self.path}.tmp"
+        with open(temporary, "w") as file:
+            json.dump({"version": VERSION, "devices": [asdict(record) for record in self.records.values()]}, file)
+        os.replace(temporary, self.path)
+
+    def remember(self, device: PhyphoxPhone, calibrated: bool = False) -> None:
+        """
+        Keep the configuration of the device, and its clock rate if it was just estimated (see ClockSync.hasRate).
+        """
+        record = self.records.setdefault((device.ip, device.port), DeviceRecord(device.ip, device.port))
+        if device.config:
+            record.config = device.config
+        if calibrated and device.clock.hasRate:
+            record.calibratedAt = time.time()
+            record.rate = device.clock.rate
+            record.bestRoundTrip = device.clock.bestRoundTrip
+            record.residual = device.clock.residual
+        record.lastSeen = time.time()
+
+    def forget(self, device: PhyphoxPhone) -> None:
+        self.records.pop((device.ip, device.port), None)
+
+    def isFresh(self, device: PhyphoxPhone) -> bool:
+        record = self.records.get((device.ip, device.port))
+        return (record is not None and record.calibratedAt > 0 and record.residual is not None
+                and time.time() - record.calibratedAt < self.maxAge)
+
+    async def _restore(self, device: PhyphoxPhone) -> Tuple[bool, bool]:
+        record = self.records.get((device.ip, device.port))
+        if record is None or not record.config:
+            return False, False
+        try:
+            device.applyConfig(record.config)
+        except (KeyError, TypeError, AttributeError):
+            return False, False
+        configured = await device.probe()
+        if not device.isAlive:
+            return False, False
+        record.lastSeen = time.time()
+        # Another experiment on the same phone: its clock didn't change
+        if not self.isFresh(device):
+            return configured, False
+        device.clock.rate = device.deltaTime = record.rate
+        device.clock.bestRoundTrip = record.bestRoundTrip
+        return configured, True
+
+    async def validate(self, devices: Iterable[PhyphoxPhone]) -> Tuple[List[PhyphoxPhone], List[PhyphoxPhone]]:
+        """
+        Probe the devices concurrently and restore what is still valid of their records.
+        The calibration clears the phones: those which skip it must be cleared before the experiment.
+        :return: the devices whose configuration must be fetched, and those whose clock must be calibrated
+        """
+        devices = list(devices)
+        results = await asyncio.gather(*(self._restore(device) for device in devices))
+        return ([device for device, (configured, _) in zip(devices, results) if not configured],
+                [device for device, (_, calibrated) in zip(devices, results) if not calibrated])
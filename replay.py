@@ -0,0 +1,163 @@
+"""
+Replay of a recorded session through the broadcast, to develop analysis scripts without any phone.
+
+A session is read from a recording (see recording.py) or from JSON lines {ip: {"time": ..., "data": {...}}},
+like the output of the headless mode or a capture of the JSON broadcast (gap and start lines included).
+Its records are then written to a SampleRing in time order, each one at the deadline given by its time
+divided by the speed: the broadcaster reading the ring sends them exactly like during an experiment.
+At MAX_SPEED only the room left in the ring paces the replay, which makes it a throughput benchmark of
+the broadcast and of its clients.
+"""
+from dataclasses import dataclass
+from recording import MAGIC, RecordingReader
+from shmring import FLAG_EMPTY, FLAG_GAP, FLAG_START, SampleRing
+from typing import Dict, List
+import json
+import math
+import numpy
+import threading
+import time
+
+MAX_SPEED = 0
+# Records written to the ring at once at most, and the pause when it is full
+REPLAY_BATCH = 512
+FULL_RING_DELAY = 0.001
+
+
+@dataclass
+class ReplayStats:
+    records: int = 0
+    duration: float = 0
+    # Seconds: how late the most delayed batch was written, compared to its deadline
+    maxLag: float = 0
+    # Batches delayed because the ring was full
+    fullRing: int = 0
+
+
+class Session:
+    """
+    The records of every device, ordered by time: device index, time, values (NaN padded), flags.
+    """
+
+    def __init__(self, devices: Dict[str, List[str]], indexes: numpy.ndarray, times: numpy.ndarray,
+                 values: numpy.ndarray, flags: numpy.ndarray):
+        """
+        :param devices: channels by ip, in the order of the device indexes
+        """
+        order = numpy.argsort(times, kind="stable")
+        self.devices = devices
+        self.indexes = indexes[order]
+        self.times = times[order]
+        self.values = values[order]
+        self.flags = flags[order]
+
+    def __len__(self):
+        return len(self.times)
+
+    @property
+    def duration(self) -> float:
+        return float(self.times[-1] - self.times[0]) if len(self.times) else 0.0
+
+
+def _fromRecording(path: str) -> Session:
+    with RecordingReader(path) as reader:
+        devices = {ip: channels for ip, (_, channels) in sorted(reader.devices.items(), key=lambda item: item[1][0])}
+        width = max((len(channels) for channels in devices.values()), default=0)
+        indexes, times, values = list(), list(), list()
+        for index, (ip, channels) in enumerate(devices.items()):
+            columns = reader.read(ip)
+            count = len(columns["t"])
+            deviceValues = numpy.full((count, width), math.nan)
+            for i, channel in enumerate(channels):
+                deviceValues[:, i] = columns[channel]
+            indexes.append(numpy.full(count, index))
+            times.append(numpy.array(columns["t"]))
+            values.append(deviceValues)
+    if not times:
+        return Session(devices, numpy.empty(0, int), numpy.empty(0), numpy.empty((0, 0)), numpy.empty(0, int))
+    values = numpy.concatenate(values)
+    # Rows without any value are frames the phone didn't answer
+    flags = numpy.where(numpy.isnan(values).all(axis=1), FLAG_EMPTY, 0) if width else numpy.zeros(len(values), int)
+    return Session(devices, numpy.concatenate(indexes), numpy.concatenate(times), values, flags)
+
+
+def _fromJsonLines(path: str) -> Session:
+    devices: Dict[str, List[str]] = dict()
+    records = list()
+    with open(path) as file:
+        for line in file:
+            if not line.strip():
+                continue
+            for ip, frame in json.loads(line).items():
+                channels = devices.setdefault(ip, list())
+                if "gap" in frame:
+                    records.append((ip, frame["gap"][0], {None: frame["gap"][1]}, FLAG_GAP))
+                    continue
+                if "start" in frame:
+                    records.append((ip, frame["start"][0], {None: frame["start"][1]}, FLAG_START))
+                    continue
+                data = frame["data"]
+                for channel in data or ():
+                    if channel not in channels:
+                        channels.append(channel)
+                records.append((ip, frame["time"], data or {}, 0 if data else FLAG_EMPTY))
+    indexes = {ip: index for index, ip in enumerate(devices)}
+    width = max([1] + [len(channels) for channels in devices.values()])
+    values = numpy.full((len(records), width), math.nan)
+    for row, (ip, _, data, flags) in enumerate(records):
+        if flags & (FLAG_GAP | FLAG_START):
+            values[row, 0] = data[None]
+            continue
+        channels = devices[ip]
+        for channel, value in data.items():
+            if value is not None:
+                values[row, channels.index(channel)] = value
+    return Session(devices, numpy.array([indexes[record[0]] for record in records], dtype=int),
+                   numpy.array([record[1] for record in records], dtype=float), values,
+                   numpy.array([record[3] for record in records], dtype=int))
+
+
+def loadSession(path: str) -> Session:
+    """
+    Read a recording, or JSON lines when the file isn't one.
+    """
+    with open(path, "rb") as file:
+        isRecording = file.read(len(MAGIC)) == MAGIC
+    return _fromRecording(path) if isRecording else _fromJsonLines(path)
+
+
+def replaySession(session: Session, ring: SampleRing, speed: float = 1, stop: threading.Event or None = None) -> ReplayStats:
+    """
+    Write the records of the session to the ring, on their schedule.
+    :param speed: 1 for real time, N for N times faster, MAX_SPEED for as fast as the ring is read
+    :param stop: interrupts the replay when set
+    """
+    stop = stop if stop is not None else threading.Event()
+    stats = ReplayStats()
+    if len(session) == 0:
+        return stats
+    startedAt = time.monotonic()
+    if speed == MAX_SPEED:
+        deadlines = numpy.full(len(session), startedAt)
+    else:
+        deadlines = startedAt + (session.times - session.times[0]) / speed
+    position = 0
+    while position < len(session) and not stop.is_set():
+        now = time.monotonic()
+        due = int(numpy.searchsorted(deadlines, now, side="right"))
+        if due == position:
+            stop.wait(deadlines[position] - now)
+            continue
+        end = min(due, position + REPLAY_BATCH, position + ring.capacity - len(ring))
+        if end == position:
+            stats.fullRing += 1
+            stop.wait(FULL_RING_DELAY)
+            continue
+        if speed != MAX_SPEED:
+            stats.maxLag = max(stats.maxLag, now - deadlines[position])
+        ring.writeBatch(zip(session.indexes[position:end].tolist(), session.times[position:end].tolist(),
+                            session.values[position:end].tolist(), session.flags[position:end].tolist()))
+        stats.records += end - position
+        position = end
+    stats.duration = time.monotonic() - startedAt
+    return stats
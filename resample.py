@@ -0,0 +1,155 @@
+"""
+Alignment of several devices on a common time grid (t = k / rate), between the producer and the broadcaster.
+
+The rows of each device (time, value 1, value 2, ...) are kept in a sliding window, and every grid time
+covered by all the devices is interpolated at once for all the channels:
+
+    LINEAR  linear interpolation between the samples around the grid time
+    HOLD    the last sample at or before the grid time (zero-order hold)
+
+The result is a single pseudo-device, ALIGNED_DEVICE, with one channel "<ip>/<channel>" per channel of
+every device. Missing values are NaN: before the first sample of a device, inside its gaps, and while it
+lags more than `maxLag` seconds behind the most advanced device (the grid goes on without it, and its
+samples arriving later than the grid are dropped).
+"""
+from typing import Dict, List, Sequence, Tuple
+from samplestore import DataFrame
+import math
+import numpy
+
+LINEAR = "linear"
+HOLD = "hold"
+METHODS = (LINEAR, HOLD)
+ALIGNED_DEVICE = "aligned"
+MAX_LAG = 1.0
+
+
+class _DeviceWindow:
+    __slots__ = ("channels", "times", "values", "gaps")
+
+    def __init__(self, channels: List[str]):
+        self.channels = channels
+        self.times = numpy.empty(0)
+        self.values = numpy.empty((0, len(channels)))
+        # (start, end) of the lost samples
+        self.gaps: List[Tuple[float, float]] = list()
+
+    @property
+    def latest(self) -> float:
+        return self.times[-1] if len(self.times) else -math.inf
+
+
+class Resampler:
+    def __init__(self, rate: float, method: str = LINEAR, maxLag: float = MAX_LAG):
+        """
+        :param rate: grid times per second
+        :param method: LINEAR or HOLD
+        :param maxLag: seconds a device can lag behind the most advanced one before the grid goes on without it
+        """
+        if method not in METHODS:
+            raise ValueError(f"unknown resampling method {method!r}")
+        self.rate = rate
+        self.method = method
+        self.maxLag = maxLag
+        self._devices: Dict[str, _DeviceWindow] = dict()
+        # Index k of the next grid time k / rate, set by the first sample
+        self._next: int or None = None
+
+    @property
+    def channels(self) -> List[str]:
+        return [f"{ip}/{channel}" for ip, window in self._devices.items() for channel in window.channels]
+
+    def addDevice(self, ip: str, channels: Sequence[str]) -> None:
+        """
+        :param channels: the channels of the rows of the device, after their time
+        """
+        self._devices[ip] = _DeviceWindow(list(channels))
+
+    def submit(self, ip: str, rows: Sequence[Sequence[float]]) -> None:
+        """
+        Add rows (time, value 1, value 2, ...) of a device, in time order.
+        """
+        if len(rows) == 0:
+            return
+        window = self._devices[ip]
+        rows = numpy.asarray(rows, dtype=float).reshape(len(rows), len(window.channels) + 1)
+        # Samples older than the grid already emitted are dropped by the next advance
+        rows = rows[rows[:, 0] > window.latest]
+        if len(rows) == 0:
+            return
+        if self._next is None:
+            self._next = math.ceil(rows[0, 0] * self.rate)
+        window.times = numpy.concatenate((window.times, rows[:, 0]))
+        window.values = numpy.concatenate((window.values, rows[:, 1:]))
+
+    def gap(self, ip: str, start: float, end: float) -> None:
+        """
+        The samples of the device between these times are lost: don't interpolate across them.
+        """
+        self._devices[ip].gaps.append((start, end))
+
+    def advance(self, final: bool = False) -> numpy.ndarray:
+        """
+        Interpolate the grid times covered by every device since the previous call.
+        :param final: no more rows will come, go up to the most advanced device
+        :return: rows (grid time, then each channel in the order of `channels`), possibly none
+        """
+        windows = list(self._devices.values())
+        if self._next is None or not windows:
+            return numpy.empty((0, len(self.channels) + 1))
+        newest = max(window.latest for window in windows)
+        if final:
+            until = newest
+        else:
+            # The grid waits for the late devices, unless they lag too much
+            until = min(max(window.latest, newest - self.maxLag) for window in windows)
+        last = math.floor(until * self.rate)
+        if last < self._next:
+            return numpy.empty((0, len(self.channels) + 1))
+        grid = numpy.arange(self._next, last + 1) / self.rate
+        self._next = last + 1
+        columns = [grid[:, None]]
+        for window in windows:
+            columns.append(self._interpolate(window, grid))
+            self._prune(window)
+        return numpy.hstack(columns)
+
+    def _interpolate(self, window: _DeviceWindow, grid: numpy.ndarray) -> numpy.ndarray:
+        result = numpy.full((len(grid), len(window.channels)), math.nan)
+        times = window.times
+        if len(times) == 0:
+            return result
+        # Index of the last sample at or before each grid time
+        before = numpy.searchsorted(times, grid, side="right") - 1
+        valid = (before >= 0) & (grid <= times[-1])
+        if self.method == HOLD:
+            result[valid] = window.values[before[valid]]
+        else:
+            exact = valid & (before == len(times) - 1)
+            result[exact] = window.values[before[exact]]
+            inner = valid & ~exact
+            left, right = before[inner], before[inner] + 1
+            weight = ((grid[inner] - times[left]) / (times[right] - times[left]))[:, None]
+            result[inner] = window.values[left] * (1 - weight) + window.values[right] * weight
+        for start, end in window.gaps:
+            result[(grid > start) & (grid < end)] = math.nan
+        return result
+
+    def _prune(self, window: _DeviceWindow) -> None:
+        nextTime = self._next / self.rate
+        # Keep the last sample before the next grid time, needed to interpolate it
+        first = max(0, int(numpy.searchsorted(window.times, nextTime, side="right")) - 1)
+        window.times = window.times[first:]
+        window.values = window.values[first:]
+        window.gaps = [gap for gap in window.gaps if gap[1] > nextTime]
+
+    def toFrames(self, rows: numpy.ndarray) -> List[DataFrame]:
+        """
+        The rows of `advance` as frames of ALIGNED_DEVICE, without the missing values.
+        """
+        channels = self.channels
+        frames = list()
+        for row in rows.tolist():
+            data = {channel: value for channel, value in zip(channels, row[1:]) if value == value}
+            frames.append(DataFrame(row[0], data or None))
+        return frames
@@ -0,0 +1,175 @@
+from array import array
+from typing import Dict, Iterable, List
+import math
+
+
+class DataFrame:
+    """
+    A single sample: its time and the value of each channel (None when the phone didn't answer).
+    """
+    __slots__ = ("t", "data")
+
+    def __init__(self, t: float, data: object):
+        self.t = t
+        self.data = data
+
+    def __repr__(self):
+        return f"DataFrame(t={self.t!r}, data={self.data!r})"
+
+    def __eq__(self, other):
+        if not isinstance(other, DataFrame):
+            return NotImplemented
+        return self.t == other.t and self.data == other.data
+
+    def toJson(self):
+        return {"time": self.t, "data": self.data}
+
+
+class SampleStore:
+    """
+    Columnar sample storage: one float64 array for the time and one per channel.
+    Missing values are stored as NaN.
+
+    Without a capacity the columns grow by doubling. With a capacity the store is a ring buffer
+    and the oldest samples are overwritten. Views returned by `column`, `times` and `window` are
+    zero-copy memoryviews whenever the requested range is contiguous in memory (always the case
+    without a capacity), and copies otherwise.
+    """
+    INITIAL_SIZE = 1024
+
+    def __init__(self, channels: Iterable[str] = (), capacity: int or None = None):
+        self.capacity = capacity
+        self._channels: List[str] = list()
+        self._indexes: Dict[str, int] = dict()
+        self._times = array("d")
+        self._columns: List[array] = list()
+        self._start = 0
+        self._count = 0
+        self.setChannels(channels)
+
+    @property
+    def channels(self) -> List[str]:
+        return list(self._channels)
+
+    def setChannels(self, channels: Iterable[str]) -> None:
+        """
+        Change the stored channels. This drops every sample already stored.
+        """
+        self._channels = list(channels)
+        self._indexes = {channel: i for i, channel in enumerate(self._channels)}
+        size = self.capacity if self.capacity is not None else SampleStore.INITIAL_SIZE
+        self._times = SampleStore._allocate(size)
+        self._columns = [SampleStore._allocate(size) for _ in self._channels]
+        self._start = self._count = 0
+
+    @staticmethod
+    def _allocate(size: int) -> array:
+        return array("d", bytes(8 * size))
+
+    def _grow(self) -> None:
+        # New arrays instead of resizing in place, so memoryviews handed out stay valid
+        extra = SampleStore._allocate(len(self._times))
+        self._times = self._times + extra
+        self._columns = [column + extra for column in self._columns]
+
+    def _physical(self, index: int) -> int:
+        return (self._start + index) % len(self._times)
+
+    def __len__(self):
+        return self._count
+
+    def clear(self) -> None:
+        self._start = self._count = 0
+
+    def append(self, frame: DataFrame) -> None:
+        self.appendValues(frame.t, frame.data)
+
+    def appendValues(self, t: float, data: dict or None) -> None:
+        size = len(self._times)
+        if self._count == size:
+            if self.capacity is None:
+                self._grow()
+                size = len(self._times)
+            else:
+                # Ring buffer full: forget the oldest sample
+                self._start = (self._start + 1) % size
+                self._count -= 1
+        position = (self._start + self._count) % size
+        self._times[position] = t
+        for column in self._columns:
+            column[position] = math.nan
+        if data is not None:
+            for channel, value in data.items():
+                index = self._indexes.get(channel)
+                if index is not None:
+                    self._columns[index][position] = math.nan if value is None else value
+        self._count += 1
+
+    def extend(self, frames: Iterable[DataFrame]) -> None:
+        for frame in frames:
+            self.appendValues(frame.t, frame.data)
+
+    def _frame(self, position: int) -> DataFrame:
+        data = dict()
+        for channel, column in zip(self._channels, self._columns):
+            value = column[position]
+            if value == value:
+                data[channel] = value
+        return DataFrame(self._times[position], data or None)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._frame(self._physical(i)) for i in range(*index.indices(self._count))]
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError("SampleStore index out of range")
+        return self._frame(self._physical(index))
+
+    def __iter__(self):
+        for i in range(self._count):
+            yield self._frame(self._physical(i))
+
+    def _view(self, column: array, begin: int, end: int):
+        if begin >= end:
+            return memoryview(array("d"))
+        first = self._physical(begin)
+        if first + (end - begin) <= len(column):
+            return memoryview(column)[first:first + end - begin]
+        # The range wraps around the end of the ring buffer
+        return memoryview(column[first:] + column[:self._physical(end)])
+
+    def times(self, begin: int = 0, end: int or None = None):
+        end = self._count if end is None else end
+        return self._view(self._times, begin, end)
+
+    def column(self, channel: str, begin: int = 0, end: int or None = None):
+        end = self._count if end is None else end
+        return self._view(self._columns[self._indexes[channel]], begin, end)
+
+    def _bisect(self, t: float, right: bool) -> int:
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            value = self._times[self._physical(middle)]
+            if value < t or (right and value == t):
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def indexRange(self, start: float, end: float) -> range:
+        """
+        Indexes of the samples whose time is in [start, end]. The time column must be non-decreasing.
+        """
+        return range(self._bisect(start, False), self._bisect(end, True))
+
+    def window(self, start: float, end: float) -> Dict[str, memoryview]:
+        """
+        The time column (key "t") and every channel column for the samples between start and end.
+        """
+        indexes = self.indexRange(start, end)
+        result = {"t": self.times(indexes.start, indexes.stop)}
+        for channel in self._channels:
+            result[channel] = self.column(channel, indexes.start, indexes.stop)
+        return result
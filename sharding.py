@@ -0,0 +1,81 @@
+"""
+Split of the phones between several producer processes, each polling its shard into its own SampleRing.
+
+The shards are balanced with the longest-processing-time rule: the phones, heaviest first, each go to the
+least loaded shard. The load of a phone is estimated from its requests and samples per second, measured
+during the previous experiment when there was one.
+
+The broadcaster reads every ring through MergedRings. Each phone belongs to a single ring (single producer,
+single consumer, as SampleRing requires) and a ring is read in order, so the order of the records of each
+phone is kept.
+"""
+from shmring import SampleRing
+from typing import List, Sequence
+import heapq
+
+# Cost of a request compared to one value of a sample (JSON decoding, bookkeeping), in the load estimation
+REQUEST_COST = 50
+# Sensor rate assumed for a phone never measured, in incremental mode
+DEFAULT_SAMPLE_RATE = 100
+# Phones a producer process is expected to keep up with, to suggest a number of processes
+PHONES_PER_WORKER = 8
+
+
+def deviceLoad(requestRate: float, sampleRate: float, channels: int) -> float:
+    return requestRate * REQUEST_COST + sampleRate * max(1, channels)
+
+
+def balanceShards(loads: Sequence[float], workers: int) -> List[List[int]]:
+    """
+    :param loads: load of each device
+    :return: the indexes of the devices of each shard, no shard is empty
+    """
+    shards = [list() for _ in range(max(1, min(workers, len(loads))))]
+    heap = [(0.0, shard) for shard in range(len(shards))]
+    for index in sorted(range(len(loads)), key=lambda i: loads[i], reverse=True):
+        load, shard = heapq.heappop(heap)
+        shards[shard].append(index)
+        heapq.heappush(heap, (load + loads[index], shard))
+    return [sorted(shard) for shard in shards]
+
+
+class MergedRings:
+    """
+    The consumer side of several rings, read like a single SampleRing.
+    """
+
+    def __init__(self, rings: Sequence[SampleRing]):
+        self.rings = list(rings)
+        self._first = 0
+
+    def __len__(self):
+        return sum(len(ring) for ring in self.rings)
+
+    @property
+    def highWater(self) -> int:
+        return sum(ring.highWater for ring in self.rings)
+
+    @property
+    def dropped(self) -> int:
+        return sum(ring.dropped for ring in self.rings)
+
+    def readBatch(self, maxRecords: int) -> List[tuple]:
+        """
+        Up to maxRecords records, taken from each ring in turn. The ring read first changes at each call,
+        so a busy ring can't starve the others.
+        """
+        records = list()
+        for i in range(len(self.rings)):
+            if len(records) >= maxRecords:
+                break
+            records.extend(self.rings[(self._first + i) % len(self.rings)].readBatch(maxRecords - len(records)))
+        self._first = (self._first + 1) % len(self.rings)
+        return records
+
+    def close(self) -> None:
+        for ring in self.rings:
+            ring.close()
+
+    def unlink(self) -> None:
+        for ring in self.rings:
+            ring.unlink()
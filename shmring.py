@@ -0,0 +1,125 @@
+from multiprocessing import shared_memory
+from typing import Iterable, List, Sequence, Tuple
+import math
+import struct
+
+# write counter, read counter, high water mark, dropped records, capacity, channels
+HEADER = struct.Struct("<QQQQII")
+COUNTER = struct.Struct("<Q")
+HEAD, TAIL, HIGH_WATER, DROPPED = 0, 8, 16, 24
+HEADER_SIZE = 64
+
+# Record flags
+FLAG_EMPTY = 1
+# Not a sample: the samples of the device between the time of the record and its first value are lost
+FLAG_GAP = 2
+# Not a sample: the device started at the time of the record (its skew from t=0), within its first value (s)
+FLAG_START = 4
+
+
+class SampleRing:
+    """
+    Lock-free single-producer/single-consumer ring buffer of fixed-size sample records in shared memory.
+    A record is: device index (u32), flags (u32), time, then `channels` values (float64, NaN when missing).
+
+    The producer only moves the write counter and the consumer only moves the read counter, both growing
+    forever, so no lock is needed as long as there is one process writing and one process reading.
+    A record is written before the counter exposing it. When the ring is full, new records are dropped
+    and counted.
+    """
+
+    def __init__(self, capacity: int, channels: int, name: str or None = None):
+        """
+        Create a new ring, or attach to an existing one when `name` is given (capacity and channels are then
+        read from the shared memory).
+        """
+        if name is None:
+            self.record = struct.Struct(f"<IId{channels}d")
+            self._memory = shared_memory.SharedMemory(create=True, size=HEADER_SIZE + capacity * self.record.size)
+            HEADER.pack_into(self._memory.buf, 0, 0, 0, 0, 0, capacity, channels)
+        else:
+            self._memory = shared_memory.SharedMemory(name=name)
+            capacity, channels = HEADER.unpack_from(self._memory.buf)[4:]
+            self.record = struct.Struct(f"<IId{channels}d")
+        self.capacity = capacity
+        self.channels = channels
+        self._padding = (math.nan,) * channels
+
+    def __reduce__(self):
+        return SampleRing, (self.capacity, self.channels, self.name)
+
+    @property
+    def name(self) -> str:
+        return self._memory.name
+
+    def _load(self, offset: int) -> int:
+        return COUNTER.unpack_from(self._memory.buf, offset)[0]
+
+    def _store(self, offset: int, value: int) -> None:
+        COUNTER.pack_into(self._memory.buf, offset, value)
+
+    def __len__(self):
+        return self._load(HEAD) - self._load(TAIL)
+
+    @property
+    def highWater(self) -> int:
+        return self._load(HIGH_WATER)
+
+    @property
+    def dropped(self) -> int:
+        return self._load(DROPPED)
+
+    def write(self, deviceIndex: int, t: float, values: Sequence[float], flags: int = 0) -> bool:
+        return self.writeBatch(((deviceIndex, t, values, flags),)) == 1
+
+    def writeBatch(self, records: Iterable[Tuple[int, float, Sequence[float], int]]) -> int:
+        """
+        Producer side. Each record is (device index, time, values, flags), values are padded with NaN.
+        :return: the number of records written, the others were dropped because the ring is full
+        """
+        buffer = self._memory.buf
+        head = self._load(HEAD)
+        free = self.capacity - (head - self._load(TAIL))
+        written = dropped = 0
+        for deviceIndex, t, values, flags in records:
+            if written == free:
+                dropped += 1
+                continue
+            if len(values) < self.channels:
+                values = tuple(values) + self._padding[len(values):]
+            offset = HEADER_SIZE + ((head + written) % self.capacity) * self.record.size
+            self.record.pack_into(buffer, offset, deviceIndex, flags, t, *values[:self.channels])
+            written += 1
+        # Publish the records only once they are entirely written
+        self._store(HEAD, head + written)
+        if dropped:
+            self._store(DROPPED, self._load(DROPPED) + dropped)
+        occupancy = head + written - self._load(TAIL)
+        if occupancy > self._load(HIGH_WATER):
+            self._store(HIGH_WATER, occupancy)
+        return written
+
+    def readBatch(self, maxRecords: int) -> List[tuple]:
+        """
+        Consumer side.
+        :return: at most maxRecords records as (device index, flags, time, value 1, value 2, ...) tuples
+        """
+        tail = self._load(TAIL)
+        count = min(maxRecords, self._load(HEAD) - tail)
+        if count <= 0:
+            return []
+        records = list()
+        first = tail % self.capacity
+        # At most two contiguous regions: up to the end of the ring, then from its beginning
+        for begin, size in ((first, min(count, self.capacity - first)), (0, count - min(count, self.capacity - first))):
+            if size > 0:
+                offset = HEADER_SIZE + begin * self.record.size
+                records.extend(self.record.iter_unpack(self._memory.buf[offset:offset + size * self.record.size]))
+        self._store(TAIL, tail + count)
+        return records
+
+    def close(self) -> None:
+        self._memory.close()
+
+    def unlink(self) -> None:
+        self._memory.unlink()
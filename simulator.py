@@ -0,0 +1,210 @@
+"""
+Fake phyphox phones, to develop and benchmark without real devices on Wi-Fi.
+
+    python3 simulator.py --count 3 --port 18080 --sensor-rate 200 --latency 0.02 --jitter 0.01
+
+Each phone serves /, /config, /get (latest value, `full` and `<threshold>|<time buffer>` queries),
+/control (start, stop, clear) and /time like the phyphox remote interface does.
+"""
+from aiohttp import web
+from typing import List, Tuple
+import argparse
+import asyncio
+import math
+import random
+import time
+import uuid
+
+CHANNEL_NAMES = "xyzabcdefghijklmnopqrsuvw"
+
+
+class SimulatedPhone:
+    def __init__(self, sensorRate: float = 100, channels: int = 3, latency: float = 0, jitter: float = 0,
+                 lossRate: float = 0, drift: float = 0, seed: int or None = None):
+        """
+        :param sensorRate: samples per second of the simulated sensor
+        :param channels: data channels of the sensor, its time channel excluded
+        :param latency: seconds added to every answer, +/- a uniform random jitter
+        :param lossRate: probability of a request to fail (503)
+        :param drift: the clock of the phone runs (1 + drift) times as fast as the host's
+        """
+        self.sensorRate = sensorRate
+        self.latency = latency
+        self.jitter = jitter
+        self.lossRate = lossRate
+        self.drift = drift
+        self.random = random.Random(seed)
+        self.channels = [f"acc{CHANNEL_NAMES[i % len(CHANNEL_NAMES)]}{i // len(CHANNEL_NAMES) or ''}" for i in range(channels)]
+        self.timeChannel = "acc_time"
+        self.session = uuid.uuid4().hex[:8]
+        self.requests = 0
+        self._elapsed = 0.0
+        self._resumedAt: float or None = None
+        self._events: List[dict] = list()
+
+    def experimentTime(self) -> float:
+        if self._resumedAt is None:
+            return self._elapsed
+        return self._elapsed + (time.time() - self._resumedAt) * (1 + self.drift)
+
+    def _count(self) -> int:
+        return int(self.experimentTime() * self.sensorRate)
+
+    def _value(self, channel: int, t: float) -> float:
+        return math.sin(2 * math.pi * (channel + 1) * t) + channel
+
+    def _indexes(self, query: str) -> range:
+        count = self._count()
+        if query == "full":
+            return range(count)
+        if query == "":
+            return range(max(0, count - 1), count)
+        # Threshold on the time buffer: the samples strictly after it
+        threshold = float(query.split("|")[0])
+        return range(min(count, max(0, math.floor(threshold * self.sensorRate + 1e-6) + 1)), count)
+
+    def buffer(self, name: str, indexes: range) -> list:
+        times = [i / self.sensorRate for i in indexes]
+        if name == self.timeChannel:
+            return times
+        channel = self.channels.index(name)
+        return [self._value(channel, t) for t in times]
+
+    def config(self) -> dict:
+        outputs = [{CHANNEL_NAMES[i % len(CHANNEL_NAMES)]: name} for i, name in enumerate(self.channels)]
+        outputs.append({"t": self.timeChannel})
+        return {
+            "title": "Simulated phone",
+            "inputs": [{"source": "accelerometer", "outputs": outputs}],
+            "buffers": [{"name": name, "size": 0} for name in self.channels + [self.timeChannel]],
+        }
+
+    def control(self, command: str) -> bool:
+        now = time.time()
+        if command == "start" and self._resumedAt is None:
+            self._events.append({"event": "START", "experimentTime": self._elapsed, "systemTime": now})
+            self._resumedAt = now
+        elif command == "stop" and self._resumedAt is not None:
+            self._elapsed = self.experimentTime()
+            self._resumedAt = None
+            self._events.append({"event": "PAUSE", "experimentTime": self._elapsed, "systemTime": now})
+        elif command == "clear":
+            self._elapsed = 0.0
+            self._resumedAt = None
+            self._events.clear()
+            self.session = uuid.uuid4().hex[:8]
+        else:
+            return command in ("start", "stop")
+        return True
+
+    async def _delay(self) -> None:
+        self.requests += 1
+        delay = self.latency + self.random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if self.random.random() < self.lossRate:
+            raise web.HTTPServiceUnavailable()
+
+    async def handleRoot(self, request: web.Request) -> web.Response:
+        await self._delay()
+        return web.Response(text="<html><body>Simulated phyphox</body></html>", content_type="text/html")
+
+    async def handleConfig(self, request: web.Request) -> web.Response:
+        await self._delay()
+        return web.json_response(self.config())
+
+    async def handleGet(self, request: web.Request) -> web.Response:
+        await self._delay()
+        buffers = dict()
+        for name, query in request.query.items():
+            if name != self.timeChannel and name not in self.channels:
+                continue
+            buffers[name] = {"size": 0, "updateMode": "partial" if "|" in query else "full",
+                             "buffer": self.buffer(name, self._indexes(query))}
+        status = {"session": self.session, "measuring": self._resumedAt is not None, "timedRun": False, "countDown": 0}
+        return web.json_response({"buffer": buffers, "status": status})
+
+    async def handleControl(self, request: web.Request) -> web.Response:
+        await self._delay()
+        return web.json_response({"result": self.control(request.query.get("cmd", ""))})
+
+    async def handleTime(self, request: web.Request) -> web.Response:
+        await self._delay()
+        return web.json_response(self._events)
+
+    def application(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get("/", self.handleRoot)
+        app.router.add_get("/config", self.handleConfig)
+        app.router.add_get("/get", self.handleGet)
+        app.router.add_get("/control", self.handleControl)
+        app.router.add_get("/time", self.handleTime)
+        return app
+
+
+def simulatorAddresses(count: int, port: int, host: str = "127.0.0.1", distinctHosts: bool = False) -> List[Tuple[str, int]]:
+    """
+    The phones are told apart by their ip in the whole tool: with distinctHosts, they are served on
+    consecutive loopback addresses (127.0.0.1, 127.0.0.2, ... on the same port, Linux only), otherwise
+    on consecutive ports of the same host.
+    """
+    if distinctHosts:
+        first = int(host.rsplit(".", 1)[1])
+        prefix = host.rsplit(".", 1)[0]
+        return [(f"{prefix}.{first + i}", port) for i in range(count)]
+    return [(host, port + i) for i in range(count)]
+
+
+async def startSimulators(count: int, port: int, host: str = "127.0.0.1", distinctHosts: bool = False,
+                          **options) -> List[Tuple[web.AppRunner, SimulatedPhone]]:
+    """
+    Serve `count` simulated phones (see simulatorAddresses), see SimulatedPhone for the options.
+    Stop them with `await runner.cleanup()`.
+    """
+    simulators = list()
+    for address, phonePort in simulatorAddresses(count, port, host, distinctHosts):
+        phone = SimulatedPhone(**options)
+        runner = web.AppRunner(phone.application(), access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, address, phonePort).start()
+        simulators.append((runner, phone))
+    return simulators
+
+
+def parseArguments(arguments: List[str] or None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Serve simulated phyphox phones.")
+    parser.add_argument("--count", type=int, default=1, help="number of phones (default: %(default)s)")
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on (default: %(default)s)")
+    parser.add_argument("--port", type=int, default=18080, help="port of the first phone, the next ones follow (default: %(default)s)")
+    parser.add_argument("--distinct-hosts", action="store_true", help="serve the phones on consecutive loopback "
+                                                                      "addresses instead of consecutive ports")
+    parser.add_argument("--sensor-rate", type=float, default=100, help="samples per second (default: %(default)s)")
+    parser.add_argument("--channels", type=int, default=3, help="data channels per phone (default: %(default)s)")
+    parser.add_argument("--latency", type=float, default=0, help="seconds added to each answer (default: %(default)s)")
+    parser.add_argument("--jitter", type=float, default=0, help="random +/- seconds on the latency (default: %(default)s)")
+    parser.add_argument("--loss", type=float, default=0, help="probability of a request to fail (default: %(default)s)")
+    parser.add_argument("--drift", type=float, default=0, help="clock drift of the phones, in ppm (default: %(default)s)")
+    return parser.parse_args(arguments)
+
+
+def simulatorOptions(args: argparse.Namespace) -> dict:
+    return {"sensorRate": args.sensor_rate, "channels": args.channels, "latency": args.latency,
+            "jitter": args.jitter, "lossRate": args.loss, "drift": args.drift / 10**6}
+
+
+async def serve(args: argparse.Namespace) -> None:
+    simulators = await startSimulators(args.count, args.port, args.host, args.distinct_hosts, **simulatorOptions(args))
+    addresses = simulatorAddresses(args.count, args.port, args.host, args.distinct_hosts)
+    print("Serving simulated phones on", ", ".join(f"{ip}:{port}" for ip, port in addresses), "- CTRL-C to stop")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        for runner, _ in simulators:
+            await runner.cleanup()
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(serve(parseArguments()))
+    except KeyboardInterrupt:
+        pass
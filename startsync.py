@@ -0,0 +1,87 @@
+"""
+Start of several phones at a single instant, and measurement of when each one really started.
+
+Sent one after the other, each one possibly opening its connection, the start commands land tens to hundreds
+of milliseconds apart. Instead:
+
+    1. warmUp: one request to every phone beforehand, so a keep-alive connection to it is open and idle
+    2. startTogether: every start request is sent from the same iteration of the event loop, at a host time
+       scheduled in advance, which several producer processes can share
+    3. the phone started between the sending of its request and its answer: its start is estimated at the
+       middle of this round trip, within half of it.
+
+The skew of a device is its estimated start minus the scheduled instant, which is t=0 of the stream.
+The samples don't need to be shifted: they are stamped with their sensor time mapped to the host clock
+(see clocksync.py), so the first sample of a phone which started late is late on the common timeline too.
+Neither the clock mapping nor `/time` measure the start better: the mapping relies on the newest sample time
+of the phone, which lags its experiment time by up to a sensor period, and the START event of `/time` is
+stamped by the phone's own clock, not synchronized with the host.
+"""
+from dataclasses import dataclass
+from phyphox import PhyphoxPhone
+from typing import List, Sequence
+import asyncio
+import math
+import time
+
+# Seconds between the scheduling of the start and the instant, for every process to get it
+START_LEAD = 0.25
+# The end of the wait is spent polling the clock: asyncio.sleep can be late by a millisecond or more
+SPIN_MARGIN = 0.005
+
+
+@dataclass
+class StartReport:
+    ip: str
+    # Host times (time.time()): the instant scheduled, the sending of the start request and its answer
+    scheduledAt: float
+    sentAt: float = math.nan
+    answeredAt: float = math.nan
+
+    @property
+    def started(self) -> bool:
+        return self.answeredAt == self.answeredAt
+
+    @property
+    def skew(self) -> float:
+        """
+        Seconds between the scheduled instant and the start of the phone.
+        """
+        return (self.sentAt + self.answeredAt) / 2 - self.scheduledAt
+
+    @property
+    def uncertainty(self) -> float:
+        return (self.answeredAt - self.sentAt) / 2
+
+
+async def warmUp(devices: Sequence[PhyphoxPhone]) -> None:
+    await asyncio.gather(*(device.ping() for device in devices))
+
+
+async def _sleepUntil(instant: float) -> None:
+    remaining = instant - time.time() - SPIN_MARGIN
+    if remaining > 0:
+        await asyncio.sleep(remaining)
+    while time.time() < instant:
+        pass
+
+
+async def startTogether(devices: Sequence[PhyphoxPhone], instant: float) -> List[StartReport]:
+    """
+    Start the experiment on every device at the host time `instant` (now if it's past), and measure when each
+    one started. Warm the connections up before (see warmUp).
+    :return: the measured start of each device, in their order
+    """
+    reports = [StartReport(device.ip, instant) for device in devices]
+    await _sleepUntil(instant)
+
+    async def start(device: PhyphoxPhone, report: StartReport) -> None:
+        previous = device.startAt
+        report.sentAt = time.time()
+        await device.startExperiment()
+        # Set when the phone accepted the command
+        if device.startAt != previous:
+            report.answeredAt = device.startAt / 10**9
+
+    await asyncio.gather(*(start(device, report) for device, report in zip(devices, reports)))
+    return reports
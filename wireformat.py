@@ -0,0 +1,126 @@
+"""
+Compact binary format of the UDP broadcast.
+
+Every datagram starts with the magic b"PX", the protocol version and the packet type (network order).
+
+Schema packet:  device id (u16), schema id (u16), device ip (u8 length + utf-8),
+                channel count (u16), then each channel name (u8 length + utf-8)
+Data packet:    device id (u16), sequence number (u32), schema id (u16), frame count (u16),
+                then for each frame its time followed by one value per channel of the schema,
+                all little-endian float64. Missing values are NaN.
+
+Gap packet:     device id (u16), start time, end time (float64): the samples of the device between these
+                times are lost (the device was unreachable, or its data was cleared).
+
+Start packet:   device id (u16), start time, uncertainty (float64): when the device really started, relative
+                to t=0 of the stream, which is the instant every device was asked to start (see startsync.py).
+
+A data packet can only be decoded once the schema packet with the same device id and schema id
+has been received, so the schemas are announced at start and then periodically.
+examples/phyclient.py holds the matching decoder.
+"""
+from typing import Dict, List, Iterable, Sequence
+from samplestore import DataFrame
+import math
+import struct
+
+MAGIC = b"PX"
+VERSION = 1
+SCHEMA_PACKET = 1
+DATA_PACKET = 2
+GAP_PACKET = 3
+START_PACKET = 4
+
+HEADER = struct.Struct("!2sBB")
+SCHEMA_HEADER = struct.Struct("!HH")
+DATA_HEADER = struct.Struct("!HIHH")
+GAP_BODY = struct.Struct("!Hdd")
+START_BODY = struct.Struct("!Hdd")
+# Keep datagrams under the usual Ethernet MTU once the IP and UDP headers are added
+DEFAULT_MTU = 1400
+
+
+def _packString(value: str) -> bytes:
+    encoded = value.encode()[:255]
+    return bytes((len(encoded),)) + encoded
+
+
+class BinaryEncoder:
+    def __init__(self, mtu: int = DEFAULT_MTU):
+        self.mtu = mtu
+        self._deviceIds: Dict[str, int] = dict()
+        self._schemas: Dict[str, List[str]] = dict()
+        self._schemaIds: Dict[str, int] = dict()
+        self._sequences: Dict[str, int] = dict()
+
+    def registerDevice(self, ip: str, channels: Iterable[str]) -> bytes:
+        """
+        Declare (or update) the channels of a device.
+        :return: the schema packet to announce
+        """
+        channels = list(channels)
+        if ip not in self._deviceIds:
+            self._deviceIds[ip] = len(self._deviceIds)
+            self._sequences[ip] = 0
+            self._schemaIds[ip] = 0
+        elif self._schemas[ip] != channels:
+            self._schemaIds[ip] = (self._schemaIds[ip] + 1) % 2**16
+        self._schemas[ip] = channels
+        return self.schemaPacket(ip)
+
+    def schemaPacket(self, ip: str) -> bytes:
+        channels = self._schemas[ip]
+        packet = bytearray(HEADER.pack(MAGIC, VERSION, SCHEMA_PACKET))
+        packet += SCHEMA_HEADER.pack(self._deviceIds[ip], self._schemaIds[ip])
+        packet += _packString(ip)
+        packet += struct.pack("!H", len(channels))
+        for channel in channels:
+            packet += _packString(channel)
+        return bytes(packet)
+
+    def schemaPackets(self) -> List[bytes]:
+        return [self.schemaPacket(ip) for ip in self._schemas]
+
+    def framesPerPacket(self, ip: str) -> int:
+        frameSize = 8 * (len(self._schemas[ip]) + 1)
+        return max(1, (self.mtu - HEADER.size - DATA_HEADER.size) // frameSize)
+
+    def encodeFrames(self, ip: str, frames: List[DataFrame]) -> List[bytes]:
+        """
+        Pack the frames of a device in as few datagrams as the MTU allows.
+        """
+        channels = self._schemas[ip]
+        rows = list()
+        for frame in frames:
+            data = frame.data or {}
+            rows.append((frame.t, *(math.nan if data.get(channel) is None else data[channel] for channel in channels)))
+        return self.encodeRows(ip, rows)
+
+    def encodeRows(self, ip: str, rows: List[Sequence[float]]) -> List[bytes]:
+        """
+        Same as encodeFrames, from rows already in the schema order: (time, value 1, value 2, ...).
+        """
+        frameFormat = struct.Struct(f"<{len(self._schemas[ip]) + 1}d")
+        perPacket = self.framesPerPacket(ip)
+        packets = list()
+        for begin in range(0, len(rows), perPacket):
+            chunk = rows[begin:begin + perPacket]
+            packet = bytearray(HEADER.pack(MAGIC, VERSION, DATA_PACKET))
+            packet += DATA_HEADER.pack(self._deviceIds[ip], self._sequences[ip], self._schemaIds[ip], len(chunk))
+            self._sequences[ip] = (self._sequences[ip] + 1) % 2**32
+            for row in chunk:
+                packet += frameFormat.pack(*row)
+            packets.append(bytes(packet))
+        return packets
+
+    def encodeGap(self, ip: str, start: float, end: float) -> bytes:
+        """
+        Announce that the samples of the device between these times are lost.
+        """
+        return HEADER.pack(MAGIC, VERSION, GAP_PACKET) + GAP_BODY.pack(self._deviceIds[ip], start, end)
+
+    def encodeStart(self, ip: str, start: float, uncertainty: float) -> bytes:
+        """
+        Announce when the device really started, relative to t=0.
+        """
+        return HEADER.pack(MAGIC, VERSION, START_PACKET) + START_BODY.pack(self._deviceIds[ip], start, uncertainty)